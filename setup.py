@@ -35,15 +35,19 @@ setup(name='mist.io',
       keywords='web cloud mobile libcloud pyramid amazon rackspace openstack linode',
       packages=find_packages('src'),
       package_dir = {'':'src'},
+      py_modules=['mist_green'],
       namespace_packages=['mist'],
       include_package_data=True,
       zip_safe=False,
       install_requires=requires,
+      extras_require={'gevent': ['gevent']},
       tests_require=requires,
       test_suite="mist.io",
       entry_points = """\
       [paste.app_factory]
       main = mist.io:main
+      [paste.server_runner]
+      gevent = mist_green:serve
       """,
       )
 
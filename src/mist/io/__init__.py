@@ -3,10 +3,20 @@ import yaml
 import logging
 
 from pyramid.config import Configurator
+from pyramid.events import NewRequest
 
 from mist.io.resources import Root
 from mist.io import helpers
 from mist.io.shell import ShellMiddleware
+from mist.io.ssh import start_executor
+from mist.io.poller import InventoryPoller
+from mist.io.sessions import ShellSessions
+from mist.io.store import open_store, refresh_store
+from mist.io.keygen import KeypairPool
+from mist.io.workers import WorkerPool
+from mist.io.jobs import MachineJobs
+from mist.io.catalog import ImageCatalog, ListingCache
+from mist.io.config import BACKEND_WORKERS, SIZES_TTL, LOCATIONS_TTL
 
 log = logging.getLogger('mist.io')
 
@@ -20,19 +30,70 @@ def main(global_config, **settings):
     helpers.load_settings(settings)
 
     config = Configurator(root_factory=Root, settings=settings)
+    # views see a copy of settings, everything else must share it
+    settings = config.registry.settings
+
+    # Where backends and keypairs are stored, settings.yaml or sqlite
+    config.registry.store = open_store(settings)
+    config.add_subscriber(refresh_store, NewRequest)
+
+    # Poll backends in the background, views answer from its snapshots
+    config.registry.poller = InventoryPoller(settings)
+    config.registry.poller.start()
+
+    # Threads for calls to many backends at once
+    config.registry.backend_pool = WorkerPool(BACKEND_WORKERS, name='backend')
+
+    # Threads for creating machines and other slow actions, tracked as jobs
+    config.registry.machine_jobs = MachineJobs(config.registry.poller)
+
+    # Threads for SSH commands, with a bounded queue in front of them
+    start_executor(settings['ssh_workers'], settings['ssh_queue_size'])
+
+    # Interactive shells, kept open between commands
+    config.registry.shell_sessions = ShellSessions()
+
+    # Keypairs generated in the background, ready for new keys
+    config.registry.keypair_pool = KeypairPool(settings['keypair_pool_size'],
+                                               settings['keypair_type'],
+                                               settings['keypair_bits'])
+    config.registry.keypair_pool.start()
+
+    # Image catalogs, kept on disk as they rarely change
+    config.registry.image_catalog = ImageCatalog(settings['image_catalog_dir'])
+
+    # Sizes and locations, fetched in the background to be ready when needed
+    config.registry.sizes = ListingCache(lambda conn: conn.list_sizes(),
+                                         SIZES_TTL)
+    config.registry.locations = ListingCache(lambda conn: conn.list_locations(),
+                                             LOCATIONS_TTL)
+    config.registry.sizes.prewarm(settings['backends'],
+                                  config.registry.backend_pool)
+    config.registry.locations.prewarm(settings['backends'],
+                                      config.registry.backend_pool)
 
     config.add_static_view('static', 'mist.io:static')
 
     config.add_route('home', '/')
     config.add_route('backends', '/backends')
     config.add_route('backend_action', '/backends/{backend}')
+    config.add_route('events', '/events')
 
+    config.add_route('all_machines', '/machines')
+    config.add_route('uptimes', '/machines/uptime')
+    config.add_route('fleet_shell', '/machines/shell')
+    config.add_route('machine_actions', '/machines/actions')
     config.add_route('machines', '/backends/{backend}/machines')
     config.add_route('machine', '/backends/{backend}/machines/{machine}')
     config.add_route('machine_metadata',
                      '/backends/{backend}/machines/{machine}/metadata')
     config.add_route('machine_shell',
                      '/backends/{backend}/machines/{machine}/shell')
+    config.add_route('machine_sessions',
+                     '/backends/{backend}/machines/{machine}/sessions')
+    config.add_route('session', '/sessions/{session}')
+    config.add_route('session_output', '/sessions/{session}/output')
+    config.add_route('job', '/jobs/{job}')
 
     config.add_route('images', '/backends/{backend}/images')
     config.add_route('sizes', '/backends/{backend}/sizes')
@@ -0,0 +1,212 @@
+"""Cached catalogs of images, sizes and locations"""
+import os
+import re
+import json
+import logging
+import tempfile
+import threading
+
+from time import time
+
+from mist.io.config import IMAGES_TTL, IMAGE_DISTROS
+from mist.io.helpers import backend_hash, get_connection, get_images
+from mist.io.helpers import evict_driver
+
+
+log = logging.getLogger('mist.io')
+
+
+def tokenize(text):
+    """Splits text in lowercase words, for indexing and searching."""
+    return [word for word in re.split(r'[^a-z0-9]+', (text or '').lower())
+            if word]
+
+
+def get_distro(name):
+    """Guesses the distro of an image from its name, None if unknown."""
+    name = (name or '').lower()
+    for fragment, distro in IMAGE_DISTROS.iteritems():
+        if fragment in name:
+            return distro
+    return None
+
+
+class ImageCatalog(object):
+    """Keeps the images of each backend on disk and in memory.
+
+    Images rarely change, so a catalog is fetched from the provider only the
+    first time, then served from memory or from its file under path, even
+    across restarts. Once older than IMAGES_TTL it is still served, but
+    revalidated by a background thread. Catalogs are keyed by backend_hash(),
+    so editing a backend's credentials starts a new one.
+
+    Each catalog is indexed by the words of the image names and their distro,
+    so that search() can answer queries without the client downloading the
+    full list.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.catalogs = {}
+        self.refreshing = set()
+        self.lock = threading.Lock()
+        if not os.path.isdir(path):
+            os.makedirs(path)
+
+    def filename(self, key):
+        return os.path.join(self.path, '%s.json' % key)
+
+    def get(self, backend_id, backend):
+        """Returns the catalog of a backend, a dict with images and index.
+
+        Raises if the catalog has to be fetched and the provider fails.
+        """
+        key = backend_hash(backend)
+        catalog = self.catalogs.get(key, None) or self.load(key)
+        if not catalog:
+            return self.refresh(backend_id, backend)
+
+        if time() - catalog['updated'] > IMAGES_TTL:
+            with self.lock:
+                if key in self.refreshing:
+                    return catalog
+                self.refreshing.add(key)
+            thread = threading.Thread(target=self.revalidate,
+                                      args=(backend_id, backend))
+            thread.daemon = True
+            thread.start()
+        return catalog
+
+    def load(self, key):
+        """Loads a catalog from disk, returns None if there is none."""
+        try:
+            with open(self.filename(key), 'r') as catalog_file:
+                stored = json.load(catalog_file)
+        except (IOError, ValueError):
+            return None
+        catalog = self.build(stored['images'], stored['updated'])
+        self.catalogs[key] = catalog
+        return catalog
+
+    def refresh(self, backend_id, backend):
+        """Fetches the images of a backend and stores them on disk."""
+        key = backend_hash(backend)
+        try:
+            with get_connection(backend_id, backend) as conn:
+                images = get_images(conn)
+        except:
+            evict_driver(backend_id)
+            raise
+        catalog = self.build(images, time())
+
+        # write to a temp file and rename, so readers never see half a file
+        (tmp_fd, tmp_path) = tempfile.mkstemp(dir=self.path)
+        with os.fdopen(tmp_fd, 'w') as tmp_file:
+            json.dump({'updated': catalog['updated'], 'images': images},
+                      tmp_file)
+        os.rename(tmp_path, self.filename(key))
+
+        self.catalogs[key] = catalog
+        return catalog
+
+    def revalidate(self, backend_id, backend):
+        key = backend_hash(backend)
+        try:
+            self.refresh(backend_id, backend)
+        except Exception as exc:
+            log.warn('Could not revalidate images of backend %s: %s'
+                     % (backend_id, exc))
+        finally:
+            with self.lock:
+                self.refreshing.discard(key)
+
+    def forget(self, backend):
+        """Removes the catalog of a backend, e.g. when it gets deleted."""
+        key = backend_hash(backend)
+        self.catalogs.pop(key, None)
+        try:
+            os.remove(self.filename(key))
+        except OSError:
+            pass
+
+    def build(self, images, updated):
+        """Returns a catalog for images, indexing them by word."""
+        index = {}
+        for position, image in enumerate(images):
+            words = tokenize(image['name'])
+            distro = get_distro(image['name'])
+            if distro:
+                words.append(distro)
+            for word in words:
+                index.setdefault(word, set()).add(position)
+        return {'updated': updated, 'images': images, 'index': index}
+
+    def search(self, catalog, query='', offset=0, limit=None):
+        """Searches a catalog, returns the total matches and a page of them.
+
+        Every word of the query has to prefix a word of the image name or its
+        distro, e.g. 'ubu 12' finds 'Ubuntu Server 12.04.1 LTS 64bit'. An
+        empty query matches all images. Matches keep the catalog order.
+        """
+        images = catalog['images']
+        index = catalog['index']
+
+        matches = None
+        for word in tokenize(query):
+            found = set()
+            for indexed, positions in index.iteritems():
+                if indexed.startswith(word):
+                    found.update(positions)
+            matches = found if matches is None else matches & found
+
+        if matches is None:
+            results = images
+        else:
+            results = [images[position] for position in sorted(matches)]
+
+        if limit is None:
+            return len(results), results[offset:]
+        return len(results), results[offset:offset + limit]
+
+
+class ListingCache(object):
+    """Keeps near static listings of each backend in memory, e.g. sizes.
+
+    fetch is called with a driver and returns the listing, which is then
+    kept for ttl seconds. Listings are keyed by backend_hash(), so editing a
+    backend's credentials starts over.
+    """
+
+    def __init__(self, fetch, ttl):
+        self.fetch = fetch
+        self.ttl = ttl
+        self.listings = {}
+
+    def get(self, backend_id, backend):
+        """Returns the cached listing of a backend, fetching it if needed."""
+        listing = self.listings.get(backend_hash(backend), None)
+        if listing and time() - listing['updated'] < self.ttl:
+            return listing['items']
+        return self.refresh(backend_id, backend)
+
+    def refresh(self, backend_id, backend):
+        """Fetches the listing of a backend from the provider."""
+        try:
+            with get_connection(backend_id, backend) as conn:
+                items = self.fetch(conn)
+        except:
+            evict_driver(backend_id)
+            raise
+        self.listings[backend_hash(backend)] = {'updated': time(),
+                                                'items': items}
+        return items
+
+    def prewarm(self, backends, pool):
+        """Fetches the listings of all enabled backends on a WorkerPool."""
+        for backend_id, backend in backends.items():
+            if backend.get('enabled', True):
+                pool.submit(self.get, backend_id, backend)
+
+    def forget(self, backend):
+        """Drops the listing of a backend, e.g. when it gets deleted."""
+        self.listings.pop(backend_hash(backend), None)
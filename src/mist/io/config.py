@@ -5,6 +5,144 @@ from libcloud.compute.types import NodeState
 
 COMMAND_TIMEOUT = 20
 
+
+# Seconds settings.yaml writes wait for more changes, see SettingsWriter,
+# and at most between retries of a failed write
+SETTINGS_WRITE_DELAY = 0.5
+SETTINGS_RETRY_MAX = 60
+
+# Parsed settings.yaml, reused at startup while the file is unchanged
+SETTINGS_CACHE = '.settings.cache'
+
+
+# Pooled SSH connections, see ssh.SSHPool. All values besides the number of
+# connections are in seconds.
+SSH_MAX_CONNECTIONS = 200
+SSH_IDLE_TIMEOUT = 300
+SSH_KEEPALIVE = 15
+SSH_CONNECT_TIMEOUT = 10
+SSH_HEALTH_CHECK = 60
+
+
+# Defaults for the ssh_workers and ssh_queue_size settings, see ssh.SSHExecutor
+SSH_WORKERS = 32
+SSH_QUEUE_SIZE = 256
+
+# Commands a single batch request may have in flight, e.g. uptime checks
+SSH_BATCH_CONCURRENCY = 20
+
+# Longest timeout in seconds a command run on many machines may ask for
+SHELL_MAX_TIMEOUT = 600
+
+# Chunks of up to 4KB of shell output kept for a client that reads slowly
+SHELL_BUFFER_CHUNKS = 64
+
+# Shell output is sent once this many bytes or seconds have gathered
+SHELL_FLUSH_SIZE = 16384
+SHELL_FLUSH_INTERVAL = 0.1
+
+# Interactive shell sessions, see sessions.ShellSessions. The buffer is the
+# bytes of latest output kept per session, the timeouts are in seconds
+# without input, the longer one for sessions whose output is still read.
+SHELL_MAX_SESSIONS = 50
+SHELL_SESSION_IDLE_TIMEOUT = 600
+SHELL_SESSION_WATCHED_TIMEOUT = 3600
+SHELL_SESSION_BUFFER = 65536
+
+
+# Seconds a cached libcloud driver may stay unused before it is dropped, and
+# idle drivers kept per backend. Drivers aren't thread safe, so each thread
+# checks one out, see helpers.get_connection
+DRIVER_IDLE_TIMEOUT = 900
+DRIVER_POOL_SIZE = 8
+
+
+# Default for the keypair_pool_size setting, see keygen.KeypairPool
+KEYPAIR_POOL_SIZE = 5
+
+
+# Keypairs dicts indexed at once, see helpers.KeypairIndex. There is one for
+# the settings and, when sessions are used, possibly one per session.
+KEYPAIR_INDEXES = 100
+
+
+# How many removed machines each backend inventory remembers, clients asking
+# for changes since a version older than that get the full list instead
+INVENTORY_MAX_REMOVED = 1000
+
+
+# Threads of the server, Paste's threadpool_workers, unless the server_threads
+# setting says otherwise. Keep them in step, check production.ini.
+SERVER_THREADS = 10
+
+
+# Machine event and shell output streams, lifetime and keepalive interval in
+# seconds. Clients reconnect when a stream ends, so that no thread is held
+# indefinitely. Each stream holds a server thread while it lasts, so at most
+# EVENTS_THREADS_SHARE of the server threads serve streams, whatever
+# events_max_subscribers says.
+EVENTS_MAX_SUBSCRIBERS = 100
+EVENTS_THREADS_SHARE = 0.3
+EVENTS_STREAM_TIMEOUT = 300
+EVENTS_KEEPALIVE = 15
+
+
+# Threads querying backends concurrently, and seconds to wait for each
+# backend when listing all of them at once
+BACKEND_WORKERS = 16
+BACKEND_TIMEOUT = 20
+
+
+# Machine jobs, see jobs.MachineJobs. Creations and other slow actions run on
+# MACHINE_JOB_WORKERS threads with up to MACHINE_JOB_QUEUE_SIZE waiting, and
+# finished jobs can be looked up for MACHINE_JOB_TTL seconds.
+MACHINE_JOB_WORKERS = 10
+MACHINE_JOB_QUEUE_SIZE = 100
+MACHINE_JOB_TTL = 3600
+
+# Machines created at once on a provider, further creations wait for them.
+# Providers not listed get MACHINE_CREATE_CONCURRENCY. A single request may
+# create up to MACHINE_CREATE_MAX machines.
+MACHINE_CREATE_CONCURRENCY = 5
+MACHINE_CREATE_CONCURRENCY_PROVIDERS = {
+    Provider.LINODE: 2,
+    Provider.RACKSPACE_FIRST_GEN: 2,
+}
+MACHINE_CREATE_MAX = 50
+
+
+# Image catalogs are served from disk and revalidated in the background once
+# older than IMAGES_TTL seconds. Searches return IMAGES_PAGE_SIZE by default.
+IMAGES_TTL = 6 * 3600
+IMAGES_PAGE_SIZE = 50
+
+
+# Sizes and locations hardly ever change, cache them for that many seconds
+SIZES_TTL = 3600
+LOCATIONS_TTL = 3600
+
+
+# Fragments of image names that tell the distro, as in the js image model
+IMAGE_DISTROS = {
+    'rhel': 'rhel',
+    'red hat': 'rhel',
+    'redhat': 'rhel',
+    'ubuntu': 'ubuntu',
+    'canonical': 'ubuntu',
+    'sles': 'suse',
+    'suse': 'suse',
+    'oracle': 'oracle',
+    'opensolaris': 'opensolaris',
+    'windows': 'windows',
+    'gentoo': 'gentoo',
+    'fedora': 'fedora',
+    'centos': 'centos',
+    'debian': 'debian',
+    'amazon': 'amazon',
+    'arch': 'arch',
+    'freebsd': 'freebsd',
+}
+
 STATES = {
     NodeState.RUNNING: 'running',
     NodeState.REBOOTING: 'rebooting',
@@ -186,6 +324,19 @@ EC2_SECURITYGROUP = {
 }
 
 
+# Calls a bulk machine action makes at once, each on a driver of its own and
+# with BACKEND_TIMEOUT seconds to end, see views.bulk_machine_action
+MACHINE_ACTIONS_CONCURRENCY = 8
+
+# EC2 API calls acting on many instances at once, by machine action
+EC2_BATCH_ACTIONS = {
+    'start': 'StartInstances',
+    'stop': 'StopInstances',
+    'reboot': 'RebootInstances',
+    'destroy': 'TerminateInstances',
+}
+
+
 # Linode datacenter ids/names mapping
 LINODE_DATACENTERS = {
     2: 'Dallas, TX, USA',
@@ -1,9 +1,25 @@
 """Helper functions used in views"""
 import os
+import atexit
+import marshal
 import tempfile
 import logging
+import threading
 import yaml
 
+from contextlib import contextmanager
+
+try:
+    from yaml import CLoader as SettingsLoader
+    from yaml import CDumper as SettingsDumper
+except ImportError:
+    from yaml import Loader as SettingsLoader
+    from yaml import Dumper as SettingsDumper
+
+from time import time, sleep
+from hashlib import sha256
+from Queue import Queue
+
 from pyramid.response import Response
 
 from libcloud.compute.types import Provider
@@ -12,10 +28,17 @@ from libcloud.compute.providers import get_driver
 from libcloud.compute.base import Node
 from libcloud.compute.types import Provider
 
-from fabric.api import env
-from fabric.api import run
-
 from mist.io.config import EC2_PROVIDERS, COMMAND_TIMEOUT
+from mist.io.config import STATES, LINODE_DATACENTERS, EC2_IMAGES
+from mist.io.config import DRIVER_IDLE_TIMEOUT, KEYPAIR_INDEXES
+from mist.io.config import DRIVER_POOL_SIZE
+from mist.io.config import SETTINGS_WRITE_DELAY, SETTINGS_CACHE
+from mist.io.config import SETTINGS_RETRY_MAX
+from mist.io.config import KEYPAIR_POOL_SIZE, EVENTS_MAX_SUBSCRIBERS
+from mist.io.config import SERVER_THREADS, EVENTS_THREADS_SHARE
+from mist.io.config import SSH_WORKERS, SSH_QUEUE_SIZE
+from mist.io.config import EC2_BATCH_ACTIONS
+from mist.io.ssh import get_executor, ExecutorBusy
 
 # add curl ca-bundle default path to prevent libcloud certificate error
 import libcloud.security
@@ -24,6 +47,26 @@ libcloud.security.CA_CERTS_PATH.append('/usr/share/curl/ca-bundle.crt')
 log = logging.getLogger('mist.io')
 
 
+# Process wide pools of idle libcloud drivers, keyed by backend_hash(), and
+# the pool of each driver checked out, by the driver's id()
+_drivers = {}
+_checked_out = {}
+_drivers_lock = threading.Lock()
+
+# KeypairIndex of each keypairs dict, by the dict's id()
+_keypair_indexes = {}
+_keypair_indexes_lock = threading.Lock()
+
+# Held while changing the machines of the app's keypairs
+keypairs_lock = threading.Lock()
+
+# EC2 keys and security groups known to exist, by backend id and region,
+# and the locks serializing their provisioning
+_provisioned = {}
+_provisioning_locks = {}
+_provisioned_lock = threading.Lock()
+
+
 def load_settings(settings):
     """Gets settings from settings.yaml local file.
 
@@ -31,20 +74,15 @@ def load_settings(settings):
     there is no such file, it creates one for later use and sets some sensible
     defaults without writing them in file.
     """
-    try:
-        config_file = open('settings.yaml', 'r')
-    except IOError:
+    if not os.path.exists('settings.yaml'):
         log.warn('settings.yaml does not exist.')
         config_file = open('settings.yaml', 'w')
         config_file.close()
-        config_file = open('settings.yaml', 'r')
 
     try:
-        user_config = yaml.load(config_file) or {}
-        config_file.close()
+        user_config = read_settings('settings.yaml')
     except:
         log.error('Error parsing settings.yaml')
-        config_file.close()
         raise
 
     settings['keypairs'] = user_config.get('keypairs', {})
@@ -55,45 +93,205 @@ def load_settings(settings):
     settings['js_log_level'] = user_config.get('js_log_level', 3)
     settings['default_poll_interval'] = user_config.get('default_poll_interval',
                                                          10000)
+    settings['image_catalog_dir'] = user_config.get('image_catalog_dir',
+                                                     'catalogs')
+    # these may also come from the ini file, e.g. gevent.ini raises them
+    settings['ssh_workers'] = int(user_config.get('ssh_workers',
+                                  settings.get('ssh_workers', SSH_WORKERS)))
+    settings['ssh_queue_size'] = int(user_config.get('ssh_queue_size',
+                                     settings.get('ssh_queue_size',
+                                                  SSH_QUEUE_SIZE)))
+    settings['server_threads'] = int(user_config.get('server_threads',
+                                     settings.get('server_threads',
+                                                  SERVER_THREADS)))
+    # every event stream holds a server thread, leave most for the rest
+    settings['events_max_subscribers'] = max(1, min(
+        int(user_config.get('events_max_subscribers',
+                            settings.get('events_max_subscribers',
+                                         EVENTS_MAX_SUBSCRIBERS))),
+        int(settings['server_threads'] * EVENTS_THREADS_SHARE)))
+    # keypairs generated ahead of time, check keygen.KeypairPool, gevent.ini
+    # keeps fewer since generating them blocks the other green threads
+    settings['keypair_pool_size'] = int(user_config.get('keypair_pool_size',
+                                        settings.get('keypair_pool_size',
+                                                     KEYPAIR_POOL_SIZE)))
+    settings['keypair_type'] = user_config.get('keypair_type', 'rsa')
+    if not settings['keypair_type'] in ('rsa', 'dsa'):
+        log.warn('Invalid keypair_type %r, using rsa'
+                 % settings['keypair_type'])
+        settings['keypair_type'] = 'rsa'
+    try:
+        bits = int(user_config.get('keypair_bits', 2048))
+    except (TypeError, ValueError):
+        log.warn('Invalid keypair_bits %r, using 2048'
+                 % user_config.get('keypair_bits'))
+        bits = 2048
+    # RSA keys take a multiple of 256 bits, 1024 at least
+    settings['keypair_bits'] = max(1024, bits - bits % 256)
+    if settings['keypair_bits'] != bits:
+        log.warn('keypair_bits %d is not a multiple of 256 of at least 1024, '
+                 'using %d' % (bits, settings['keypair_bits']))
+    # yaml or sqlite, check store.open_store
+    settings['storage'] = user_config.get('storage', 'yaml')
+    settings['sqlite_path'] = user_config.get('sqlite_path', 'mist.db')
+    # stop polling backends nobody has asked for in that many seconds
+    settings['poller_idle_timeout'] = user_config.get('poller_idle_timeout',
+                                                       300)
     if not 'core_uri' in settings:
         settings['core_uri'] = user_config.get('core_uri', 'https://mist.io')
 
 
+def read_settings(path, cache_path=SETTINGS_CACHE):
+    """Parses a settings file, reusing the last parse if it didn't change.
+
+    Parsing yaml is slow, even more without libyaml, so the parsed settings
+    are kept in cache_path along with the size and modification time of the
+    file. If those match the cached copy is loaded, else the file is parsed,
+    with the C yaml loader when available, and the cache rewritten.
+    """
+    stat = os.stat(path)
+    try:
+        with open(cache_path, 'rb') as cache_file:
+            cached = marshal.load(cache_file)
+        if cached['mtime'] == stat.st_mtime and cached['size'] == stat.st_size:
+            return cached['settings']
+    except (IOError, EOFError, ValueError, TypeError, KeyError):
+        pass
+
+    with open(path, 'r') as config_file:
+        settings = yaml.load(config_file, Loader=SettingsLoader) or {}
+
+    directory = os.path.dirname(os.path.abspath(cache_path))
+    tmp_path = None
+    try:
+        (tmp_fd, tmp_path) = tempfile.mkstemp(dir=directory)
+        with os.fdopen(tmp_fd, 'wb') as tmp_file:
+            marshal.dump({'mtime': stat.st_mtime,
+                          'size': stat.st_size,
+                          'settings': settings}, tmp_file)
+        os.rename(tmp_path, cache_path)
+    except (IOError, OSError, ValueError) as exc:
+        # e.g. values marshal can't handle, just parse again next time
+        log.warn('Could not cache %s: %s' % (path, exc))
+        if tmp_path and os.path.exists(tmp_path):
+            os.remove(tmp_path)
+    return settings
+
+
 def save_settings(request):
     """Stores settings to settings.yaml local file.
 
-    This is useful for using mist.io UI to configure your installation. It
-    includes some yaml dump magic in order for the dumped private ssh keys
-    to be in a valid string format.
+    This is useful for using mist.io UI to configure your installation. The
+    file is written shortly after by settings_writer, check SettingsWriter.
+    Backends and keypairs go to the app's storage engine if it has one,
+    check store.py.
+    """
+    settings = request.registry.settings
+    store = getattr(request.registry, 'store', None)
+    if store:
+        store.save()
+    else:
+        settings_writer.save(settings)
+
+
+def save_keypairs(request, keypair):
+    """Stores the machines of a keypair to settings.yaml local file.
+
+    Like save_settings, the file is written shortly after by settings_writer,
+    unless the app has a storage engine, which then stores just this keypair.
     """
-    class folded_unicode(unicode): pass
-    class literal_unicode(unicode): pass
+    if keypair:
+        settings = request.registry.settings
+        keypairs = settings['keypairs']
 
-    def literal_unicode_representer(dumper, data):
-        return dumper.represent_scalar(u'tag:yaml.org,2002:str', data, style='|')
+        with keypairs_lock:
+            index = get_keypair_index(keypairs)
+            key = index.get_name(keypair)
+            if key:
+                #save keypair machines
+                keypairs[key]['machines'] = keypair['machines']
+                index.update(key)
 
-    def folded_unicode_representer(dumper, data):
-        return dumper.represent_scalar(u'tag:yaml.org,2002:str', data, style='>')
+            store = getattr(request.registry, 'store', None)
+            if store and key:
+                store.save_keypair(key)
+            elif not store:
+                settings_writer.save(settings)
 
-    def unicode_representer(dumper, uni):
-        node = yaml.ScalarNode(tag=u'tag:yaml.org,2002:str', value=uni)
-        return node
 
-    yaml.add_representer(unicode, unicode_representer)
-    yaml.add_representer(literal_unicode, literal_unicode_representer)
+def add_keypair_machines(registry, key_name, pairs, save=True):
+    """Associates machines with a keypair of the app and stores it.
 
-    config_file = open('settings.yaml', 'w')
+    pairs is a list of [backend_id, machine_id]. Unlike save_keypairs it
+    needs no request, so machine jobs can call it once the response is gone.
+    Pass save=False to store the keypair later on, with store_keypair(),
+    e.g. once for many machines created together.
+    """
+    settings = registry.settings
+    with keypairs_lock:
+        keypairs = settings['keypairs']
+        keypair = keypairs.get(key_name, None)
+        if not keypair:
+            return
+        index = get_keypair_index(keypairs)
+        if not keypair.get('machines', None):
+            keypair['machines'] = []
+        for backend_id, machine_id in pairs:
+            if not index.has(key_name, backend_id, machine_id):
+                keypair['machines'].append([backend_id, machine_id])
+        index.update(key_name)
+
+    if save:
+        store_keypair(registry, key_name)
+
+
+def store_keypair(registry, key_name):
+    """Stores a keypair of the app, e.g. after add_keypair_machines()."""
+    settings = registry.settings
+    with keypairs_lock:
+        if not key_name in settings['keypairs']:
+            return
+        store = getattr(registry, 'store', None)
+        if store:
+            store.save_keypair(key_name)
+        else:
+            settings_writer.save(settings)
+
+
+class literal_unicode(unicode):
+    """Dumped in yaml literal style, so that ssh keys stay valid strings."""
+
+
+def literal_unicode_representer(dumper, data):
+    # the C emitter takes plain unicode only, not subclasses
+    return dumper.represent_scalar(u'tag:yaml.org,2002:str', unicode(data),
+                                   style='|')
+
+
+def unicode_representer(dumper, uni):
+    node = yaml.ScalarNode(tag=u'tag:yaml.org,2002:str', value=uni)
+    return node
 
-    settings = request.registry.settings
 
+yaml.add_representer(unicode, unicode_representer, Dumper=SettingsDumper)
+yaml.add_representer(literal_unicode, literal_unicode_representer,
+                     Dumper=SettingsDumper)
+
+
+def dump_settings(settings, tables=True):
+    """Returns the settings to store in settings.yaml, as yaml.
+
+    Backends and keypairs are left out unless tables is set, e.g. when they
+    are kept in a database, check store.SQLiteStore.
+    """
     keypairs = {}
-    for key in settings['keypairs'].keys():
+    for key, keypair in settings['keypairs'].items():
         keypairs[key] = {
-            'public': literal_unicode(settings['keypairs'][key]['public']),
-            'private': literal_unicode(settings['keypairs'][key]['private']),
-            'machines': settings['keypairs'][key].get('machines',[])
+            'public': literal_unicode(keypair['public']),
+            'private': literal_unicode(keypair['private']),
+            'machines': keypair.get('machines', [])
         }
-        if settings['keypairs'][key].get('default', None):
+        if keypair.get('default', None):
             keypairs[key]['default'] = True
     payload = {
         'keypairs': keypairs,
@@ -107,110 +305,239 @@ def save_settings(request):
         payload['email'] = settings['email']
         payload['password'] = settings['password']
 
-    yaml.dump(payload, config_file, default_flow_style=False, )
+    if settings.get('storage', 'yaml') != 'yaml':
+        payload['storage'] = settings['storage']
+        payload['sqlite_path'] = settings['sqlite_path']
 
-    config_file.close()
+    if not tables:
+        del payload['keypairs']
+        del payload['backends']
 
-def save_keypairs(request, keypair):
-    """Stores keypairs to settings.yaml local file.
-
-    This is useful for using mist.io UI to configure your installation. It
-    includes some yaml dump magic in order for the dumped private ssh keys
-    to be in a valid string format.
-    """
-    class folded_unicode(unicode): pass
-    class literal_unicode(unicode): pass
+    return yaml.dump(payload, Dumper=SettingsDumper, default_flow_style=False)
 
-    def literal_unicode_representer(dumper, data):
-        return dumper.represent_scalar(u'tag:yaml.org,2002:str', data, style='|')
 
-    def folded_unicode_representer(dumper, data):
-        return dumper.represent_scalar(u'tag:yaml.org,2002:str', data, style='>')
+class SettingsWriter(object):
+    """Writes settings.yaml in the background, coalescing saves.
 
-    def unicode_representer(dumper, uni):
-        node = yaml.ScalarNode(tag=u'tag:yaml.org,2002:str', value=uni)
-        return node
-
-    yaml.add_representer(unicode, unicode_representer)
-    yaml.add_representer(literal_unicode, literal_unicode_representer)
+    save() only marks the settings as changed. A thread writes them delay
+    seconds later, so a burst of changes, e.g. associating many machines,
+    costs a single write. The file is written to a temp file which is then
+    renamed over it, so it is never left half written. The C yaml emitter is
+    used when available. If writing fails, e.g. the disk is full, the changes
+    stay pending and the write is retried, waiting twice as long after each
+    failure up to SETTINGS_RETRY_MAX seconds. flush() writes pending changes
+    right away, it runs at exit so that nothing saved gets lost on shutdown.
+    """
 
-    if keypair:
-        config_file = open('settings.yaml', 'w')
+    def __init__(self, path='settings.yaml', delay=SETTINGS_WRITE_DELAY):
+        self.path = path
+        self.delay = delay
+        # whether backends and keypairs are written too
+        self.tables = True
+        self.settings = None
+        self.dirty = False
+        self.lock = threading.Lock()
+        # held while writing, so that flushes don't interleave
+        self.writing = threading.Lock()
+        self.wakeup = threading.Event()
+        self.thread = None
+
+    def save(self, settings):
+        """Schedules settings to be written."""
+        with self.lock:
+            self.settings = settings
+            self.dirty = True
+            if not self.thread:
+                self.thread = threading.Thread(target=self.run,
+                                               name='settings')
+                self.thread.daemon = True
+                self.thread.start()
+        self.wakeup.set()
+
+    def run(self):
+        retry = self.delay
+        while True:
+            self.wakeup.wait()
+            self.wakeup.clear()
+            # gather the changes that follow
+            sleep(self.delay)
+            if self.flush():
+                retry = self.delay
+            else:
+                sleep(retry)
+                retry = min(retry * 2, SETTINGS_RETRY_MAX)
+                self.wakeup.set()
+
+    def flush(self):
+        """Writes pending changes now, if there are any.
+
+        Returns False if writing failed, the changes then stay pending.
+        """
+        with self.writing:
+            with self.lock:
+                if not self.dirty:
+                    return True
+                settings = self.settings
+                self.dirty = False
+            try:
+                self.write(settings)
+            except Exception as exc:
+                log.error('Error writing %s, will retry: %s'
+                          % (self.path, exc))
+                with self.lock:
+                    self.dirty = True
+                return False
+            return True
 
-        settings = request.registry.settings
-        keypairs = request.registry.settings['keypairs']
+    def write(self, settings):
+        # views may change settings meanwhile, retry if caught in the middle
+        for attempt in range(3):
+            try:
+                data = dump_settings(settings, self.tables)
+                break
+            except RuntimeError:
+                if attempt == 2:
+                    raise
+
+        directory = os.path.dirname(os.path.abspath(self.path))
+        (tmp_fd, tmp_path) = tempfile.mkstemp(dir=directory)
+        try:
+            with os.fdopen(tmp_fd, 'w') as tmp_file:
+                tmp_file.write(data)
+                tmp_file.flush()
+                os.fsync(tmp_file.fileno())
+            os.rename(tmp_path, self.path)
+        except:
+            os.remove(tmp_path)
+            raise
 
-        for key in settings['keypairs'].keys():
-            if settings['keypairs'][key]['public'] == keypair['public'] and settings['keypairs'][key]['private'] == keypair['private']:
-                #save keypair machines
-                keypairs[key] = {
-                    'public': literal_unicode(settings['keypairs'][key]['public']),
-                    'private': literal_unicode(settings['keypairs'][key]['private']),
-                    'machines': keypair['machines'],
-                    'default': settings['keypairs'][key].get('default', None)
-                }
-
-        payload = {
-            'keypairs': keypairs,
-            'backends': settings['backends'],
-            'core_uri': settings['core_uri'],
-            'js_build': settings['js_build'],
-            'js_log_level': settings['js_log_level'],
-            }
-
-        if settings.get('email', False) and settings.get('password', False):
-            payload['email'] = settings['email']
-            payload['password'] = settings['password']
-
-        yaml.dump(payload, config_file, default_flow_style=False, )
 
-        config_file.close()
+# Shared by all saves of this process
+settings_writer = SettingsWriter()
+atexit.register(settings_writer.flush)
 
 
 def get_keypair_by_name(keypairs, name):
     "get key pair by name"
-
-    for key in keypairs:
-        if name == key:
-            return keypairs[key]
-    return {}
+    return keypairs.get(name, {})
 
 
 def get_keypair(keypairs, backend_id=None, machine_id=None):
     "get key pair for machine, else get default key pair"
+    return get_keypair_index(keypairs).get(backend_id, machine_id)
 
-    for key in keypairs:
-        machines = keypairs[key].get('machines', None)
-        if machines and len(machines):
-            for machine in keypairs[key]['machines']:
-                if machine == [backend_id, machine_id]:
-                    return keypairs[key]
-    for key in keypairs:
-        if keypairs[key].get('default', False):
-            return keypairs[key]
-
-    return {}
 
+class KeypairIndex(object):
+    """Finds the keypair of a machine without scanning all keypairs.
 
-def connect(request, backend_id=False):
-    """Establishes backend connection using the credentials specified.
-
-    It has been tested with:
+    Maps every (backend_id, machine_id) pair to the name of its keypair and
+    remembers the default keypair and the name of each public key. It is
+    built once per keypairs dict, check get_keypair_index(). Call update()
+    with the name of every keypair added, replaced, removed, made default or
+    whose machines changed, lookups never scan the keypairs.
+    """
 
-        * EC2, and the alternative providers like EC2_EU,
-        * Rackspace, old style and the new Nova powered one,
-        * Openstack Diablo through Trystack, should also try Essex,
-        * Linode
+    def __init__(self, keypairs):
+        self.keypairs = keypairs
+        self.lock = threading.Lock()
+        self.rebuild()
+
+    def rebuild(self):
+        with self.lock:
+            self.machines = {}
+            self.pairs = {}
+            self.publics = {}
+            self.names = {}
+            self.default = None
+            for name in self.keypairs.keys():
+                self.index(name)
+
+    def update(self, name):
+        """Reindexes a keypair, or drops it if it's no longer in keypairs."""
+        with self.lock:
+            self.index(name)
+
+    def index(self, name):
+        for pair in self.pairs.pop(name, ()):
+            if self.machines.get(pair, None) == name:
+                del self.machines[pair]
+        public = self.names.pop(name, None)
+        if self.publics.get(public, None) == name:
+            del self.publics[public]
+        keypair = self.keypairs.get(name, None)
+        if not keypair:
+            if self.default == name:
+                self.default = None
+            return
+
+        if keypair.get('default', False):
+            self.default = name
+        elif self.default == name:
+            self.default = None
+        public = keypair.get('public', None)
+        self.names[name] = public
+        self.publics.setdefault(public, name)
+
+        pairs = set()
+        for machine in keypair.get('machines', None) or []:
+            try:
+                pair = (machine[0], machine[1])
+            except (IndexError, TypeError):
+                continue
+            pairs.add(pair)
+            self.machines.setdefault(pair, name)
+        self.pairs[name] = pairs
+
+    def get(self, backend_id, machine_id):
+        """Returns the keypair of a machine, else the default, else {}."""
+        name = self.machines.get((backend_id, machine_id), None)
+        if name in self.keypairs:
+            return self.keypairs[name]
+        if self.default in self.keypairs:
+            return self.keypairs[self.default]
+        return {}
+
+    def has(self, name, backend_id, machine_id):
+        """Checks if a machine is associated to the keypair name."""
+        return (backend_id, machine_id) in self.pairs.get(name, ())
+
+    def get_name(self, keypair):
+        """Returns the name of a keypair, None if it's not in keypairs."""
+        name = self.publics.get(keypair.get('public', None), None)
+        stored = self.keypairs.get(name, None)
+        if stored and stored['private'] == keypair.get('private', None):
+            return name
+        return None
+
+
+def get_keypair_index(keypairs):
+    """Returns the KeypairIndex of a keypairs dict, building it if needed."""
+    with _keypair_indexes_lock:
+        index = _keypair_indexes.get(id(keypairs), None)
+        if not index or index.keypairs is not keypairs:
+            if len(_keypair_indexes) >= KEYPAIR_INDEXES:
+                # e.g. one dict per session, start over rather than grow
+                _keypair_indexes.clear()
+            index = KeypairIndex(keypairs)
+            _keypair_indexes[id(keypairs)] = index
+        return index
+
+
+def backend_hash(backend):
+    """Returns a hash of everything that identifies a backend's connection.
+
+    Provider, region, credentials and auth url all take part, so editing any
+    of them results in a different hash and thus in a fresh driver.
     """
-    try:
-        backends = request.environ['beaker.session']['backends']
-    except KeyError:
-        backends = request.registry.settings['backends']
+    return sha256('%s:%s:%s:%s:%s' % (backend['provider'],
+                                      backend.get('region', ''),
+                                      backend.get('apikey', ''),
+                                      backend.get('apisecret', ''),
+                                      backend.get('auth_url', ''))).hexdigest()
 
-    if not backend_id:
-        backend_id = request.matchdict['backend']
-    backend = backends.get(backend_id)
 
+def new_driver(backend):
+    """Instantiates a libcloud driver for the backend dict provided."""
     driver = get_driver(backend['provider'])
 
     if backend['provider'] == Provider.OPENSTACK:
@@ -234,6 +561,265 @@ def connect(request, backend_id=False):
     return conn
 
 
+def connect(request, backend_id=False):
+    """Establishes backend connection using the credentials specified.
+
+    It has been tested with:
+
+        * EC2, and the alternative providers like EC2_EU,
+        * Rackspace, old style and the new Nova powered one,
+        * Openstack Diablo through Trystack, should also try Essex,
+        * Linode
+
+    Drivers are pooled process wide by backend_hash(), see checkout_driver,
+    so repeated calls reuse a driver and with it any auth token (e.g.
+    Keystone for Openstack and Rackspace Nova) until libcloud finds it
+    expired. The driver belongs to the request until it is finished, don't
+    hand it to other threads, e.g. jobs, which use get_connection instead.
+    """
+    if not backend_id:
+        backend_id = request.matchdict['backend']
+    backend = get_backend(request, backend_id)
+
+    conn = checkout_driver(backend_id, backend)
+    if hasattr(request, 'add_finished_callback'):
+        request.add_finished_callback(
+            lambda request: checkin_driver(conn))
+    return conn
+
+
+def get_backend(request, backend_id=False):
+    """Returns a backend dict from the session or the settings, or None."""
+    try:
+        backends = request.environ['beaker.session']['backends']
+    except KeyError:
+        backends = request.registry.settings['backends']
+
+    if not backend_id:
+        backend_id = request.matchdict['backend']
+    return backends.get(backend_id, None)
+
+
+@contextmanager
+def get_connection(backend_id, backend):
+    """Lends a driver for a backend to the with block, see checkout_driver.
+
+    Unlike connect() it doesn't need a request, so it can be used by
+    background threads as well::
+
+        with get_connection(backend_id, backend) as conn:
+            machines = get_machines(conn)
+    """
+    conn = checkout_driver(backend_id, backend)
+    try:
+        yield conn
+    finally:
+        checkin_driver(conn)
+
+
+def checkout_driver(backend_id, backend):
+    """Takes an idle driver for a backend from its pool, or creates one.
+
+    libcloud drivers aren't thread safe, their connection is replaced by
+    every request, so a driver is used by one thread at a time and given
+    back with checkin_driver() once done. Up to DRIVER_POOL_SIZE idle
+    drivers are kept per backend_hash(), and they are dropped once unused
+    for DRIVER_IDLE_TIMEOUT seconds. A changed credential drops the pools of
+    the stale hashes of the same backend id.
+    """
+    key = backend_hash(backend)
+    now = time()
+    with _drivers_lock:
+        for cached_key in _drivers.keys():
+            pool = _drivers[cached_key]
+            pool['idle'] = [(conn, last_used) for conn, last_used
+                            in pool['idle']
+                            if now - last_used <= DRIVER_IDLE_TIMEOUT]
+        pool = _drivers.get(key, None)
+        if pool and pool['idle']:
+            conn = pool['idle'].pop()[0]
+            _checked_out[id(conn)] = pool
+            return conn
+
+    conn = new_driver(backend)
+
+    changed = False
+    with _drivers_lock:
+        # credentials changed, the old drivers are useless
+        for cached_key in _drivers.keys():
+            if cached_key != key and \
+                    _drivers[cached_key]['backend_id'] == backend_id:
+                del _drivers[cached_key]
+                changed = True
+        pool = _drivers.setdefault(key, {'key': key,
+                                         'backend_id': backend_id,
+                                         'idle': []})
+        _checked_out[id(conn)] = pool
+    if changed:
+        # and what was provisioned may belong to another account or region
+        forget_provisioned(backend_id)
+    return conn
+
+
+def checkin_driver(conn):
+    """Gives back a driver taken with checkout_driver().
+
+    It's dropped if its backend was evicted or changed meanwhile, or if the
+    pool has enough idle drivers.
+    """
+    with _drivers_lock:
+        pool = _checked_out.pop(id(conn), None)
+        if pool and pool is _drivers.get(pool['key'], None) and \
+                len(pool['idle']) < DRIVER_POOL_SIZE:
+            pool['idle'].append((conn, time()))
+
+
+def evict_driver(backend_id):
+    """Drops the pooled drivers of a backend.
+
+    Call this when a backend is removed, or when its driver raised an error
+    that could be due to a revoked token, so that the next connect() starts
+    over. Drivers checked out meanwhile are dropped when given back.
+    """
+    with _drivers_lock:
+        for cached_key in _drivers.keys():
+            if _drivers[cached_key]['backend_id'] == backend_id:
+                del _drivers[cached_key]
+    forget_provisioned(backend_id)
+
+
+def expire_inventory(request, backend_id=None):
+    """Tells the inventory poller that a backend's machines have changed."""
+    poller = getattr(request.registry, 'poller', None)
+    if poller:
+        poller.expire(backend_id or request.matchdict['backend'])
+
+
+def find_node(request, conn, machine_id, cached=True):
+    """Returns the libcloud Node of a machine, None if there is no such one.
+
+    If cached is set, the machine is taken from the inventory poller's latest
+    snapshot, which costs no call to the provider but may be up to a poll
+    interval old. Otherwise, or if it is not there, get_node() asks the
+    provider.
+    """
+    poller = getattr(request.registry, 'poller', None)
+    if cached and poller and not 'beaker.session' in request.environ:
+        machine = poller.find_machine(request.matchdict['backend'], machine_id)
+        if machine:
+            extra = dict(machine['extra'])
+            for key in ('tags', 'metadata'):
+                if isinstance(extra.get(key, None), dict):
+                    # don't let callers change the snapshot
+                    extra[key] = dict(extra[key])
+            return Node(machine_id,
+                        name=machine['name'],
+                        state=0,
+                        public_ips=machine['public_ips'],
+                        private_ips=machine['private_ips'],
+                        driver=conn,
+                        extra=extra)
+    return get_node(conn, machine_id)
+
+
+def get_node(conn, machine_id):
+    """Asks the provider for a single machine, returns its Node or None.
+
+    Openstack and Rackspace get the node's details, EC2 lists just that
+    instance. Other providers, or a failed single node call, fall back to
+    listing all the nodes.
+    """
+    try:
+        if hasattr(conn, 'ex_get_node_details'):
+            node = conn.ex_get_node_details(machine_id)
+            if node:
+                return node
+        elif conn.type in EC2_PROVIDERS:
+            nodes = conn.list_nodes(ex_node_ids=[machine_id])
+            if nodes:
+                return nodes[0]
+    except Exception as exc:
+        log.warn('Failed to get machine %s alone, listing all: %s'
+                 % (machine_id, exc))
+
+    for node in conn.list_nodes():
+        if node.id == machine_id:
+            return node
+    return None
+
+
+def get_machines(conn):
+    """Lists the machines of a backend and returns them ready for json.
+
+    Because each provider stores metadata in different places several checks
+    are needed.
+
+    The folowing are considered:::
+
+        * For tags, Rackspace stores them in extra.metadata.tags while EC2 in
+          extra.tags.tags.
+        * For images, both EC2 and Rackpace have an image and an etra.imageId
+          attribute
+        * For flavors, EC2 has an extra.instancetype attribute while Rackspace
+          an extra.flavorId. however we also expect to get size attribute.
+    """
+    machines = conn.list_nodes()
+
+    ret = []
+    for m in machines:
+        tags = m.extra.get('tags', None) or m.extra.get('metadata', None)
+        tags = tags or {}
+        tags = [value for key, value in tags.iteritems() if key != 'Name']
+
+        if m.extra.get('availability', None):
+            # for EC2
+            tags.append(m.extra['availability'])
+        elif m.extra.get('DATACENTERID', None):
+            # for Linode
+            tags.append(LINODE_DATACENTERS[m.extra['DATACENTERID']])
+
+        image_id = m.image or m.extra.get('imageId', None)
+
+        size = m.size or m.extra.get('flavorId', None)
+        size = size or m.extra.get('instancetype', None)
+
+        machine = {'id'            : m.id,
+                   'uuid'          : m.get_uuid(),
+                   'name'          : m.name,
+                   'imageId'       : image_id,
+                   'size'          : size,
+                   'state'         : STATES[m.state],
+                   'private_ips'   : m.private_ips,
+                   'public_ips'    : m.public_ips,
+                   'tags'          : tags,
+                   'extra'         : m.extra,
+                  }
+        machine.update(get_machine_actions(m, conn))
+        ret.append(machine)
+    return ret
+
+
+def get_images(conn):
+    """Lists the images of a backend and returns them ready for json.
+
+    For EC2 only the images in config.EC2_IMAGES are listed, named after it.
+    """
+    if conn.type in EC2_PROVIDERS:
+        images = conn.list_images(None, EC2_IMAGES[conn.type].keys())
+        for image in images:
+            image.name = EC2_IMAGES[conn.type][image.id]
+    else:
+        images = conn.list_images()
+
+    ret = []
+    for image in images:
+        ret.append({'id'    : image.id,
+                    'extra' : image.extra,
+                    'name'  : image.name,
+                    })
+    return ret
+
+
 def get_machine_actions(machine, backend):
     """Returns available machine actions based on backend type.
 
@@ -339,30 +925,182 @@ def create_security_group(conn, info):
         return False
 
 
+def ensure_key(backend_id, conn, public_key, name):
+    """Imports a public ssh key unless it is known to be there already.
+
+    Keys imported, or found already imported, are remembered per backend and
+    region, so further machines created with the same key skip the API call.
+    The record is trusted until forget_provisioned() drops it, e.g. after a
+    creation failed.
+    """
+    item = ('key', name, sha256(public_key).hexdigest())
+    return provision(backend_id, conn, item,
+                     lambda: import_key(conn, public_key, name))
+
+
+def ensure_security_group(backend_id, conn, info):
+    """Creates a security group unless it is known to be there already.
+
+    Remembered like the keys of ensure_key().
+    """
+    item = ('security_group', info.get('name', None))
+    return provision(backend_id, conn, item,
+                     lambda: create_security_group(conn, info))
+
+
+def provision(backend_id, conn, item, create):
+    """Calls create unless item is known to be provisioned, remembers it.
+
+    Only one thread provisions a backend's region at a time, so machines
+    created at once, e.g. by a bulk creation, wait for the first one to
+    import the key instead of all importing it.
+    """
+    if is_provisioned(backend_id, conn, item):
+        return True
+    with _provisioned_lock:
+        lock = _provisioning_locks.setdefault((backend_id, conn.type),
+                                              threading.Lock())
+    with lock:
+        if is_provisioned(backend_id, conn, item):
+            return True
+        if create():
+            mark_provisioned(backend_id, conn, item)
+            return True
+    return False
+
+
+def is_provisioned(backend_id, conn, item):
+    with _provisioned_lock:
+        return item in _provisioned.get((backend_id, conn.type), ())
+
+
+def mark_provisioned(backend_id, conn, item):
+    with _provisioned_lock:
+        _provisioned.setdefault((backend_id, conn.type), set()).add(item)
+
+
+def forget_provisioned(backend_id, conn=None):
+    """Drops what is known to be provisioned on a backend.
+
+    If conn is given only its region is dropped, otherwise all of them.
+    """
+    with _provisioned_lock:
+        for key in _provisioned.keys():
+            if key[0] == backend_id and (conn is None or key[1] == conn.type):
+                del _provisioned[key]
+
+
+def machine_action(conn, machine_id, action):
+    """Starts, stops, reboots or destroys a machine.
+
+    Raises AttributeError if the backend doesn't support the action, check
+    get_machine_actions.
+    """
+    machine = Node(machine_id,
+                   name=machine_id,
+                   state=0,
+                   public_ips=[],
+                   private_ips=[],
+                   driver=conn)
+    if action == 'start':
+        # In libcloud it is not possible to call this with machine.start()
+        conn.ex_start_node(machine)
+    elif action == 'stop':
+        conn.ex_stop_node(machine)
+    elif action == 'reboot':
+        machine.reboot()
+    elif action == 'destroy':
+        machine.destroy()
+    else:
+        raise AttributeError('No such action %s' % action)
+
+
+def machine_actions(conn, machine_ids, action):
+    """Runs an action on many machines of a backend, one after the other.
+
+    Returns a dict of machine id to None if the action succeeded, or to the
+    exception it failed with.
+    """
+    ret = {}
+    for machine_id in machine_ids:
+        try:
+            machine_action(conn, machine_id, action)
+            ret[machine_id] = None
+        except Exception as exc:
+            ret[machine_id] = exc
+    return ret
+
+
+def ec2_machine_actions(conn, machine_ids, action):
+    """Runs an action on many EC2 machines with a single API call.
+
+    StartInstances and the rest accept a list of instances, but fail as a
+    whole if any of them can't take the action. In that case every machine
+    is tried on its own, so that each gets its own outcome. Returns like
+    machine_actions.
+    """
+    params = {'Action': EC2_BATCH_ACTIONS[action]}
+    for i, machine_id in enumerate(machine_ids):
+        params['InstanceId.%d' % (i + 1)] = machine_id
+    try:
+        conn.connection.request(conn.path, params=params)
+    except Exception as exc:
+        if len(machine_ids) == 1:
+            return {machine_ids[0]: exc}
+        log.warn('EC2 %s of %d machines failed, trying one by one: %s'
+                 % (action, len(machine_ids), exc))
+        return machine_actions(conn, machine_ids, action)
+    return dict((machine_id, None) for machine_id in machine_ids)
+
+
+def backend_machine_actions(backend_id, backend, machine_ids, action):
+    """Runs an action on many machines of a backend, one call at a time.
+
+    EC2 machines take a single call, see ec2_machine_actions. Returns the
+    backend, machine and status of each machine, ready for json. Status is
+    ok, error along with the error, or unsupported if the backend can't do
+    the action.
+    """
+    with get_connection(backend_id, backend) as conn:
+        if conn.type in EC2_PROVIDERS:
+            results = ec2_machine_actions(conn, machine_ids, action)
+        else:
+            results = machine_actions(conn, machine_ids, action)
+
+    ret = []
+    for machine_id in machine_ids:
+        outcome = {'backend': backend_id, 'machine': machine_id}
+        error = results.get(machine_id, None)
+        if not error:
+            outcome['status'] = 'ok'
+        elif isinstance(error, AttributeError):
+            outcome['status'] = 'unsupported'
+        else:
+            outcome['status'] = 'error'
+            outcome['error'] = str(error)
+        ret.append(outcome)
+    return ret
+
+
 def run_command(conn, machine_id, host, ssh_user, private_key, command):
-    """Runs a command over Fabric.
+    """Runs a command over SSH.
 
-    Fabric does not support passing the private key as a string, but only as a
-    file. To solve this, a temporary file with the private key is created and
-    its path is returned.
+    Commands run on the process wide ssh.SSHExecutor, which is safe to use
+    from many request threads and refuses commands beyond its queue with a
+    503. Connections come from ssh.ssh_pool, so consecutive commands to the
+    same machine, user and key reuse an already authenticated transport
+    instead of connecting again. If the pooled connection died, the pool
+    reconnects and retries once.
 
     In ec2 we always favor the provided dns_name and set the user name to the
     default ec2-user. IP or dns_name come from the js machine model.
 
-    A few useful parameters for fabric configuration that are not currently
-    used::
-
-        * env.connection_attempts, defaults to 1
-        * env.timeout - e.g. 20 in secs defaults to 10
-        * env.always_use_pty = False to avoid running commands like htop.
-          However this might cause problems. Check fabric's docs.
-
     .. warning::
 
         EC2 machines have default usernames other than root. However when
         attempting to connect with root@... it doesn't return an error but a
         message (e.g. Please login as the ec2-user rather than the user
-        root). This misleads fabric to believe that everything went fine. To
+        root). This misleads us to believe that everything went fine. To
         deal with this we check if the returned output contains a fragment
         of this message.
     """
@@ -378,63 +1116,207 @@ def run_command(conn, machine_id, host, ssh_user, private_key, command):
         log.warn('No private key provided, returning empty')
         return Response('Key not set', 400)
 
-    (tmp_key, tmp_path) = tempfile.mkstemp()
-    key_fd = os.fdopen(tmp_key, 'w+b')
-    key_fd.write(private_key)
-    key_fd.close()
-
-    env.key_filename = [tmp_path]
-    if ssh_user:
-        env.user = ssh_user
-    else:
-        env.user = 'root'
-    env.abort_on_prompts = True
-    env.no_keys = True
-    env.no_agent = True
-    env.host_string = host
-    env.warn_only = True
-    env.combine_stderr = True
-    env.keepalive = 15
+    if not ssh_user:
+        ssh_user = 'root'
 
+    executor = get_executor()
     try:
-        cmd_output = run(command, timeout=COMMAND_TIMEOUT)
-        if 'Please login as the' in cmd_output:
-            # for EC2 Amazon Linux machines, usually with ec2-user
-            username = cmd_output.split()[4].strip('"')
-            if 'Please login as the user ' in cmd_output:
-                username = cmd_output.split()[5].strip('"')
-            machine = Node(machine_id,
-                           name=machine_id,
-                           state=0,
-                           public_ips=[],
-                           private_ips=[],
-                           driver=conn)
-            conn.ex_create_tags(machine, {'ssh_user': username})
-            env.user = username
-            cmd_output = run(command, timeout=COMMAND_TIMEOUT)
+        cmd_output = executor.run(host, ssh_user, private_key, command,
+                                  COMMAND_TIMEOUT)
+        username = get_login_user(cmd_output)
+        if username:
+            set_ssh_user(conn, machine_id, username)
+            cmd_output = executor.run(host, username, private_key, command,
+                                      COMMAND_TIMEOUT)
+    except ExecutorBusy as e:
+        log.warn('Refused command: %s' % e)
+        return Response('Too many commands, try again later', 503)
     except Exception as e:
-        if 'SSH session not active' in e:
-            from fabric.state import connections
-            conn_keys = [k for k in connections.keys() if host in k]
-            for key in conn_keys:
-                del connections[key]
+        log.error('Exception while executing command: %s' % e)
+        return Response('Exception while executing command: %s' % e, 503)
+
+    return cmd_output
+
+
+def get_login_user(cmd_output):
+    """Returns the user an EC2 machine asks to login as, None if it doesn't.
+
+    Check the warning in run_command.
+    """
+    if not 'Please login as the' in cmd_output:
+        return None
+    # for EC2 Amazon Linux machines, usually with ec2-user
+    if 'Please login as the user ' in cmd_output:
+        return cmd_output.split()[5].strip('"')
+    return cmd_output.split()[4].strip('"')
+
+
+def set_ssh_user(conn, machine_id, username):
+    """Tags an EC2 machine with the user to login as."""
+    machine = Node(machine_id,
+                   name=machine_id,
+                   state=0,
+                   public_ips=[],
+                   private_ips=[],
+                   driver=conn)
+    conn.ex_create_tags(machine, {'ssh_user': username})
+
+
+def run_commands(targets, command, concurrency):
+    """Runs a command on many machines, yields the results as they come.
+
+    Each target is a dict with the backend id and the backend_settings it
+    connects with, along with machine_id, host, ssh_user and private_key as
+    in run_command. A driver is checked out only when a user has to be set,
+    since the results may be read after the request is over. At most
+    concurrency commands are sent to the ssh.SSHExecutor at once, the rest
+    wait in here and not in its queue. Yields every target along with the
+    output of its command, or a Response with the error just like
+    run_command returns.
+    """
+    executor = get_executor()
+    finished = Queue()
+    pending = list(reversed(targets))
+    running = 0
+
+    def submit(target):
+        job = executor.submit(target['host'], target['ssh_user'],
+                              target['private_key'], command,
+                              COMMAND_TIMEOUT)
+        job.target = target
+        job.notify(finished)
+
+    while pending or running:
+        while pending and running < concurrency:
+            target = pending.pop()
+            if not target.get('host', None):
+                yield target, Response('Host not set', 400)
+            elif not target.get('private_key', None):
+                yield target, Response('Key not set', 400)
+            else:
+                target['ssh_user'] = target.get('ssh_user', None) or 'root'
+                try:
+                    submit(target)
+                except ExecutorBusy as e:
+                    log.warn('Refused command: %s' % e)
+                    yield target, Response('Too many commands, try again '
+                                           'later', 503)
+                else:
+                    running += 1
+
+        if not running:
+            continue
+        job = finished.get()
+        running -= 1
+        target = job.target
+        if job.error:
+            log.error('Exception while executing command: %s' % job.error)
+            yield target, Response('Exception while executing command: %s'
+                                   % job.error, 503)
+            continue
+
+        username = get_login_user(job.result)
+        if username and username != target['ssh_user']:
             try:
-                cmd_output = run(command, timeout=COMMAND_TIMEOUT)
-                log.warn("Recovered!")
+                with get_connection(target['backend'],
+                                    target['backend_settings']) as conn:
+                    set_ssh_user(conn, target['machine_id'], username)
+                target['ssh_user'] = username
+                submit(target)
             except Exception as e:
-                log.error("Failed to recover :(")
                 log.error('Exception while executing command: %s' % e)
-                os.remove(tmp_path)
-                return Response('Exception while executing command: %s' % e, 503)
-        else:
-            log.error('Exception while executing command: %s' % e)
-            os.remove(tmp_path)
-            return Response('Exception while executing command: %s' % e, 503)
-    except SystemExit as e:
-        log.warn('Got SystemExit: %s' % e)
-        os.remove(tmp_path)
-        return Response('SystemExit: %s' % e, 204)
+                yield target, Response('Exception while executing command: '
+                                       '%s' % e, 503)
+            else:
+                running += 1
+            continue
 
-    os.remove(tmp_path)
+        yield target, job.result
 
-    return cmd_output
+
+def get_machine_host(machine):
+    """Returns the host to ssh to for a machine from get_machines().
+
+    Like the js machine model, favors the dns_name of EC2 machines, else the
+    first public IPv4.
+    """
+    if machine['extra'].get('dns_name', None):
+        return machine['extra']['dns_name']
+    for ip in machine['public_ips'] or []:
+        if not ':' in ip:
+            return ip
+    return None
+
+
+def get_machine_user(machine):
+    """Returns the ssh user of a machine from get_machines()."""
+    tags = machine['extra'].get('tags', None) or {}
+    return tags.get('ssh_user', None) or 'root'
+
+
+def stream_commands(targets, command, concurrency, timeout):
+    """Runs a command on many machines, yields their output as it comes.
+
+    Each target is a dict with host, ssh_user and private_key. At most
+    concurrency commands are sent to the ssh.SSHExecutor at once, and each
+    may run for timeout seconds. Yields ('output', target, line) for every
+    line of output, so that lines of different machines are interleaved but
+    never mixed, and ('exit', target, status) once a command ends, where
+    status is the exit status or the error that stopped it.
+    """
+    executor = get_executor()
+    events = Queue()
+    pending = list(reversed(targets))
+    # partial lines of the commands still running, by target index
+    buffers = {}
+    running = {}
+
+    def writer(index):
+        return lambda data: events.put((index, data))
+
+    while pending or running:
+        while pending and len(running) < concurrency:
+            target = pending.pop()
+            if not target.get('host', None):
+                yield 'exit', target, 'Host not set'
+                continue
+            if not target.get('private_key', None):
+                yield 'exit', target, 'Key not set'
+                continue
+
+            index = len(targets) - len(pending) - 1
+            try:
+                job = executor.submit_stream(
+                    target['host'], target.get('ssh_user', None) or 'root',
+                    target['private_key'], command, timeout, writer(index))
+            except ExecutorBusy as e:
+                log.warn('Refused command: %s' % e)
+                yield 'exit', target, 'Too many commands, try again later'
+                continue
+            job.index = index
+            buffers[index] = ''
+            running[index] = target
+            job.notify(events)
+
+        if not running:
+            continue
+
+        event = events.get()
+        if isinstance(event, tuple):
+            index, data = event
+            lines = (buffers[index] + data.replace('\r\n', '\n')).split('\n')
+            buffers[index] = lines.pop()
+            for line in lines:
+                yield 'output', running[index], line
+            continue
+
+        # jobs are put in the queue after all their output
+        target = running.pop(event.index)
+        rest = buffers.pop(event.index)
+        if rest:
+            yield 'output', target, rest
+        if event.error:
+            yield 'exit', target, str(event.error) or \
+                event.error.__class__.__name__
+        else:
+            yield 'exit', target, event.result
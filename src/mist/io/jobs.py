@@ -0,0 +1,237 @@
+"""Slow machine actions, run in the background and tracked as jobs"""
+import os
+import logging
+import threading
+
+from time import time
+from Queue import Full
+from collections import deque
+
+from mist.io.config import MACHINE_JOB_WORKERS, MACHINE_JOB_QUEUE_SIZE
+from mist.io.config import MACHINE_JOB_TTL, MACHINE_CREATE_CONCURRENCY
+from mist.io.config import MACHINE_CREATE_CONCURRENCY_PROVIDERS
+from mist.io.workers import WorkerPool
+
+
+log = logging.getLogger('mist.io')
+
+
+class JobsBusy(Exception):
+    """Raised when MachineJobs can't take any more jobs."""
+
+
+class MachineJob(object):
+    """A machine action running in the background, and how far it got.
+
+    The function doing the work reports each stage it reaches with
+    progress(). Status is one of queued, running, done and failed.
+    """
+
+    def __init__(self, backend_id, action, machine_id=None, name=None,
+                 provider=None):
+        self.id = os.urandom(16).encode('hex')
+        self.backend_id = backend_id
+        self.provider = provider
+        self.action = action
+        self.machine_id = machine_id
+        self.name = name
+        self.status = 'queued'
+        self.stage = 'queued'
+        self.stages = [('queued', time())]
+        self.result = None
+        self.error = None
+        self.finished = None
+
+    def progress(self, stage):
+        """Records that the job reached stage."""
+        self.stage = stage
+        self.stages.append((stage, time()))
+
+    def to_dict(self):
+        """Returns the job ready for json."""
+        return {'id': self.id,
+                'backend': self.backend_id,
+                'action': self.action,
+                'machine': self.machine_id,
+                'name': self.name,
+                'status': self.status,
+                'stage': self.stage,
+                'stages': [{'stage': stage, 'time': timestamp}
+                           for stage, timestamp in self.stages],
+                'result': self.result,
+                'error': self.error,
+                }
+
+    def get_placeholder(self):
+        """Returns the machine a create job is making, ready for json.
+
+        It has the job id for id and can't do anything until it exists.
+        """
+        return {'id': self.id,
+                'uuid': self.id,
+                'name': self.name,
+                'imageId': None,
+                'size': None,
+                'state': 'pending',
+                'private_ips': [],
+                'public_ips': [],
+                'tags': [],
+                'extra': {},
+                'job': self.id,
+                'can_stop': False,
+                'can_start': False,
+                'can_destroy': False,
+                'can_reboot': False,
+                'can_tag': False,
+                }
+
+
+class MachineJobs(object):
+    """Runs machine jobs on a bounded WorkerPool and keeps track of them.
+
+    Views submit creations and other actions that take minutes, answer
+    right away with the job and clients follow it with GET /jobs/{id}.
+    Finished jobs are kept for ttl seconds.
+
+    Create jobs given a provider run at most MACHINE_CREATE_CONCURRENCY at
+    a time on it, or as many as MACHINE_CREATE_CONCURRENCY_PROVIDERS says,
+    since providers throttle accounts launching many machines at once. The
+    rest wait in a queue per provider, not on a worker, so that jobs of
+    other providers and other actions keep running. Whenever a create job
+    ends, its worker goes on with the next one waiting for the provider.
+    At most queue_size jobs wait, in the workers' queue or for a provider.
+
+    Machines being created are listed along the backend's own machines.
+    The InventoryPoller is given them with set_pending() whenever a create
+    job starts or fails. When one succeeds the backend is expired instead,
+    so the placeholder goes away as the new machine shows up.
+    """
+
+    def __init__(self, poller=None, workers=MACHINE_JOB_WORKERS,
+                 queue_size=MACHINE_JOB_QUEUE_SIZE, ttl=MACHINE_JOB_TTL):
+        self.poller = poller
+        self.ttl = ttl
+        self.queue_size = queue_size
+        self.jobs = {}
+        self.lock = threading.Lock()
+        # create jobs running on each provider, and those waiting for them
+        self.running = {}
+        self.waiting = {}
+        self.workers = WorkerPool(workers, queue_size, name='machine-job')
+
+    def submit(self, backend_id, action, func, machine_id=None, name=None,
+               provider=None):
+        """Queues func to be called with the job, returns its MachineJob.
+
+        Whatever func returns is the job's result, if it raises the job
+        fails with the message of the exception. Raises JobsBusy if too many
+        jobs are waiting already.
+        """
+        self.reap(time())
+        job = MachineJob(backend_id, action, machine_id, name, provider)
+        with self.lock:
+            if self.take_slot(job, func):
+                # doesn't block, so the slot is given back at once if full
+                try:
+                    self.workers.submit(self.run, job, func)
+                except Full:
+                    if self.is_limited(job):
+                        self.running[job.provider] -= 1
+                    raise JobsBusy('Too many machine jobs queued')
+            self.jobs[job.id] = job
+
+        if action == 'create':
+            self.show_pending(backend_id)
+        return job
+
+    def run(self, job, func):
+        while job:
+            self.execute(job, func)
+            job, func = self.release_slot(job)
+
+    def execute(self, job, func):
+        job.status = 'running'
+        try:
+            job.result = func(job)
+        except Exception as exc:
+            log.error('Machine job %s %s on backend %s failed: %s'
+                      % (job.id, job.action, job.backend_id, exc))
+            job.error = str(exc)
+            job.status = 'failed'
+            job.progress('failed')
+        else:
+            job.status = 'done'
+            job.progress('done')
+        job.finished = time()
+
+        if job.action == 'create' and job.status == 'failed':
+            self.show_pending(job.backend_id)
+        elif self.poller:
+            # the new machine and the placeholder's removal come together
+            self.poller.set_pending(job.backend_id,
+                                    self.get_pending(job.backend_id),
+                                    merge=False)
+            self.poller.expire(job.backend_id)
+
+    def is_limited(self, job):
+        """Tells if the job needs a slot on its provider to run."""
+        return job.action == 'create' and job.provider is not None
+
+    def take_slot(self, job, func):
+        """Takes a slot on the job's provider or queues it for one.
+
+        Returns True if the job may run now, False if it waits. Raises
+        JobsBusy if too many jobs wait already. Call with the lock held.
+        """
+        if not self.is_limited(job):
+            return True
+        limit = MACHINE_CREATE_CONCURRENCY_PROVIDERS.get(
+                    job.provider, MACHINE_CREATE_CONCURRENCY)
+        if self.running.get(job.provider, 0) < limit:
+            self.running[job.provider] = self.running.get(job.provider, 0) + 1
+            return True
+        if sum(map(len, self.waiting.values())) >= self.queue_size:
+            raise JobsBusy('Too many machine jobs queued')
+        self.waiting.setdefault(job.provider, deque()).append((job, func))
+        return False
+
+    def release_slot(self, job):
+        """Gives up the slot of a job that ended.
+
+        Returns the next job waiting for the provider and its func, which
+        take over the slot, or (None, None).
+        """
+        if not self.is_limited(job):
+            return None, None
+        with self.lock:
+            waiting = self.waiting.get(job.provider, None)
+            if waiting:
+                return waiting.popleft()
+            self.running[job.provider] -= 1
+        return None, None
+
+    def get(self, job_id):
+        """Returns a job, None if there is no such job."""
+        with self.lock:
+            return self.jobs.get(job_id, None)
+
+    def get_pending(self, backend_id):
+        """Returns the machines still being created in a backend."""
+        with self.lock:
+            jobs = [job for job in self.jobs.values()
+                    if job.backend_id == backend_id and
+                    job.action == 'create' and not job.finished]
+        return [job.get_placeholder() for job in jobs]
+
+    def show_pending(self, backend_id):
+        """Hands the machines being created in a backend to the poller."""
+        if self.poller:
+            self.poller.set_pending(backend_id, self.get_pending(backend_id))
+
+    def reap(self, now):
+        """Forgets the jobs finished more than ttl seconds ago."""
+        with self.lock:
+            for job_id in self.jobs.keys():
+                finished = self.jobs[job_id].finished
+                if finished and now - finished > self.ttl:
+                    del self.jobs[job_id]
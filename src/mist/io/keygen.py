@@ -0,0 +1,83 @@
+"""Key generation, with a pool of keypairs generated ahead of time"""
+import os
+import logging
+import threading
+
+from Queue import Queue, Empty, Full
+from StringIO import StringIO
+
+import paramiko
+
+from Crypto.PublicKey import RSA
+
+
+log = logging.getLogger('mist.io')
+
+
+def generate_keypair(key_type='rsa', bits=2048):
+    """Generates a keypair, returns a dict with public and private key.
+
+    The public key is in OpenSSH format, the private one in PEM. DSA keys
+    are always 1024 bits, the only size OpenSSH accepts, whatever bits says.
+    """
+    if key_type == 'dsa':
+        key = paramiko.DSSKey.generate(1024)
+        private = StringIO()
+        key.write_private_key(private)
+        return {'public': 'ssh-dss %s' % key.get_base64(),
+                'private': private.getvalue()}
+
+    key = RSA.generate(bits, os.urandom)
+    return {'public': key.exportKey('OpenSSH'),
+            'private': key.exportKey()}
+
+
+class KeypairPool(object):
+    """Keeps up to size keypairs generated ahead of time.
+
+    Generating a 2048 bit RSA key takes a good part of a second, so a thread
+    does it in the background and get() hands out a ready one. If the pool
+    runs dry, e.g. right after startup, get() generates one inline. Every
+    keypair is handed out once.
+    """
+
+    def __init__(self, size, key_type='rsa', bits=2048):
+        self.size = size
+        self.key_type = key_type
+        self.bits = bits
+        self.keypairs = Queue(size)
+        self.wakeup = threading.Event()
+        self.thread = None
+
+    def start(self):
+        """Starts the thread that refills the pool."""
+        if self.thread or not self.size:
+            return self
+        self.thread = threading.Thread(target=self.run, name='keypairs')
+        self.thread.daemon = True
+        self.thread.start()
+        return self
+
+    def get(self):
+        """Returns a fresh keypair, from the pool if there is one."""
+        try:
+            keypair = self.keypairs.get(False)
+        except Empty:
+            log.info('Keypair pool empty, generating inline')
+            keypair = generate_keypair(self.key_type, self.bits)
+        self.wakeup.set()
+        return keypair
+
+    def run(self):
+        while True:
+            while not self.keypairs.full():
+                try:
+                    keypair = generate_keypair(self.key_type, self.bits)
+                    self.keypairs.put(keypair, False)
+                except Full:
+                    break
+                except Exception as exc:
+                    log.error('Error generating keypair: %s' % exc)
+                    break
+            self.wakeup.wait(60)
+            self.wakeup.clear()
@@ -0,0 +1,353 @@
+"""Background inventory poller, shared by all clients"""
+import logging
+import threading
+
+from time import time
+
+from mist.io.config import INVENTORY_MAX_REMOVED, EVENTS_MAX_SUBSCRIBERS
+from mist.io.helpers import get_connection, get_machines, evict_driver
+
+
+log = logging.getLogger('mist.io')
+
+
+class InventoryPoller(object):
+    """Polls the machines of the backends found in settings['backends'].
+
+    Every enabled backend is refreshed at most once per its poll_interval, no
+    matter how many clients are watching it, and only as long as someone has
+    asked for it during the last poller_idle_timeout seconds. Views read the
+    latest snapshot with get_machines() instead of calling the provider.
+
+    Each inventory carries a version, bumped whenever a refresh finds added,
+    changed or removed machines, so that clients can ask for just the
+    changes since the version they already have with get_changes(), or wait
+    for the next ones with wait_for_changes().
+
+    Machines still being created, handed over with set_pending(), are
+    listed along those of the provider.
+    """
+
+    def __init__(self, settings):
+        self.settings = settings
+        self.idle_timeout = settings['poller_idle_timeout']
+        self.inventories = {}
+        self.lock = threading.Lock()
+        # notified whenever an inventory's version moves
+        self.changed = threading.Condition(self.lock)
+        self.subscribers = 0
+        self.max_subscribers = settings.get('events_max_subscribers',
+                                            EVENTS_MAX_SUBSCRIBERS)
+        self.wakeup = threading.Event()
+        self.running = False
+        self.thread = None
+
+    def start(self):
+        """Starts the polling thread."""
+        if self.running:
+            return
+        self.running = True
+        self.thread = threading.Thread(target=self.run, name='poller')
+        self.thread.daemon = True
+        self.thread.start()
+
+    def stop(self):
+        """Stops the polling thread, refreshes in flight are left to finish."""
+        self.running = False
+        self.wakeup.set()
+
+    def get_inventory(self, backend_id):
+        """Returns the inventory record of a backend, creating it if needed."""
+        with self.lock:
+            inventory = self.inventories.get(backend_id, None)
+            if not inventory:
+                # start from the clock, so that versions handed out before a
+                # restart are older than anything handed out after it
+                version = int(time() * 1000)
+                inventory = {'machines': None,
+                             'index': {},
+                             'listed': None,
+                             'pending': [],
+                             'version': version,
+                             'oldest': version,
+                             'created': {},
+                             'modified': {},
+                             'removed': {},
+                             'error': None,
+                             'updated': 0,
+                             'viewed': 0,
+                             'lock': threading.Lock()}
+                self.inventories[backend_id] = inventory
+            return inventory
+
+    def get_machines(self, backend_id):
+        """Returns the latest machine list of a backend.
+
+        Marks the backend as viewed, so that it keeps being polled. If it has
+        never been polled it is refreshed right away. Raises KeyError if the
+        backend doesn't exist and the last polling error if that failed.
+        """
+        if not backend_id in self.settings['backends']:
+            raise KeyError(backend_id)
+
+        inventory = self.get_inventory(backend_id)
+        inventory['viewed'] = time()
+        if not inventory['updated']:
+            self.refresh(backend_id)
+
+        if inventory['error']:
+            raise inventory['error']
+        return inventory['machines']
+
+    def refresh(self, backend_id, blocking=True):
+        """Lists the machines of a backend and stores the snapshot.
+
+        If another thread is already refreshing the backend, a blocking call
+        waits for it and uses its result, a non blocking one returns at once.
+        """
+        inventory = self.get_inventory(backend_id)
+        started = time()
+        if not inventory['lock'].acquire(blocking):
+            return
+        try:
+            if inventory['updated'] >= started:
+                return
+            try:
+                backend = self.settings['backends'][backend_id]
+                with get_connection(backend_id, backend) as conn:
+                    machines = get_machines(conn)
+            except Exception as exc:
+                log.error('Error polling backend %s: %s' % (backend_id, exc))
+                evict_driver(backend_id)
+                inventory['error'] = exc
+            else:
+                with self.lock:
+                    inventory['listed'] = machines
+                    self.update(inventory, machines + inventory['pending'])
+                    self.changed.notify_all()
+                inventory['error'] = None
+            inventory['updated'] = time()
+        finally:
+            inventory['lock'].release()
+
+    def update(self, inventory, machines):
+        """Stores a fresh machine list, recording what changed and when.
+
+        For every machine the versions it was added and last modified in are
+        kept, as well as the version each removed machine disappeared in.
+        Only the latest INVENTORY_MAX_REMOVED removals are remembered.
+        """
+        old = dict((m['id'], m) for m in inventory['machines'] or [])
+        new = dict((m['id'], m) for m in machines)
+        version = inventory['version'] + 1
+        moved = False
+
+        for machine_id, machine in new.iteritems():
+            if old.get(machine_id, None) != machine:
+                if not machine_id in old:
+                    inventory['created'][machine_id] = version
+                    inventory['removed'].pop(machine_id, None)
+                inventory['modified'][machine_id] = version
+                moved = True
+
+        for machine_id in old:
+            if not machine_id in new:
+                inventory['created'].pop(machine_id, None)
+                inventory['modified'].pop(machine_id, None)
+                inventory['removed'][machine_id] = version
+                moved = True
+
+        removed = inventory['removed']
+        if len(removed) > INVENTORY_MAX_REMOVED:
+            expired = sorted(removed, key=removed.get)[:-INVENTORY_MAX_REMOVED]
+            inventory['oldest'] = max([removed.pop(i) for i in expired])
+
+        inventory['machines'] = machines
+        inventory['index'] = new
+        if moved:
+            inventory['version'] = version
+
+    def find_machine(self, backend_id, machine_id):
+        """Returns a machine from the latest snapshot, None if it's not there.
+
+        Unlike get_machines() it never calls the provider, nor does it mark
+        the backend as viewed. Machines being created are not returned.
+        """
+        inventory = self.inventories.get(backend_id, None)
+        if not inventory:
+            return None
+        with self.lock:
+            machine = inventory['index'].get(machine_id, None)
+        if machine and machine.get('job', None):
+            return None
+        return machine
+
+    def set_pending(self, backend_id, machines, merge=True):
+        """Sets the machines being created in a backend, see jobs.MachineJobs.
+
+        If merge is set they are listed right away, otherwise with the next
+        refresh, e.g. when the machine created will be listed by then.
+        """
+        inventory = self.get_inventory(backend_id)
+        with self.lock:
+            inventory['pending'] = machines
+            if merge and inventory['listed'] is not None:
+                self.update(inventory, inventory['listed'] + machines)
+                self.changed.notify_all()
+
+    def get_changes(self, backend_id, since):
+        """Returns what changed in a backend after version since.
+
+        Returns None if nothing changed. If since is not a version this
+        inventory can compute changes from, e.g. 0 or one from before a
+        restart, the full list is returned flagged with full. Otherwise the
+        added and changed machines are returned along with the ids of the
+        removed ones. Raises like get_machines().
+        """
+        self.get_machines(backend_id)
+        inventory = self.get_inventory(backend_id)
+
+        with self.lock:
+            version = inventory['version']
+            if since == version:
+                return None
+
+            if since < inventory['oldest'] or since > version:
+                return {'version': version,
+                        'full': True,
+                        'machines': inventory['machines']}
+
+            added = []
+            changed = []
+            for machine in inventory['machines']:
+                machine_id = machine['id']
+                if inventory['modified'].get(machine_id, 0) > since:
+                    if inventory['created'].get(machine_id, 0) > since:
+                        added.append(machine)
+                    else:
+                        changed.append(machine)
+            removed = [machine_id for machine_id, removed_in
+                       in inventory['removed'].iteritems() if removed_in > since]
+
+        return {'version': version,
+                'full': False,
+                'added': added,
+                'changed': changed,
+                'removed': removed}
+
+    def wait_for_changes(self, cursors, timeout):
+        """Blocks until any of the backends in cursors changes.
+
+        Cursors maps backend ids to the versions the caller already has.
+        Returns a dict with the changes of every backend that moved, like
+        get_changes(), or the exception raised while getting them. The dict
+        is empty if nothing moved within timeout seconds. Keeps the backends
+        marked as viewed.
+        """
+        deadline = time() + timeout
+        while True:
+            changes = {}
+            for backend_id, since in cursors.items():
+                try:
+                    backend_changes = self.get_changes(backend_id, since)
+                except Exception as exc:
+                    changes[backend_id] = exc
+                    continue
+                if backend_changes is not None:
+                    changes[backend_id] = backend_changes
+
+            remaining = deadline - time()
+            if changes or remaining <= 0:
+                return changes
+
+            with self.changed:
+                for backend_id, since in cursors.items():
+                    inventory = self.inventories.get(backend_id, None)
+                    if not inventory or inventory['version'] != since:
+                        break
+                else:
+                    self.changed.wait(remaining)
+
+    def subscribe(self):
+        """Counts a new event stream, returns False if there are too many."""
+        with self.lock:
+            if self.subscribers >= self.max_subscribers:
+                return False
+            self.subscribers += 1
+            return True
+
+    def unsubscribe(self):
+        """Counts an event stream out."""
+        with self.lock:
+            self.subscribers -= 1
+
+    def expire(self, backend_id):
+        """Marks the snapshot of a backend as old, e.g. after a machine action.
+
+        The backend gets refreshed in the next cycle if somebody watches it.
+        """
+        inventory = self.inventories.get(backend_id, None)
+        if inventory and inventory['updated']:
+            inventory['updated'] = 1
+            self.wakeup.set()
+
+    def forget(self, backend_id):
+        """Drops the inventory of a backend, e.g. when it gets deleted."""
+        with self.lock:
+            self.inventories.pop(backend_id, None)
+
+    def due(self, backend_id, now):
+        """Checks if a backend is enabled, watched, idle and its snapshot old.
+        """
+        backend = self.settings['backends'].get(backend_id, None)
+        inventory = self.inventories.get(backend_id, None)
+        if not backend or not inventory or inventory['lock'].locked():
+            return False
+        if not backend.get('enabled', True):
+            return False
+        if now - inventory['viewed'] > self.idle_timeout:
+            return False
+        interval = backend.get('poll_interval',
+                               self.settings['default_poll_interval'])
+        # poll_interval is in milliseconds, as used by the js app
+        return now - inventory['updated'] >= interval / 1000.0
+
+    def run(self):
+        """Main loop, refreshes every due backend in its own thread."""
+        while self.running:
+            now = time()
+            for backend_id in self.inventories.keys():
+                if not backend_id in self.settings['backends']:
+                    self.forget(backend_id)
+                elif self.due(backend_id, now):
+                    thread = threading.Thread(target=self.refresh,
+                                              args=(backend_id, False))
+                    thread.daemon = True
+                    thread.start()
+            self.wakeup.wait(1)
+            self.wakeup.clear()
+
+
+class Subscription(object):
+    """The app_iter of an event stream, holding a place among subscribers.
+
+    The place is taken by InventoryPoller.subscribe() before the response is
+    returned, and given back when the server closes the app_iter, which it
+    does whether the stream got iterated or not, unlike a generator's
+    finally.
+    """
+
+    def __init__(self, poller, events):
+        self.poller = poller
+        self.events = events
+        self.closed = False
+
+    def __iter__(self):
+        return self.events
+
+    def close(self):
+        if self.closed:
+            return
+        self.closed = True
+        self.events.close()
+        self.poller.unsubscribe()
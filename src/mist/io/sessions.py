@@ -0,0 +1,182 @@
+"""Interactive shell sessions kept open between commands"""
+import os
+import logging
+import threading
+
+from time import time, sleep
+
+from mist.io.config import SHELL_MAX_SESSIONS, SHELL_SESSION_IDLE_TIMEOUT
+from mist.io.config import SHELL_SESSION_WATCHED_TIMEOUT, SHELL_SESSION_BUFFER
+from mist.io.ssh import ssh_pool
+
+
+log = logging.getLogger('mist.io')
+
+
+class ShellSession(object):
+    """A shell with a pty on a machine, and the latest output it printed.
+
+    A thread reads the channel into a buffer of at most SHELL_SESSION_BUFFER
+    bytes. Output is addressed by offset from the start of the session, so
+    readers can resume where they left off. If a reader falls further behind
+    than the buffer, it gets what is left.
+    """
+
+    def __init__(self, session_id, channel, backend_id, machine_id):
+        self.id = session_id
+        self.channel = channel
+        self.backend_id = backend_id
+        self.machine_id = machine_id
+        self.output = ''
+        # offset of the first byte kept in output
+        self.start = 0
+        self.closed = False
+        # last input, and last read of the output
+        self.last_used = time()
+        self.last_read = self.last_used
+        self.changed = threading.Condition()
+        self.thread = threading.Thread(target=self.read,
+                                       name='session-%s' % session_id[:8])
+        self.thread.daemon = True
+        self.thread.start()
+
+    def read(self):
+        try:
+            while True:
+                data = self.channel.recv(4096)
+                if not data:
+                    break
+                with self.changed:
+                    self.output += data
+                    extra = len(self.output) - SHELL_SESSION_BUFFER
+                    if extra > 0:
+                        self.output = self.output[extra:]
+                        self.start += extra
+                    self.changed.notify_all()
+        except Exception as exc:
+            log.warn('Shell session %s failed: %s' % (self.id, exc))
+        finally:
+            self.close()
+
+    def write(self, data):
+        """Sends input to the shell."""
+        self.last_used = time()
+        self.channel.sendall(data)
+
+    def get_output(self, offset, timeout):
+        """Returns the output after offset, waiting up to timeout for some.
+
+        Returns the new offset and the output, which is empty if nothing came
+        in time or the session is closed.
+        """
+        self.last_read = time()
+        deadline = time() + timeout
+        with self.changed:
+            end = self.start + len(self.output)
+            while offset >= end and not self.closed:
+                remaining = deadline - time()
+                if remaining <= 0:
+                    break
+                self.changed.wait(remaining)
+                end = self.start + len(self.output)
+            offset = max(offset, self.start)
+            return end, self.output[offset - self.start:]
+
+    def close(self):
+        with self.changed:
+            if self.closed:
+                return
+            self.closed = True
+            self.changed.notify_all()
+        ssh_pool.close(self.channel)
+
+
+class ShellSessions(object):
+    """Keeps the open shell sessions of this process.
+
+    At most SHELL_MAX_SESSIONS are open at once. Sessions nobody sent input
+    to for idle_timeout seconds are closed, unless their output is still
+    read, then they are closed after watched_timeout seconds without input.
+    Reading alone never keeps a session open for good. Sessions live on pooled
+    ssh connections, so opening one on a machine recently talked to only
+    costs a channel.
+    """
+
+    def __init__(self, max_sessions=SHELL_MAX_SESSIONS,
+                 idle_timeout=SHELL_SESSION_IDLE_TIMEOUT,
+                 watched_timeout=SHELL_SESSION_WATCHED_TIMEOUT):
+        self.max_sessions = max_sessions
+        self.idle_timeout = idle_timeout
+        self.watched_timeout = max(idle_timeout, watched_timeout)
+        self.sessions = {}
+        self.lock = threading.Lock()
+        self.thread = threading.Thread(target=self.run, name='sessions')
+        self.thread.daemon = True
+        self.thread.start()
+
+    def open(self, host, user, private_key, backend_id, machine_id):
+        """Opens a shell on a machine, returns its ShellSession.
+
+        Returns None if there are too many sessions open already.
+        """
+        self.reap(time())
+        with self.lock:
+            if len(self.sessions) >= self.max_sessions:
+                return None
+            session_id = os.urandom(16).encode('hex')
+            # hold the place while connecting
+            self.sessions[session_id] = None
+
+        channel = None
+        try:
+            channel = ssh_pool.open(host, user, private_key)
+            channel.get_pty(term='dumb')
+            channel.invoke_shell()
+        except:
+            with self.lock:
+                self.sessions.pop(session_id, None)
+            if channel:
+                ssh_pool.close(channel)
+            raise
+
+        session = ShellSession(session_id, channel, backend_id, machine_id)
+        with self.lock:
+            self.sessions[session_id] = session
+        return session
+
+    def get(self, session_id):
+        """Returns an open session, None if there is no such session."""
+        with self.lock:
+            session = self.sessions.get(session_id, None)
+        if session and session.closed:
+            self.close(session_id)
+            return None
+        return session
+
+    def close(self, session_id):
+        with self.lock:
+            session = self.sessions.pop(session_id, None)
+        if session:
+            session.close()
+
+    def reap(self, now):
+        """Closes the sessions idle for too long, see ShellSessions."""
+        with self.lock:
+            idle = [session_id for session_id, session
+                    in self.sessions.items()
+                    if session and (session.closed or self.idle(session, now))]
+        for session_id in idle:
+            self.close(session_id)
+
+    def idle(self, session, now):
+        """Tells if a session went without input for too long."""
+        if now - session.last_used <= self.idle_timeout:
+            return False
+        if now - session.last_read > self.idle_timeout:
+            return True
+        return now - session.last_used > self.watched_timeout
+
+    def run(self):
+        while True:
+            sleep(min(60, self.idle_timeout))
+            self.reap(time())
@@ -1,21 +1,20 @@
-import os
-import sys
+import json
+import base64
+import codecs
 import socket
 import logging
-import subprocess
-import tempfile
+import threading
 
-#import gevent
-#import gevent.socket
-
-#from gevent import monkey
-#monkey.patch_socket()
-
-from StringIO import StringIO
+from time import time
+from Queue import Queue, Empty, Full
 
 from pyramid.request import Request
 from pyramid.response import Response
-from mist.io.helpers import connect, run_command, get_keypair
+from mist.io.config import COMMAND_TIMEOUT, SHELL_MAX_TIMEOUT
+from mist.io.config import SHELL_BUFFER_CHUNKS
+from mist.io.config import SHELL_FLUSH_SIZE, SHELL_FLUSH_INTERVAL
+from mist.io.helpers import get_backend, get_keypair
+from mist.io.ssh import get_executor, ExecutorBusy
 
 log = logging.getLogger('mistshell')
 
@@ -55,10 +54,16 @@ class ShellMiddleware(object):
                 else:
                     private_key = None
 
-                conn = connect(request, backend)
-                if conn:
-                    return self.stream_command(conn, machine, host, ssh_user, 
-                                               private_key, command, 
+                try:
+                    timeout = min(int(request.params.get('timeout',
+                                                         COMMAND_TIMEOUT)),
+                                  SHELL_MAX_TIMEOUT)
+                except ValueError:
+                    timeout = COMMAND_TIMEOUT
+
+                if get_backend(request, backend):
+                    return self.stream_command(host, ssh_user, private_key,
+                                               command, timeout, environ,
                                                start_response)
                 else:
                     raise
@@ -69,48 +74,157 @@ class ShellMiddleware(object):
             return self.app(environ, start_response)
 
         
-    def stream_command(self, conn, machine, host, ssh_user, private_key, command, start_response):
-        """ 
-            Generator function that streams the output of the remote command 
-            using the hidden iframe web pattern
+    def stream_command(self, host, ssh_user, private_key, command, timeout,
+                       environ, start_response):
+        """Starts the command on the ssh executor and streams its output.
+
+        The command runs in process over a pooled ssh connection and is
+        stopped after timeout seconds. At most SHELL_BUFFER_CHUNKS chunks of
+        output are buffered for a slow client, after that reading from the
+        machine waits for the client to catch up.
+
+        Clients that accept text/event-stream, i.e. EventSource, get the
+        output as server-sent events, check stream_events. Others get the
+        hidden iframe page of stream_output.
         """
-        #TODO: add timeout
-        outputPrefix = u'[%s] out:' % host
-        
-        # save private key in temp file
-        (tmp_key, key_path) = tempfile.mkstemp()
-        key_fd = os.fdopen(tmp_key, 'w+b')
-        key_fd.write(private_key)
-        key_fd.close()
-        
-        # start the http response
-        start_response('200 OK', [('Content-Type','text/html')])
-        # send some blank data to get webkit browsers to display what's sent
-        yield 1024*'\0'
-        
-        # start the html response
-        yield '<html><body>\n'
+        if not host or not private_key or not command:
+            return Response('Host, key or command not set', 400)(
+                environ, start_response)
+
+        chunks = Queue(SHELL_BUFFER_CHUNKS)
+        # set once the client is gone, so that the command stops too
+        cancelled = threading.Event()
+        deadline = time() + timeout
 
-        # run the command as a seperate process using fab
-        cmd = ['./bin/fab','-H', host , '-u', ssh_user, '-k', '-i', key_path, '--', command]
-        proc = subprocess.Popen(cmd, bufsize=0, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        def write(data):
+            while not cancelled.is_set() and time() < deadline:
+                try:
+                    chunks.put(data, True, 1)
+                    return
+                except Full:
+                    continue
+            raise socket.timeout('Nobody reads the output')
+
+        try:
+            job = get_executor().submit_stream(host, ssh_user, private_key,
+                                               command, timeout, write)
+        except ExecutorBusy:
+            return Response('Too many commands, try again later', 503)(
+                environ, start_response)
+
+        request = Request(environ)
+        if 'text/event-stream' in environ.get('HTTP_ACCEPT', ''):
+            binary = request.params.get('binary', '') in ('1', 'true')
+            start_response('200 OK', [('Content-Type', 'text/event-stream'),
+                                      ('Cache-Control', 'no-cache')])
+            return self.stream_events(job, chunks, cancelled, binary)
+
+        start_response('200 OK', [('Content-Type', 'text/html')])
+        return self.stream_output(job, chunks, cancelled)
+
+    def read_output(self, job, chunks):
+        """Yields the output of a command in coalesced chunks, until it ends.
+
+        Output is gathered until there are SHELL_FLUSH_SIZE bytes of it or
+        SHELL_FLUSH_INTERVAL seconds passed since the first byte, so that a
+        chatty command doesn't turn into a message per read.
+        """
+        buffered = []
+        size = 0
+        flush_at = None
         while True:
-            # get commands output, line by line
-            line = proc.stdout.readline()
-            if line == '' and proc.poll() != None:
+            if flush_at is None:
+                timeout = 1
+            else:
+                timeout = max(0, flush_at - time())
+            try:
+                data = chunks.get(True, timeout)
+            except Empty:
+                data = None
+
+            if data:
+                if flush_at is None:
+                    flush_at = time() + SHELL_FLUSH_INTERVAL
+                buffered.append(data)
+                size += len(data)
+
+            if buffered and (size >= SHELL_FLUSH_SIZE or time() >= flush_at):
+                yield ''.join(buffered)
+                buffered = []
+                size = 0
+                flush_at = None
+
+            # the job is done only after all its output was queued
+            if data is None and job.done.is_set() and chunks.empty():
                 break
-            if line != '':
-                sys.stdout.write(line)
-                sys.stdout.flush()
-                if outputPrefix.encode('utf-8','ignore') in line: # remove logging decorators
-                    line = line[len(outputPrefix):]
-                    # send the actual output
-                    yield "<script type='text/javascript'>parent.appendShell('%s');</script>\n" % line.replace('\'','\\\'').replace('\n','<br/>') #.replace('<','&lt;').replace('>', '&gt;')
-        # wait for child
-        stdout, stderr = proc.communicate()
-        
-        # remove temp key
-        os.remove(key_path)
-        
-        yield "<script type='text/javascript'>parent.completeShell(%s);</script>\n" % proc.returncode        
-        yield '</body></html>\n'   
+
+        if buffered:
+            yield ''.join(buffered)
+
+    def get_returncode(self, job):
+        if job.error:
+            log.error('Exception while executing command: %s' % job.error)
+            return 1
+        return job.result
+
+    def stream_events(self, job, chunks, cancelled, binary=False):
+        """Streams the output of a command as server-sent events.
+
+        Every chunk of output is sent as an 'output' event holding a json
+        string, or base64 if binary is set so that any bytes go through
+        untouched. An 'exit' event with the exit status and error, if any,
+        ends the stream. Clients should close the EventSource then, and also
+        on errors, as reconnecting would run the command again.
+        """
+        decoder = codecs.getincrementaldecoder('utf-8')('replace')
+        try:
+            for data in self.read_output(job, chunks):
+                if binary:
+                    payload = base64.b64encode(data)
+                else:
+                    payload = json.dumps(decoder.decode(data))
+                yield 'event: output\ndata: %s\n\n' % payload
+
+            if not binary:
+                rest = decoder.decode('', True)
+                if rest:
+                    yield 'event: output\ndata: %s\n\n' % json.dumps(rest)
+
+            returncode = self.get_returncode(job)
+            yield 'event: exit\ndata: %s\n\n' % json.dumps(
+                  {'status': returncode,
+                   'error': job.error and str(job.error) or None})
+        finally:
+            cancelled.set()
+
+    def stream_output(self, job, chunks, cancelled):
+        """
+            Generator function that streams the output of the remote command
+            using the hidden iframe web pattern
+        """
+        try:
+            # send some blank data to get webkit browsers to display what's sent
+            yield 1024*'\0'
+
+            # start the html response
+            yield '<html><body>\n'
+
+            for data in self.read_output(job, chunks):
+                yield self.append_script(data)
+
+            if job.error:
+                yield self.append_script('Exception while executing command: '
+                                         '%s\n' % job.error)
+            returncode = self.get_returncode(job)
+
+            yield "<script type='text/javascript'>parent.completeShell(%s);</script>\n" % returncode
+            yield '</body></html>\n'
+        finally:
+            cancelled.set()
+
+    def append_script(self, data):
+        """Returns the script tag that appends output to the shell."""
+        data = data.replace('\\', '\\\\').replace('\'', '\\\'')
+        data = data.replace('</', '<\\/').replace('\r\n', '\n')
+        data = data.replace('\n', '<br/>')
+        return "<script type='text/javascript'>parent.appendShell('%s');</script>\n" % data
@@ -0,0 +1,337 @@
+"""Pooled SSH connections and a bounded executor for commands"""
+import socket
+import logging
+import threading
+
+from time import time
+from hashlib import sha256
+from Queue import Full
+from StringIO import StringIO
+
+import paramiko
+
+from mist.io.config import SSH_MAX_CONNECTIONS, SSH_IDLE_TIMEOUT
+from mist.io.config import SSH_KEEPALIVE, SSH_CONNECT_TIMEOUT
+from mist.io.config import SSH_HEALTH_CHECK, SSH_WORKERS, SSH_QUEUE_SIZE
+from mist.io.workers import WorkerPool
+
+
+log = logging.getLogger('mist.io')
+
+
+def load_key(private_key):
+    """Parses a private key given as a string, RSA or DSA."""
+    try:
+        return paramiko.RSAKey.from_private_key(StringIO(private_key))
+    except paramiko.SSHException:
+        return paramiko.DSSKey.from_private_key(StringIO(private_key))
+
+
+class SSHPool(object):
+    """Keeps authenticated SSH connections open, to be reused by commands.
+
+    Connections are keyed by host, user and key fingerprint. A paramiko
+    transport can carry many channels at once, so a connection is shared by
+    all commands to the same machine instead of being checked out. Each
+    connection counts the channels open on it, taken with open() and given
+    back with close().
+
+    Connections unused for idle_timeout seconds are closed, and if there are
+    already max_connections open the least recently used one makes room for
+    a new one. Connections with channels open are never closed, only taken
+    out of the pool, and they are closed when their last channel is. So the
+    pool may briefly hold more than max_connections. Keepalives are sent
+    every keepalive seconds, and connections idle for more than
+    SSH_HEALTH_CHECK seconds are checked before reuse.
+    """
+
+    def __init__(self, max_connections=SSH_MAX_CONNECTIONS,
+                 idle_timeout=SSH_IDLE_TIMEOUT, keepalive=SSH_KEEPALIVE):
+        self.max_connections = max_connections
+        self.idle_timeout = idle_timeout
+        self.keepalive = keepalive
+        self.connections = {}
+        # the connection of each channel open
+        self.channels = {}
+        self.keys = {}
+        self.lock = threading.Lock()
+
+    def get_key(self, private_key):
+        """Returns the parsed key and its fingerprint, parsing only once."""
+        digest = sha256(private_key).hexdigest()
+        with self.lock:
+            if digest in self.keys:
+                return self.keys[digest]
+        key = load_key(private_key)
+        fingerprint = key.get_fingerprint().encode('hex')
+        with self.lock:
+            self.keys[digest] = (key, fingerprint)
+        return key, fingerprint
+
+    def connect(self, host, user, key):
+        """Opens a new SSHClient."""
+        client = paramiko.SSHClient()
+        client.set_missing_host_key_policy(paramiko.AutoAddPolicy())
+        client.connect(host, username=user, pkey=key,
+                       timeout=SSH_CONNECT_TIMEOUT,
+                       allow_agent=False, look_for_keys=False)
+        client.get_transport().set_keepalive(self.keepalive)
+        return client
+
+    def get(self, host, user, private_key):
+        """Checks out a connection to host, connecting only if needed.
+
+        Returns the connection, whose client is open. Give it back with
+        checkin() once done with it.
+        """
+        key, fingerprint = self.get_key(private_key)
+        pool_key = (host, user, fingerprint)
+        now = time()
+
+        self.reap(now)
+        with self.lock:
+            connection = self.connections.get(pool_key, None)
+            if connection:
+                connection['users'] += 1
+                connection['last_used'] = now
+
+        if connection:
+            if self.healthy(connection, now):
+                return connection
+            self.checkin(connection)
+            self.drop(pool_key, connection=connection)
+
+        client = self.connect(host, user, key)
+
+        closing = []
+        with self.lock:
+            connection = self.connections.get(pool_key, None)
+            if connection:
+                # another thread connected meanwhile, use its connection
+                connection['users'] += 1
+                connection['last_used'] = now
+                closing.append({'client': client})
+            else:
+                connection = {'client': client,
+                              'users': 1,
+                              'retired': False,
+                              'last_used': now,
+                              'checked': now}
+                idle = [k for k, c in self.connections.items()
+                        if not c['users']]
+                if len(self.connections) >= self.max_connections and idle:
+                    oldest = min(idle,
+                                 key=lambda k: self.connections[k]['last_used'])
+                    closing.append(self.connections.pop(oldest))
+                self.connections[pool_key] = connection
+        for stale in closing:
+            stale['client'].close()
+        return connection
+
+    def checkin(self, connection):
+        """Gives back a connection taken with get().
+
+        Closes it if it was taken out of the pool while in use.
+        """
+        with self.lock:
+            connection['users'] -= 1
+            connection['last_used'] = time()
+            closing = connection['retired'] and not connection['users']
+        if closing:
+            connection['client'].close()
+
+    def healthy(self, connection, now):
+        """Checks that a connection is still usable."""
+        transport = connection['client'].get_transport()
+        if not transport or not transport.is_active():
+            return False
+        if now - connection['checked'] > SSH_HEALTH_CHECK:
+            try:
+                transport.send_ignore()
+            except Exception:
+                return False
+            connection['checked'] = now
+        return True
+
+    def drop(self, host, user=None, private_key=None, connection=None):
+        """Takes a pooled connection out of the pool, e.g. after it failed.
+
+        Accepts either a pool key or host, user and private_key. If given a
+        connection, it's only dropped if it's still the pooled one. It's
+        closed right away unless it has channels open.
+        """
+        if user is None:
+            pool_key = host
+        else:
+            pool_key = (host, user, self.get_key(private_key)[1])
+        with self.lock:
+            pooled = self.connections.get(pool_key, None)
+            if not pooled or (connection and pooled is not connection):
+                return
+            del self.connections[pool_key]
+            pooled['retired'] = True
+            closing = not pooled['users']
+        if closing:
+            pooled['client'].close()
+
+    def reap(self, now):
+        """Closes the connections idle for more than idle_timeout."""
+        with self.lock:
+            idle = [pool_key for pool_key, connection
+                    in self.connections.items()
+                    if not connection['users'] and
+                    now - connection['last_used'] > self.idle_timeout]
+            closing = [self.connections.pop(pool_key) for pool_key in idle]
+        for connection in closing:
+            connection['client'].close()
+
+    def open(self, host, user, private_key):
+        """Opens a channel to host, on a pooled connection if there is one.
+
+        If the pooled connection turns out dead it is dropped and the channel
+        is opened on a fresh one. Close the channel with close(), so that the
+        pool knows the connection is no longer used by it.
+        """
+        connection = self.get(host, user, private_key)
+        try:
+            channel = connection['client'].get_transport().open_session()
+        except (paramiko.SSHException, EOFError) as exc:
+            log.warn('SSH connection to %s failed, reconnecting: %s'
+                     % (host, exc))
+            self.checkin(connection)
+            self.drop(host, user, private_key)
+            connection = self.get(host, user, private_key)
+            try:
+                channel = connection['client'].get_transport().open_session()
+            except:
+                self.checkin(connection)
+                raise
+        with self.lock:
+            self.channels[channel] = connection
+        return channel
+
+    def close(self, channel):
+        """Closes a channel taken with open() and gives its connection back."""
+        try:
+            channel.close()
+        finally:
+            with self.lock:
+                connection = self.channels.pop(channel, None)
+            if connection:
+                self.checkin(connection)
+
+    def run(self, host, user, private_key, command, timeout):
+        """Runs a command and returns its output, stdout and stderr merged.
+
+        A pty is requested as Fabric did, so that commands like sudo that
+        need one behave the same.
+        """
+        output = []
+        self.stream(host, user, private_key, command, timeout, output.append)
+        return ''.join(output).replace('\r\n', '\n').strip()
+
+    def stream(self, host, user, private_key, command, timeout, write):
+        """Runs a command, passing its output to write as it comes.
+
+        The command may run for at most timeout seconds. Returns its exit
+        status. Raises socket.error if the connection is lost before the
+        command exits, so that cut output isn't taken for all of it.
+        """
+        deadline = time() + timeout
+        channel = self.open(host, user, private_key)
+        try:
+            channel.settimeout(timeout)
+            channel.get_pty()
+            channel.set_combine_stderr(True)
+            channel.exec_command(command)
+            while True:
+                data = channel.recv(4096)
+                if not data:
+                    break
+                write(data)
+                if time() > deadline:
+                    raise socket.timeout('Command timed out')
+            if not channel.exit_status_ready():
+                transport = channel.get_transport()
+                if not transport or not transport.is_active():
+                    raise socket.error('SSH connection to %s lost' % host)
+            return channel.recv_exit_status()
+        finally:
+            self.close(channel)
+
+
+class ExecutorBusy(Exception):
+    """Raised when an SSHExecutor can't take any more commands."""
+
+
+class SSHExecutor(object):
+    """Runs SSH commands on a bounded WorkerPool, over an SSHPool.
+
+    Every command carries its own host, user and key down to its connection,
+    nothing is kept in module state like Fabric's env, so any number of
+    request threads can use it at once. At most workers commands run at the
+    same time and up to queue_size more wait for a worker. Further commands
+    are refused with ExecutorBusy, so that callers can answer right away
+    instead of piling up blocked threads.
+    """
+
+    def __init__(self, pool, workers=SSH_WORKERS, queue_size=SSH_QUEUE_SIZE):
+        self.pool = pool
+        self.workers = WorkerPool(workers, queue_size, name='ssh')
+
+    def submit(self, host, user, private_key, command, timeout):
+        """Queues a command, returns its workers.Job."""
+        try:
+            return self.workers.submit(self.pool.run, host, user,
+                                       private_key, command, timeout)
+        except Full:
+            raise ExecutorBusy('Too many commands queued')
+
+    def submit_stream(self, host, user, private_key, command, timeout,
+                      write):
+        """Queues a command streaming its output to write, see SSHPool.stream.
+
+        Returns its workers.Job, whose result is the exit status.
+        """
+        try:
+            return self.workers.submit(self.pool.stream, host, user,
+                                       private_key, command, timeout, write)
+        except Full:
+            raise ExecutorBusy('Too many commands queued')
+
+    def run(self, host, user, private_key, command, timeout):
+        """Runs a command and waits for its output, raising its errors.
+
+        Waits at most timeout seconds for a worker and as long again, plus
+        the time to connect, for the command, then raises socket.timeout.
+        """
+        job = self.submit(host, user, private_key, command, timeout)
+        if not job.wait_running(timeout + SSH_CONNECT_TIMEOUT, timeout):
+            raise socket.timeout('Command timed out')
+        if job.error:
+            raise job.error
+        return job.result
+
+
+# Shared by all commands of this process
+ssh_pool = SSHPool()
+ssh_executor = None
+ssh_executor_lock = threading.Lock()
+
+
+def get_executor():
+    """Returns the process wide SSHExecutor, starting it if needed."""
+    if not ssh_executor:
+        start_executor(SSH_WORKERS, SSH_QUEUE_SIZE, replace=False)
+    return ssh_executor
+
+
+def start_executor(workers, queue_size, replace=True):
+    """Starts the process wide SSHExecutor with the given limits.
+
+    Unless replace is set, keeps the one already running if there is one.
+    """
+    global ssh_executor
+    with ssh_executor_lock:
+        if replace or not ssh_executor:
+            ssh_executor = SSHExecutor(ssh_pool, workers, queue_size)
@@ -503,6 +503,12 @@ function appendShell(data){
     }
 }
 
+function appendShellText(text){
+    // output from server-sent events is plain text, unlike the iframe's
+    appendShell(text.replace(/&/g, '&amp;').replace(/</g, '&lt;')
+                    .replace(/>/g, '&gt;').replace(/\r?\n/g, '<br/>'));
+}
+
 function completeShell(ret){
     $('iframe').remove();
     Mist.machine.set('pendingShell', false);
@@ -524,3 +530,18 @@ function completeShell(ret){
     }
     $('body').append('<iframe id="hidden-shell-iframe"></iframe');
 }
+
+function watchJob(job, callback){
+    // machine jobs run in the background, check on them until they finish
+    if (job.status == 'done' || job.status == 'failed') {
+        callback(job);
+        return;
+    }
+    setTimeout(function(){
+        $.getJSON('/jobs/' + job.id, function(data) {
+            watchJob(data, callback);
+        }).error(function() {
+            callback({'id': job.id, 'status': 'failed', 'error': 'Job lost'});
+        });
+    }, 3000);
+}
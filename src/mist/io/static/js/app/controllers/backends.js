@@ -15,6 +15,12 @@ define('app/controllers/backends', [
             // TODO make this property dynamic according to all backends states
             state: "waiting",
             ok: false,
+            // one EventSource pushes machine changes of all backends
+            events: null,
+            eventsSupported: !!window.EventSource,
+            // machines waiting for their uptime to be checked
+            uptimeQueue: [],
+            uptimeTimer: null,
 
             isOK: function() {
                 if(this.state == 'state-ok'){
@@ -48,6 +54,242 @@ define('app/controllers/backends', [
                 this.set('imageCount', count);
             },
 
+            subscribe: function() {
+                if (!this.eventsSupported) {
+                    return false;
+                }
+                // reopen the stream once, however many backends subscribe
+                Ember.run.once(this, 'openEvents');
+                return true;
+            },
+
+            openEvents: function() {
+                if (this.events) {
+                    this.events.close();
+                    this.set('events', null);
+                }
+
+                var cursors = [];
+                this.content.forEach(function(backend) {
+                    if (backend.machines.subscribed) {
+                        cursors.push(backend.id + ':' + backend.machines.version);
+                    }
+                });
+                if (!cursors.length) {
+                    return;
+                }
+
+                var that = this;
+                var source = new EventSource('/events?since=' + cursors.join(','));
+
+                source.addEventListener('changes', function(e) {
+                    var data = JSON.parse(e.data);
+                    var backend = that.findProperty('id', data.backend);
+                    if (backend && backend.machines.subscribed) {
+                        backend.machines.applyChanges(data);
+                        that.getMachineCount();
+                        Ember.run.next(function(){
+                            $('#machines-list input.ember-checkbox').checkboxradio();
+                        });
+                    }
+                });
+
+                function fallBack() {
+                    that.set('eventsSupported', false);
+                    that.set('events', null);
+                    source.close();
+                    that.content.forEach(function(backend) {
+                        if (backend.machines.subscribed) {
+                            backend.machines.resubscribe();
+                        }
+                    });
+                }
+
+                source.addEventListener('failure', function(e) {
+                    var data = JSON.parse(e.data);
+                    warn('Machine events failed: ' + data.error);
+                    if (data.backend) {
+                        var backend = that.findProperty('id', data.backend);
+                        if (backend) {
+                            backend.machines.set('eventsSupported', false);
+                            backend.machines.resubscribe();
+                        }
+                    } else {
+                        fallBack();
+                    }
+                });
+
+                source.onerror = function() {
+                    // the browser reconnects by itself, unless it got an
+                    // error status, e.g. 501 when events are not supported
+                    if (source.readyState == EventSource.CLOSED) {
+                        fallBack();
+                    }
+                };
+
+                this.set('events', source);
+            },
+
+            queueUptime: function(machine, delay) {
+                var that = this;
+                setTimeout(function() {
+                    if (that.uptimeQueue.indexOf(machine) == -1) {
+                        that.uptimeQueue.push(machine);
+                    }
+                    // gather the machines queued meanwhile in one request
+                    if (!that.uptimeTimer) {
+                        that.uptimeTimer = setTimeout(function() {
+                            that.uptimeTimer = null;
+                            that.checkUptimes();
+                        }, 500);
+                    }
+                }, delay);
+            },
+
+            checkUptimes: function() {
+                var that = this;
+                var queued = this.uptimeQueue;
+                var pending = {};
+                var batch = [];
+                this.uptimeQueue = [];
+
+                queued.forEach(function(machine) {
+                    if (!machine.backend) {
+                        return;
+                    }
+                    if (machine.backend.create_pending) {
+                        // Try again later if a machine is being created on this backend
+                        that.queueUptime(machine, 10000);
+                        return;
+                    }
+                    if (machine.state != 'running') {
+                        return;
+                    }
+                    var host = machine.getHost();
+                    if (!host) {
+                        return;
+                    }
+                    pending[machine.backend.id + ':' + machine.id] = machine;
+                    batch.push({'backend': machine.backend.id,
+                                'machine': machine.id,
+                                'host': host,
+                                'ssh_user': machine.getUser()});
+                });
+                if (!batch.length) {
+                    return;
+                }
+
+                // results come one json object per line, as machines answer
+                var xhr = new XMLHttpRequest();
+                var parsed = 0;
+
+                function readResults() {
+                    var end = xhr.responseText.lastIndexOf('\n');
+                    if (end < parsed) {
+                        return;
+                    }
+                    var lines = xhr.responseText.substring(parsed, end).split('\n');
+                    parsed = end + 1;
+                    lines.forEach(function(line) {
+                        if (!line) {
+                            return;
+                        }
+                        var result = JSON.parse(line);
+                        var key = result.backend + ':' + result.machine;
+                        var machine = pending[key];
+                        if (machine) {
+                            delete pending[key];
+                            machine.applyUptime(result.status, result.output);
+                        }
+                    });
+                }
+
+                xhr.onreadystatechange = function() {
+                    if (xhr.readyState == 3) {
+                        readResults();
+                    } else if (xhr.readyState == 4) {
+                        if (xhr.status == 200) {
+                            readResults();
+                        }
+                        // machines left without a result get checked again
+                        for (var key in pending) {
+                            pending[key].applyUptime(xhr.status, xhr.statusText);
+                        }
+                    }
+                };
+                xhr.open('POST', '/machines/uptime');
+                xhr.setRequestHeader('Content-Type', 'application/json');
+                xhr.setRequestHeader('cache-control', 'no-cache');
+                xhr.send(JSON.stringify({'machines': batch}));
+            },
+
+            machineAction: function(machines, action, state) {
+                // one request for all machines, see bulk_machine_action
+                var selected = {};
+                var batch = [];
+                machines.forEach(function(machine) {
+                    selected[machine.backend.id + ':' + machine.id] = machine;
+                    batch.push({'backend': machine.backend.id,
+                                'machine': machine.id});
+                });
+                if (!batch.length) {
+                    return;
+                }
+
+                $.ajax({
+                    url: '/machines/actions',
+                    type: 'POST',
+                    contentType: 'application/json',
+                    data: JSON.stringify({'action': action, 'machines': batch}),
+                    headers: { "cache-control": "no-cache" },
+                    success: function(data) {
+                        var failed = [];
+                        var applyResults = function(results) {
+                            results.forEach(function(result) {
+                                var machine = selected[result.backend + ':' + result.machine];
+                                if (!machine) {
+                                    return;
+                                }
+                                if (result.status == 'ok' || result.status == 'queued') {
+                                    machine.set('state', state);
+                                } else {
+                                    failed.push(machine.name);
+                                }
+                            });
+                        };
+                        var notifyFailed = function() {
+                            if (failed.length) {
+                                Mist.notificationController.notify('Error when sending ' + action +
+                                        ' to machines ' + failed.join(', '));
+                                failed = [];
+                            }
+                        };
+
+                        applyResults(data.machines);
+                        info('Successfully sent', action, 'to', batch.length, 'machines');
+                        notifyFailed();
+
+                        // reboots and destroys run as a job per backend
+                        data.jobs.forEach(function(job) {
+                            watchJob(job, function(job) {
+                                if (job.status == 'done') {
+                                    applyResults(job.result);
+                                } else {
+                                    Mist.notificationController.notify('Error when sending ' + action +
+                                            ' to machines: ' + job.error);
+                                }
+                                notifyFailed();
+                            });
+                        });
+                    },
+                    error: function(jqXHR, textstate, errorThrown) {
+                        Mist.notificationController.notify('Error when sending ' + action +
+                                ' to machines');
+                        error(textstate, errorThrown, 'when sending', action, 'to machines');
+                    }
+                });
+            },
+
             checkMonitoring: function(){
                 if (!Mist.authenticated){
                     return
@@ -32,6 +32,22 @@ define('app/controllers/images', [
                 return foundImage;
             },
 
+            search: function(query, offset, callback) {
+                // search the catalog on the server, a page at a time
+                var that = this;
+                $.getJSON('/backends/' + this.backend.id + '/images',
+                          {'q': query || '', 'offset': offset || 0}, function(data) {
+                    var images = new Array();
+                    data.images.forEach(function(item){
+                        item.backend = that.backend;
+                        images.push(Image.create(item));
+                    });
+                    callback(images, data.total);
+                }).error(function() {
+                    Mist.notificationController.notify("Error searching images for backend: " + that.backend.title);
+                });
+            },
+
             init: function() {
                 this._super();
 
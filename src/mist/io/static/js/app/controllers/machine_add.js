@@ -20,9 +20,64 @@ define('app/controllers/machine_add', [
                                             this.get('newMachineScript'));
             },
 
+            searchImages: function() {
+                var backend = this.get('newMachineBackend');
+                var query = this.get('newMachineImageQuery');
+                var that = this;
+
+                this.set('newMachineImage', null);
+                if (!backend) {
+                    this.set('newMachineImages', []);
+                    return;
+                }
+                backend.images.search(query, 0, function(images, total) {
+                    // ignore answers to older queries
+                    if (backend == that.get('newMachineBackend') &&
+                        query == that.get('newMachineImageQuery')) {
+                        // keep an image picked from the images list selectable
+                        var image = that.get('newMachineImage');
+                        if (image && !images.findProperty('id', image.id)) {
+                            images.unshift(image);
+                        }
+                        that.set('newMachineImages', images);
+                        that.set('newMachineImagesTotal', total);
+                    }
+                });
+            },
+
+            moreImages: function() {
+                // fetch the next page of the current search
+                var backend = this.get('newMachineBackend');
+                var query = this.get('newMachineImageQuery');
+                var current = this.get('newMachineImages') || [];
+                var that = this;
+
+                if (!backend || !this.get('newMachineImagesMore')) {
+                    return;
+                }
+                backend.images.search(query, current.length, function(images, total) {
+                    if (backend == that.get('newMachineBackend') &&
+                        query == that.get('newMachineImageQuery') &&
+                        current == that.get('newMachineImages')) {
+                        that.set('newMachineImages', current.concat(images.filter(function(image) {
+                            return !current.findProperty('id', image.id);
+                        })));
+                        that.set('newMachineImagesTotal', total);
+                    }
+                });
+            },
+
+            newMachineImagesMore: function() {
+                var images = this.get('newMachineImages') || [];
+                return images.length < (this.get('newMachineImagesTotal') || 0);
+            }.property('newMachineImages', 'newMachineImagesTotal'),
+
             newMachineClear: function() {
                 this.set('newMachineName', null);
                 this.set('newMachineBackend', null);
+                this.set('newMachineImageQuery', null);
+                this.set('newMachineImages', []);
+                this.set('newMachineImagesTotal', 0);
                 this.set('newMachineImage', null);
                 this.set('newMachineSize', null);
                 this.set('newMachineLocation', null);
@@ -61,6 +116,8 @@ define('app/controllers/machine_add', [
                 this.addObserver('newMachineSize', this, this.updateNewMachineReady);
                 this.addObserver('newMachineLocation', this, this.updateNewMachineReady);
                 this.addObserver('newMachineCost', this, this.updateNewMachineReady);
+                this.addObserver('newMachineBackend', this, this.searchImages);
+                this.addObserver('newMachineImageQuery', this, this.searchImages);
             }
         });
     }
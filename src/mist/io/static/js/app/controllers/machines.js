@@ -14,6 +14,13 @@ define('app/controllers/machines', [
 
             content: null,
 
+            // inventory version of the last response, see list_machines
+            version: 0,
+
+            // whether changes are pushed, see stream_machine_events
+            subscribed: false,
+            eventsSupported: true,
+
             init: function() {
                 this._super();
                 this.set('content', []),
@@ -24,7 +31,9 @@ define('app/controllers/machines', [
 
                 if(!this.backend.enabled){
                     this.backend.set('state', 'offline');
+                    this.unsubscribe();
                     this.clear();
+                    this.set('version', 0);
                     return;
                 }
 
@@ -33,60 +42,17 @@ define('app/controllers/machines', [
                 
                 this.backend.set('state', 'waiting');
 
-                $.getJSON('/backends/' + this.backend.id + '/machines', function(data) {
-
-                    data.forEach(function(item){
-                        var found = false;
-
-                        log("item id: " + item.id);
-
-                        that.content.forEach(function(machine){
-                            if (machine.id == item.id || (machine.id == -1 && machine.name == item.name)) {
-                                found = true;
-                                // machine.set(item); //FIXME this does not change anything;
-                                if (machine.id == -1) {
-                                    machine.set('id', item.id);
-                                }
-                                machine.set('state', item.state);
-                                machine.set('can_stop', item.can_stop);
-                                machine.set('can_start', item.can_start);
-                                machine.set('can_destroy', item.can_destroy);
-                                machine.set('can_reboot', item.can_reboot);
-                                machine.set('can_tag', item.can_tag);
-                                //FIXME check for changes
-                                machine.tags.set('content', item.tags)
-                                machine.set('public_ips', item.public_ips);
-                                machine.set('extra', item.extra);
-                                return false;
-                            }
-                        });
-
-                        if (!found && !that.backend.create_pending) {
-                            item.backend = that.backend;
-                            var machine = Machine.create(item);
-                            machine.tags.set('content', item.tags)
-                            that.pushObject(machine);
-                        }
-
-                    });
-                    
-                    that.content.forEach(function(item) {
-                        var found = false;
-
-                        data.forEach(function(machine) {
-                            log("machine id: " + machine.id);
-
-                            if (machine.id == item.id) {
-                                found = true;
-                                return false;
-                            }
-                        });
+                $.getJSON('/backends/' + this.backend.id + '/machines', {'since': this.version}, function(data) {
 
-                        if (!found && item.id != -1) {
-                            log("not found, deleting");
-                            that.removeObject(item);
-                        }
-                    });
+                    if (!data) {
+                        // 304, nothing changed since our version
+                    } else if (data instanceof Array) {
+                        // this backend does not support versions, nor events
+                        that.set('eventsSupported', false);
+                        that.syncMachines(data);
+                    } else {
+                        that.applyChanges(data);
+                    }
 
                     if(that.backend.enabled){
                         that.backend.set('state', 'online');
@@ -100,9 +66,12 @@ define('app/controllers/machines', [
                         $('#machines-list input.ember-checkbox').checkboxradio();    
                     });
                     
-                    Ember.run.later(that, function(){
-                        this.refresh();
-                    }, that.backend.poll_interval);
+                    // prefer getting changes pushed, poll if not possible
+                    if (!that.subscribe()) {
+                        Ember.run.later(that, function(){
+                            this.refresh();
+                        }, that.backend.poll_interval);
+                    }
                     
                     if (that.backend.error) {
                         that.backend.set('error', false);
@@ -125,6 +94,115 @@ define('app/controllers/machines', [
                 });
             },
 
+            applyChanges: function(data) {
+                if (data.full) {
+                    this.syncMachines(data.machines);
+                } else {
+                    this.updateMachines(data.added.concat(data.changed));
+                    this.removeMachines(data.removed);
+                }
+                // new machines are skipped while one is being
+                // created, so keep asking for them until it's done
+                if (!this.backend.create_pending) {
+                    this.set('version', data.version);
+                }
+            },
+
+            subscribe: function() {
+                // changes are pushed by the backends controller's stream
+                if (!this.subscribed && this.eventsSupported && this.backend.enabled) {
+                    this.set('subscribed', Mist.backendsController.subscribe());
+                }
+                return this.subscribed;
+            },
+
+            unsubscribe: function() {
+                if (this.subscribed) {
+                    this.set('subscribed', false);
+                    Mist.backendsController.subscribe();
+                }
+            },
+
+            resubscribe: function() {
+                // catch up by polling, which subscribes again if possible
+                this.unsubscribe();
+                this.refresh();
+            },
+
+            updateMachines: function(data) {
+                var that = this;
+
+                data.forEach(function(item){
+                    var found = false;
+
+                    log("item id: " + item.id);
+
+                    that.content.forEach(function(machine){
+                        if (machine.id == item.id || (machine.id == -1 && machine.name == item.name)) {
+                            found = true;
+                            // machine.set(item); //FIXME this does not change anything;
+                            if (machine.id == -1) {
+                                machine.set('id', item.id);
+                            }
+                            machine.set('state', item.state);
+                            machine.set('can_stop', item.can_stop);
+                            machine.set('can_start', item.can_start);
+                            machine.set('can_destroy', item.can_destroy);
+                            machine.set('can_reboot', item.can_reboot);
+                            machine.set('can_tag', item.can_tag);
+                            //FIXME check for changes
+                            machine.tags.set('content', item.tags)
+                            machine.set('public_ips', item.public_ips);
+                            machine.set('extra', item.extra);
+                            return false;
+                        }
+                    });
+
+                    if (!found && !that.backend.create_pending) {
+                        item.backend = that.backend;
+                        var machine = Machine.create(item);
+                        machine.tags.set('content', item.tags)
+                        that.pushObject(machine);
+                    }
+                });
+            },
+
+            removeMachines: function(ids) {
+                var that = this;
+
+                ids.forEach(function(id) {
+                    var machine = that.findProperty('id', id);
+                    if (machine) {
+                        log("removed, deleting");
+                        that.removeObject(machine);
+                    }
+                });
+            },
+
+            syncMachines: function(data) {
+                var that = this;
+
+                this.updateMachines(data);
+
+                this.content.slice().forEach(function(item) {
+                    var found = false;
+
+                    data.forEach(function(machine) {
+                        log("machine id: " + machine.id);
+
+                        if (machine.id == item.id) {
+                            found = true;
+                            return false;
+                        }
+                    });
+
+                    if (!found && item.id != -1) {
+                        log("not found, deleting");
+                        that.removeObject(item);
+                    }
+                });
+            },
+
             newMachine: function(name, image, size, location, key, script) {
                 log('Creating machine', this.name, 'to backend', this.backend.title);
 
@@ -181,13 +259,27 @@ define('app/controllers/machines', [
                         warn(data);
                         if (that.backend.error) {
                             that.backend.set('error', false);
-                        }     
+                        }
+                        // listed with the job id until created, see create_machine
                         machine.set("id", data.id);
-                        machine.set("name", data.name);
-                        machine.set("public_ips", data.public_ips);
-                        machine.set("private_ips", data.private_ips);
-                        machine.set("extra", data.extra);
-                        that.backend.set('create_pending', false);
+                        watchJob(data, function(job) {
+                            if (job.status == 'done') {
+                                machine.set("id", job.result.id);
+                                machine.set("name", job.result.name);
+                                machine.set("public_ips", job.result.public_ips);
+                                machine.set("private_ips", job.result.private_ips);
+                                machine.set("extra", job.result.extra);
+                            } else {
+                                Mist.notificationController.notify('Error while creating machine ' +
+                                        name + ': ' + job.error);
+                                that.removeObject(machine);
+                            }
+                            that.backend.set('create_pending', false);
+                            if (that.subscribed) {
+                                // get the changes skipped while creating
+                                that.resubscribe();
+                            }
+                        });
                     },
                     error: function(jqXHR, textstate, errorThrown) {
                         Mist.notificationController.notify('Error while sending create machine' +
@@ -196,6 +288,10 @@ define('app/controllers/machines', [
                         that.removeObject(machine);
                         that.backend.set('error', textstate);
                         that.backend.set('create_pending', false);
+                        if (that.subscribed) {
+                            // get the changes skipped while creating
+                            that.resubscribe();
+                        }
 
                     }
                 });
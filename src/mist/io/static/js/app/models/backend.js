@@ -62,6 +62,7 @@ define('app/models/backend', [
                 if (!this.enabled){
                     this.set('state', "offline");
                     this.machines.clear();
+                    this.machines.set('version', 0);
                     this.images.clear();
                     this.sizes.clear();
                     this.locations.clear();
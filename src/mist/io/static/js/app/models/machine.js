@@ -18,6 +18,9 @@ define('app/models/machine', [
             hasMonitoring: null,
             pendingMonitoring: false,
             pendingShell: false,
+            // id and EventSource of the interactive shell, if one is open
+            shellSession: null,
+            shellEvents: null,
             pendingAddTag: false,
             pendingDeleteTag: false,
             pendingStats: false,
@@ -45,6 +48,12 @@ define('app/models/machine', [
                     success: function(data) {
                         that.set('state', 'rebooting');
                         info('Succesfully sent reboot to machine', that.name);
+                        watchJob(data, function(job) {
+                            if (job.status == 'failed') {
+                                Mist.notificationController.notify('Error when rebooting machine ' +
+                                        that.name + ': ' + job.error);
+                            }
+                        });
                     },
                     error: function(jqXHR, textstate, errorThrown) {
                         Mist.notificationController.notify('Error when sending reboot to machine ' +
@@ -67,6 +76,12 @@ define('app/models/machine', [
                     success: function(data) {
                         that.set('state', 'pending');
                         info('Successfully sent destroy to machine', that.name);
+                        watchJob(data, function(job) {
+                            if (job.status == 'failed') {
+                                Mist.notificationController.notify('Error when destroying machine ' +
+                                        that.name + ': ' + job.error);
+                            }
+                        });
                     },
                     error: function(jqXHR, textstate, errorThrown) {
                         Mist.notificationController.notify('Error when sending destroy to machine ' +
@@ -181,11 +196,123 @@ define('app/models/machine', [
                 }
                 url = url + '?' + EncodeQueryData(params);
                 this.set('pendingShell', true);
-                
-                $('#hidden-shell-iframe').attr('src', url);
+
+                if (window.EventSource) {
+                    // output comes in chunks as server-sent events
+                    var source = new EventSource(url);
+                    var completed = false;
+                    source.addEventListener('output', function(e) {
+                        appendShellText(JSON.parse(e.data));
+                    });
+                    source.addEventListener('exit', function(e) {
+                        completed = true;
+                        source.close();
+                        completeShell(JSON.parse(e.data).status);
+                    });
+                    source.onerror = function() {
+                        // never let it reconnect, that runs the command again
+                        source.close();
+                        if (!completed) {
+                            completed = true;
+                            completeShell(-1);
+                        }
+                    };
+                } else {
+                    $('#hidden-shell-iframe').attr('src', url);
+                }
                 callback('');
             },
 
+            shellInput: function(shell_command, callback) {
+                // commands share one shell, so cd, export etc. carry over
+                if (!window.EventSource) {
+                    return this.shell(shell_command, callback);
+                }
+                if (this.shellSession) {
+                    callback('');
+                    this.sendShellInput(shell_command);
+                    return;
+                }
+
+                log('Opening shell to machine', this.name);
+                this.set('pendingShell', true);
+
+                var that = this;
+                $.ajax({
+                    url: '/backends/' + this.backend.id + '/machines/' + this.id + '/sessions',
+                    type: 'POST',
+                    headers: { "cache-control": "no-cache" },
+                    contentType: 'application/json',
+                    data: JSON.stringify({'host': this.getHost(),
+                                          'ssh_user': this.getUser()}),
+                    dataType: 'json',
+                    success: function(data) {
+                        that.set('shellSession', data.session);
+                        var source = new EventSource('/sessions/' + data.session + '/output');
+                        source.addEventListener('output', function(e) {
+                            that.set('pendingShell', false);
+                            $('.shell-return .pending').removeClass('pending');
+                            appendShellText(JSON.parse(e.data));
+                        });
+                        source.addEventListener('closed', function() {
+                            that.closeShell();
+                        });
+                        source.onerror = function() {
+                            // otherwise the browser resumes where it left off
+                            if (source.readyState == EventSource.CLOSED) {
+                                that.closeShell();
+                            }
+                        };
+                        that.set('shellEvents', source);
+                        callback('');
+                        that.sendShellInput(shell_command);
+                    },
+                    error: function(jqXHR, textstate, errorThrown) {
+                        error(textstate, errorThrown, 'when opening shell to machine',
+                            that.name);
+                        // fall back to a new connection per command
+                        that.shell(shell_command, callback);
+                    }
+                });
+            },
+
+            sendShellInput: function(shell_command) {
+                log('Sending', shell_command, 'to shell of machine', this.name);
+
+                var that = this;
+                this.set('pendingShell', true);
+                $.ajax({
+                    url: '/sessions/' + this.shellSession,
+                    type: 'POST',
+                    headers: { "cache-control": "no-cache" },
+                    contentType: 'application/json',
+                    data: JSON.stringify({'input': shell_command + '\n'}),
+                    error: function(jqXHR, textstate, errorThrown) {
+                        Mist.notificationController.notify('Error when sending command to machine ' +
+                                that.name);
+                        error(textstate, errorThrown, 'when sending command to machine',
+                                that.name);
+                        that.closeShell();
+                    }
+                });
+            },
+
+            closeShell: function() {
+                if (this.shellEvents) {
+                    this.shellEvents.close();
+                    this.set('shellEvents', null);
+                }
+                if (this.shellSession) {
+                    $.ajax({
+                        url: '/sessions/' + this.shellSession,
+                        type: 'DELETE'
+                    });
+                    this.set('shellSession', null);
+                }
+                this.set('pendingShell', false);
+                $('.shell-return .pending').removeClass('pending');
+            },
+
             hasAlert : function() {
                 //TODO when we have alerts
                 return false;
@@ -207,62 +334,27 @@ define('app/models/machine', [
             },
 
             checkUptime: function() {
-                var that = this;
-
-                function uptimeTimeout() {
-                    if (!that.backend) {
-                        return false;
-                    }
-                    
-                    if (that.backend.create_pending){
-                        // Try again later if a machine is being created on this backend
-                        setTimeout(uptimeTimeout, 10000);
-                        return false;
-                    }
+                // checked in batches with the other machines, see backends
+                Mist.backendsController.queueUptime(this, 2000);
+            },
 
-                    if (that.state == 'running') {
-                        var host = that.getHost();
-                        if (host) {
-                            var ssh_user = that.getUser();
-
-                            $.ajax({
-                                url: '/backends/' + that.backend.id + '/machines/' + that.id + '/shell',
-                                type: 'POST',
-                                headers: { "cache-control": "no-cache" },
-                                data: {'host': host,
-                                   'ssh_user': ssh_user,
-                                   'command': 'cat /proc/uptime'},
-                                success: function(data, textStatus, jqXHR) {
-                                       // got it fine, also means it has a key
-                                    if (jqXHR.status === 200) {
-                                        that.set('hasKey', true);
-                                        var resp = data.split(' ');
-                                        if (resp.length == 2) {
-                                            var uptime = parseFloat(resp[0]) * 1000;
-                                            that.set('uptimeChecked', Date.now());
-                                            that.set('uptimeFromServer', uptime);
-                                        }
-                                        info('Successfully got uptime', data, 'from machine', that.name);
-                                    } else {
-                                        // in every other case there is a problem
-                                        that.set('hasKey', false);
-                                        info('Got response other than 200 while getting uptime from machine', that.name);
-                                        setTimeout(uptimeTimeout, 10000);
-                                    }
-                                },
-                                error: function(jqXHR, textstate, errorThrown) {
-                                    that.set('hasKey', false);
-                                    //Mist.notificationController.notify('Error getting uptime from machine ' +
-                                    //    that.name);
-                                    error(textstate, errorThrown, 'when getting uptime from machine',
-                                        that.name);
-                                    setTimeout(uptimeTimeout, 10000);
-                                }
-                            });
-                        }
+            applyUptime: function(status, data) {
+                if (status == 200) {
+                    // got it fine, also means it has a key
+                    this.set('hasKey', true);
+                    var resp = data.split(' ');
+                    if (resp.length == 2) {
+                        var uptime = parseFloat(resp[0]) * 1000;
+                        this.set('uptimeChecked', Date.now());
+                        this.set('uptimeFromServer', uptime);
                     }
-                };
-                setTimeout(uptimeTimeout, 2000);
+                    info('Successfully got uptime', data, 'from machine', this.name);
+                } else {
+                    // in every other case there is a problem
+                    this.set('hasKey', false);
+                    error(status, data, 'when getting uptime from machine', this.name);
+                    Mist.backendsController.queueUptime(this, 10000);
+                }
             },
 
             resetUptime: function() {
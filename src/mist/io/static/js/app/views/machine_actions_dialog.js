@@ -33,9 +33,7 @@ define('app/views/machine_actions_dialog', [
                 Mist.confirmationController.set("text", 'Are you sure you want to reboot' +
                         names +'?');
                 Mist.confirmationController.set("callback", function(){
-                    machines.forEach(function(machine){
-                        machine.reboot();
-                    });
+                    Mist.backendsController.machineAction(machines, 'reboot', 'rebooting');
                     window.history.go(-1);
                 });
                 Mist.confirmationController.set("fromDialog", true);
@@ -63,9 +61,7 @@ define('app/views/machine_actions_dialog', [
                 Mist.confirmationController.set("text", 'Are you sure you want to destroy' +
                         names +'?');
                 Mist.confirmationController.set("callback", function(){
-                    machines.forEach(function(machine){
-                        machine.destroy();
-                    });
+                    Mist.backendsController.machineAction(machines, 'destroy', 'pending');
                     window.history.go(-1);
                 });
                 Mist.confirmationController.set("fromDialog", true);
@@ -93,9 +89,7 @@ define('app/views/machine_actions_dialog', [
                 Mist.confirmationController.set("text", 'Are you sure you want to start' +
                         names +'?');
                 Mist.confirmationController.set("callback", function(){
-                    machines.forEach(function(machine){
-                        machine.start();
-                    });
+                    Mist.backendsController.machineAction(machines, 'start', 'pending');
                     window.history.go(-1);
                 });
                 Mist.confirmationController.set("fromDialog", true);
@@ -123,9 +117,7 @@ define('app/views/machine_actions_dialog', [
                 Mist.confirmationController.set("text", 'Are you sure you want to shutdown' +
                         names +'?');
                 Mist.confirmationController.set("callback", function(){
-                    machines.forEach(function(machine){
-                        machine.shutdown();
-                    });
+                    Mist.backendsController.machineAction(machines, 'stop', 'stopped');
                     window.history.go(-1);
                 });
                 Mist.confirmationController.set("fromDialog", true);
@@ -33,6 +33,10 @@ define('app/views/machine_add_dialog', [
                 this.clear();
             },
 
+            moreImagesClicked: function(){
+                Mist.machineAddController.moreImages();
+            },
+
             backClicked: function(){
                 this.clear();
                 history.back();
@@ -55,6 +59,12 @@ define('app/views/machine_add_dialog', [
                         });
                     });
 
+                    Mist.machineAddController.addObserver('newMachineImages', function() {
+                        Ember.run.next(function() {
+                            $('#createmachine-select-image').selectmenu('refresh');
+                        });
+                    });
+
                     Mist.machineAddController.addObserver('newMachineReady', function() {
                         Ember.run.next(function() {
                             $('#create-ok').button();
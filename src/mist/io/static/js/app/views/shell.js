@@ -46,7 +46,7 @@ function(shell_html) {
 
             var command = this.command;
 
-            this.machine.shell(command, function(output) {
+            this.machine.shellInput(command, function(output) {
 
                 if(!that.shellOutputItems.content){
                     that.shellOutputItems.set('content', new Array());
@@ -96,6 +96,9 @@ function(shell_html) {
         },
         
         back: function() {
+            if (this.machine) {
+                this.machine.closeShell();
+            }
             $('#dialog-shell').popup('close');
         },
 
@@ -0,0 +1,308 @@
+"""Storage engines for backends and keypairs"""
+import json
+import logging
+import sqlite3
+import threading
+
+from mist.io.helpers import settings_writer, keypairs_lock
+from mist.io.helpers import get_keypair_index
+
+
+log = logging.getLogger('mist.io')
+
+
+class YAMLStore(object):
+    """Keeps everything in settings.yaml, the default.
+
+    Every change rewrites the whole file, through helpers.settings_writer
+    which coalesces them.
+    """
+
+    def __init__(self, settings):
+        self.settings = settings
+
+    def save(self):
+        """Stores all settings, e.g. after the email changed."""
+        settings_writer.save(self.settings)
+
+    def refresh(self):
+        """settings.yaml is read only at startup."""
+
+    def save_backend(self, backend_id):
+        self.save()
+
+    def delete_backend(self, backend_id):
+        self.save()
+
+    def save_keypair(self, name):
+        self.save()
+
+    def delete_keypair(self, name):
+        self.save()
+
+    def set_default_keypair(self, name):
+        self.save()
+
+
+class SQLiteStore(object):
+    """Keeps backends, keypairs and their machines in a SQLite database.
+
+    Each change only touches the rows involved, in a transaction of its own,
+    so associating a key to a machine doesn't rewrite every private key like
+    settings.yaml does. The rest of the settings stay in settings.yaml.
+
+    Backends and keypairs are loaded into settings at startup, views keep
+    working on settings and tell the store what they changed. If the
+    database is empty, the backends and keypairs of settings.yaml are
+    imported.
+
+    Other processes, e.g. more workers, may share the database. The machines
+    of a keypair are stored by adding and removing only the pairs this
+    process changed since it last read them, so writes of different workers
+    don't undo each other, and refresh() reads what the others committed
+    once PRAGMA data_version tells there is something new. It's called at
+    the start of every request, check refresh_store(). Two workers editing
+    the same backend or keypair at once still end up with the last write.
+    """
+
+    SCHEMA = '''
+        CREATE TABLE IF NOT EXISTS backends (
+            id TEXT PRIMARY KEY,
+            data TEXT NOT NULL
+        );
+        CREATE TABLE IF NOT EXISTS keypairs (
+            name TEXT PRIMARY KEY,
+            public TEXT,
+            private TEXT,
+            is_default INTEGER NOT NULL DEFAULT 0
+        );
+        CREATE TABLE IF NOT EXISTS machine_keys (
+            backend_id TEXT NOT NULL,
+            machine_id TEXT NOT NULL,
+            key_name TEXT NOT NULL,
+            PRIMARY KEY (backend_id, machine_id, key_name)
+        );
+        CREATE INDEX IF NOT EXISTS machine_keys_key_name
+            ON machine_keys (key_name);
+    '''
+
+    def __init__(self, settings, path):
+        self.settings = settings
+        self.path = path
+        self.lock = threading.Lock()
+        # machines of each keypair as last read or written by this process
+        self.pairs = {}
+        self.version = None
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        self.db.execute('PRAGMA journal_mode=WAL')
+        self.db.executescript(self.SCHEMA)
+
+        if self.is_empty():
+            log.info('Importing backends and keypairs to %s' % path)
+            self.import_settings()
+        self.load()
+        # settings.yaml keeps only the rest from now on
+        settings_writer.tables = False
+
+    def is_empty(self):
+        with self.lock:
+            backends = self.db.execute(
+                'SELECT COUNT(*) FROM backends').fetchone()[0]
+            keypairs = self.db.execute(
+                'SELECT COUNT(*) FROM keypairs').fetchone()[0]
+        return not backends and not keypairs
+
+    def load(self):
+        """Reads backends and keypairs into settings."""
+        with self.lock:
+            backends, keypairs = self.read()
+        self.settings['backends'] = backends
+        self.settings['keypairs'] = keypairs
+
+    def refresh(self):
+        """Reads backends and keypairs again if another process changed them.
+
+        Only the backends and keypairs that differ are replaced, in the same
+        dicts, so views holding them keep working on what's current.
+        """
+        with keypairs_lock:
+            with self.lock:
+                version = self.db.execute(
+                    'PRAGMA data_version').fetchone()[0]
+                if version == self.version:
+                    return
+                backends, keypairs = self.read()
+
+            self.merge(self.settings['backends'], backends)
+            changed = self.merge(self.settings['keypairs'], keypairs)
+            index = get_keypair_index(self.settings['keypairs'])
+            for name in changed:
+                index.update(name)
+
+    def merge(self, current, stored):
+        """Makes current hold what's stored, returns the keys it changed."""
+        changed = []
+        for key in current.keys():
+            if not key in stored:
+                del current[key]
+                changed.append(key)
+        for key, value in stored.items():
+            if current.get(key, None) != value:
+                current[key] = value
+                changed.append(key)
+        return changed
+
+    def read(self):
+        """Returns the backends and keypairs stored, holding self.lock."""
+        backends = {}
+        keypairs = {}
+        self.version = self.db.execute('PRAGMA data_version').fetchone()[0]
+        for backend_id, data in self.db.execute(
+                'SELECT id, data FROM backends'):
+            backends[backend_id] = json.loads(data)
+        for name, public, private, is_default in self.db.execute(
+                'SELECT name, public, private, is_default FROM keypairs'):
+            keypairs[name] = {'public': public,
+                              'private': private,
+                              'machines': []}
+            if is_default:
+                keypairs[name]['default'] = True
+        for backend_id, machine_id, key_name in self.db.execute(
+                'SELECT backend_id, machine_id, key_name FROM machine_keys '
+                'ORDER BY rowid'):
+            if key_name in keypairs:
+                keypairs[key_name]['machines'].append([backend_id,
+                                                       machine_id])
+        self.pairs = dict((name, set((machine[0], machine[1])
+                                     for machine in keypair['machines']))
+                          for name, keypair in keypairs.items())
+        return backends, keypairs
+
+    def import_settings(self):
+        """Stores all backends and keypairs found in settings."""
+        with self.lock:
+            with self.db:
+                self.db.execute('DELETE FROM backends')
+                self.db.execute('DELETE FROM keypairs')
+                self.db.execute('DELETE FROM machine_keys')
+                self.pairs = {}
+                for backend_id in self.settings['backends']:
+                    self.write_backend(backend_id)
+                for name in self.settings['keypairs']:
+                    self.write_keypair(name)
+
+    def save(self):
+        """Stores the settings besides backends and keypairs."""
+        settings_writer.save(self.settings)
+
+    def save_backend(self, backend_id):
+        with self.lock:
+            with self.db:
+                self.write_backend(backend_id)
+
+    def delete_backend(self, backend_id):
+        with self.lock:
+            with self.db:
+                self.db.execute('DELETE FROM backends WHERE id = ?',
+                                (backend_id,))
+
+    def save_keypair(self, name):
+        """Stores a keypair, adding and removing only the machines changed.
+
+        Changed means since this process last read or wrote the keypair,
+        machines other processes associated meanwhile are left alone.
+        """
+        keypair = self.settings['keypairs'][name]
+        machines = set()
+        for machine in keypair.get('machines', None) or []:
+            try:
+                machines.add((machine[0], machine[1]))
+            except (IndexError, TypeError):
+                continue
+
+        with self.lock:
+            known = self.pairs.get(name, set())
+            with self.db:
+                self.db.execute(
+                    'INSERT OR REPLACE INTO keypairs '
+                    '(name, public, private, is_default) VALUES (?, ?, ?, ?)',
+                    (name, keypair['public'], keypair['private'],
+                     keypair.get('default', False) and 1 or 0))
+                self.db.executemany(
+                    'DELETE FROM machine_keys WHERE backend_id = ? AND '
+                    'machine_id = ? AND key_name = ?',
+                    [pair + (name,) for pair in known - machines])
+                self.db.executemany(
+                    'INSERT OR IGNORE INTO machine_keys '
+                    '(backend_id, machine_id, key_name) VALUES (?, ?, ?)',
+                    [pair + (name,) for pair in machines - known])
+            self.pairs[name] = machines
+
+    def delete_keypair(self, name):
+        with self.lock:
+            with self.db:
+                self.db.execute('DELETE FROM keypairs WHERE name = ?',
+                                (name,))
+                self.db.execute('DELETE FROM machine_keys WHERE key_name = ?',
+                                (name,))
+                self.write_default()
+            self.pairs.pop(name, None)
+
+    def set_default_keypair(self, name):
+        with self.lock:
+            with self.db:
+                self.write_default()
+
+    def write_backend(self, backend_id):
+        self.db.execute(
+            'INSERT OR REPLACE INTO backends (id, data) VALUES (?, ?)',
+            (backend_id, json.dumps(self.settings['backends'][backend_id])))
+
+    def write_keypair(self, name):
+        keypair = self.settings['keypairs'][name]
+        self.db.execute(
+            'INSERT INTO keypairs (name, public, private, is_default) '
+            'VALUES (?, ?, ?, ?)',
+            (name, keypair['public'], keypair['private'],
+             keypair.get('default', False) and 1 or 0))
+        pairs = set()
+        for machine in keypair.get('machines', None) or []:
+            try:
+                pairs.add((machine[0], machine[1]))
+            except (IndexError, TypeError):
+                continue
+        self.db.executemany(
+            'INSERT OR IGNORE INTO machine_keys '
+            '(backend_id, machine_id, key_name) VALUES (?, ?, ?)',
+            [pair + (name,) for pair in pairs])
+        self.pairs[name] = pairs
+
+    def write_default(self):
+        """Marks the keypair that is default in settings, and only that."""
+        self.db.execute('UPDATE keypairs SET is_default = 0')
+        for name, keypair in self.settings['keypairs'].items():
+            if keypair.get('default', False):
+                self.db.execute(
+                    'UPDATE keypairs SET is_default = 1 WHERE name = ?',
+                    (name,))
+
+
+def open_store(settings):
+    """Returns the storage engine chosen in settings['storage']."""
+    if settings['storage'] == 'sqlite':
+        return SQLiteStore(settings, settings['sqlite_path'])
+    return YAMLStore(settings)
+
+
+def refresh_store(event):
+    """Subscriber of NewRequest, so that views see what other workers
+    stored."""
+    store = getattr(event.request.registry, 'store', None)
+    if store:
+        store.refresh()
+
+
+def get_store(request):
+    """Returns the storage engine of the app, YAMLStore if there is none."""
+    store = getattr(request.registry, 'store', None)
+    return store or YAMLStore(request.registry.settings)
@@ -1,4 +1,5 @@
 """Testing module"""
+import os
 import unittest
 from pyramid import testing
 
@@ -17,3 +18,342 @@ class ViewTests(unittest.TestCase):
         request = testing.DummyRequest()
         info = home(request)
         self.assertEqual(info['project'], 'mist.io')
+
+
+class FakeChannel(object):
+    def close(self):
+        pass
+
+
+class FakeTransport(object):
+    def __init__(self):
+        self.active = True
+
+    def is_active(self):
+        return self.active
+
+    def send_ignore(self):
+        pass
+
+    def open_session(self):
+        return FakeChannel()
+
+
+class FakeClient(object):
+    def __init__(self):
+        self.transport = FakeTransport()
+        self.closed = False
+
+    def get_transport(self):
+        return self.transport
+
+    def close(self):
+        self.closed = True
+        self.transport.active = False
+
+
+class SSHPoolTests(unittest.TestCase):
+    """Connections in use are never closed by the pool"""
+    def setUp(self):
+        from mist.io.ssh import SSHPool
+        self.pool = SSHPool(max_connections=1, idle_timeout=60)
+        self.pool.get_key = lambda private_key: (None, private_key)
+        self.clients = []
+
+        def connect(host, user, key):
+            client = FakeClient()
+            self.clients.append(client)
+            return client
+        self.pool.connect = connect
+
+    def test_reuse(self):
+        """A second channel to a host shares its connection"""
+        first = self.pool.open('host', 'root', 'key')
+        second = self.pool.open('host', 'root', 'key')
+        self.assertEqual(len(self.clients), 1)
+        self.assertEqual(self.pool.channels[first]['users'], 2)
+        self.pool.close(first)
+        self.pool.close(second)
+        self.assertEqual(self.pool.connections.values()[0]['users'], 0)
+        self.assertFalse(self.clients[0].closed)
+
+    def test_no_eviction_in_use(self):
+        """A full pool doesn't evict a connection with channels open"""
+        channel = self.pool.open('host1', 'root', 'key')
+        other = self.pool.open('host2', 'root', 'key')
+        self.assertFalse(self.clients[0].closed)
+        self.assertEqual(len(self.pool.connections), 2)
+        self.pool.close(other)
+        self.pool.close(channel)
+        # once idle it makes room for the next one
+        self.pool.close(self.pool.open('host3', 'root', 'key'))
+        self.assertTrue(self.clients[0].closed or self.clients[1].closed)
+        self.assertEqual(len(self.pool.connections), 2)
+
+    def test_reap(self):
+        """Only idle connections without channels are reaped"""
+        from time import time
+        channel = self.pool.open('host', 'root', 'key')
+        self.pool.reap(time() + 120)
+        self.assertFalse(self.clients[0].closed)
+        self.pool.close(channel)
+        self.pool.reap(time() + 120)
+        self.assertTrue(self.clients[0].closed)
+        self.assertEqual(self.pool.connections, {})
+
+    def test_drop_in_use(self):
+        """A dropped connection is closed with its last channel"""
+        channel = self.pool.open('host', 'root', 'key')
+        self.pool.drop(('host', 'root', 'key'))
+        self.assertFalse(self.clients[0].closed)
+        self.pool.close(self.pool.open('host', 'root', 'key'))
+        self.assertEqual(len(self.clients), 2)
+        self.pool.close(channel)
+        self.assertTrue(self.clients[0].closed)
+        self.assertFalse(self.clients[1].closed)
+
+    def test_dead_connection(self):
+        """A dead pooled connection is replaced, not handed out"""
+        self.pool.close(self.pool.open('host', 'root', 'key'))
+        self.clients[0].transport.active = False
+        channel = self.pool.open('host', 'root', 'key')
+        self.assertEqual(len(self.clients), 2)
+        self.assertTrue(self.clients[0].closed)
+        self.assertTrue(self.pool.channels[channel]['client']
+                        is self.clients[1])
+
+
+class StoreTests(unittest.TestCase):
+    """Backends and keypairs survive a round trip through each store"""
+    def setUp(self):
+        import tempfile
+        from mist.io import store
+        from mist.io.helpers import SettingsWriter
+        self.directory = tempfile.mkdtemp()
+        self.writer = SettingsWriter(os.path.join(self.directory,
+                                                  'settings.yaml'))
+        self.shared_writer = store.settings_writer
+        store.settings_writer = self.writer
+
+    def tearDown(self):
+        import shutil
+        from mist.io import store
+        store.settings_writer = self.shared_writer
+        shutil.rmtree(self.directory)
+
+    def get_settings(self):
+        return {'keypairs': {}, 'backends': {}, 'core_uri': '',
+                'js_build': True, 'js_log_level': 3}
+
+    def add(self, settings):
+        backend = {'title': 'EC2', 'provider': 2, 'apikey': 'key',
+                   'apisecret': 'secret', 'region': '', 'enabled': True}
+        keypair = {'public': u'ssh-rsa AAAA', 'private': u'PRIVATE',
+                   'machines': [['backend', 'machine']], 'default': True}
+        settings['backends']['backend'] = backend
+        settings['keypairs']['key'] = keypair
+        return backend, keypair
+
+    def test_yaml(self):
+        from mist.io.helpers import read_settings
+        from mist.io.store import YAMLStore
+        settings = self.get_settings()
+        backend, keypair = self.add(settings)
+        store = YAMLStore(settings)
+        store.save_backend('backend')
+        store.save_keypair('key')
+        self.assertTrue(self.writer.flush())
+
+        stored = read_settings(self.writer.path,
+                               os.path.join(self.directory, '.cache'))
+        self.assertEqual(stored['backends'], {'backend': backend})
+        self.assertEqual(stored['keypairs'], {'key': keypair})
+
+    def test_sqlite(self):
+        from mist.io.store import SQLiteStore
+        path = os.path.join(self.directory, 'mist.db')
+        store = SQLiteStore(self.get_settings(), path)
+        backend, keypair = self.add(store.settings)
+        store.save_backend('backend')
+        store.save_keypair('key')
+
+        settings = self.get_settings()
+        SQLiteStore(settings, path)
+        self.assertEqual(settings['backends'], {'backend': backend})
+        self.assertEqual(settings['keypairs'], {'key': keypair})
+
+        # dropping an association only drops that one
+        keypair['machines'] = [['backend', 'other']]
+        store.save_keypair('key')
+        SQLiteStore(settings, path)
+        self.assertEqual(settings['keypairs']['key']['machines'],
+                         [['backend', 'other']])
+
+    def test_sqlite_workers(self):
+        """Workers sharing the database keep each other's associations"""
+        from mist.io.store import SQLiteStore
+        path = os.path.join(self.directory, 'mist.db')
+        first = SQLiteStore(self.get_settings(), path)
+        self.add(first.settings)
+        first.save_backend('backend')
+        first.save_keypair('key')
+        second = SQLiteStore(self.get_settings(), path)
+
+        first.settings['keypairs']['key']['machines'].append(['backend', 'a'])
+        first.save_keypair('key')
+        second.settings['keypairs']['key']['machines'].append(['backend', 'b'])
+        second.save_keypair('key')
+
+        first.refresh()
+        self.assertEqual(first.settings['keypairs']['key']['machines'],
+                         [['backend', 'machine'], ['backend', 'a'],
+                          ['backend', 'b']])
+
+        second.settings['backends']['other'] = {'title': 'Linode'}
+        second.save_backend('other')
+        first.refresh()
+        self.assertEqual(first.settings['backends']['other'],
+                         {'title': 'Linode'})
+
+
+class MachineJobsTests(unittest.TestCase):
+    """Create jobs wait for their provider without holding a worker"""
+    def setUp(self):
+        import threading
+        from mist.io.jobs import MachineJobs
+        self.jobs = MachineJobs(workers=3, queue_size=10)
+        self.release = threading.Event()
+        self.started = []
+
+    def tearDown(self):
+        self.release.set()
+
+    def block(self, job):
+        self.started.append(job.id)
+        self.release.wait(5)
+        return job.id
+
+    def wait(self, job):
+        from time import sleep
+        for attempt in range(100):
+            if job.finished:
+                return True
+            sleep(0.05)
+        return False
+
+    def test_provider_slots(self):
+        """Create jobs past the provider's limit wait, other jobs run"""
+        from libcloud.compute.types import Provider
+        from mist.io.config import MACHINE_CREATE_CONCURRENCY_PROVIDERS
+        limit = MACHINE_CREATE_CONCURRENCY_PROVIDERS[Provider.LINODE]
+        creates = [self.jobs.submit('backend', 'create', self.block,
+                                    name='m%d' % i, provider=Provider.LINODE)
+                   for i in range(limit + 1)]
+        # a worker is still free for another action
+        reboot = self.jobs.submit('backend', 'reboot', lambda job: 'ok')
+        self.assertTrue(self.wait(reboot))
+        self.assertEqual(reboot.result, 'ok')
+        self.assertEqual(len(self.started), limit)
+        self.assertEqual(creates[-1].status, 'queued')
+
+        self.release.set()
+        for job in creates:
+            self.assertTrue(self.wait(job))
+            self.assertEqual(job.result, job.id)
+        self.assertEqual(self.jobs.running[Provider.LINODE], 0)
+
+    def test_busy(self):
+        """Jobs past the queue size are refused"""
+        from libcloud.compute.types import Provider
+        from mist.io.config import MACHINE_CREATE_CONCURRENCY_PROVIDERS
+        from mist.io.jobs import JobsBusy
+        from mist.io.jobs import MachineJobs
+        jobs = MachineJobs(workers=3, queue_size=2)
+        limit = MACHINE_CREATE_CONCURRENCY_PROVIDERS[Provider.LINODE]
+        for i in range(limit + 2):
+            jobs.submit('backend', 'create', self.block,
+                        name='m%d' % i, provider=Provider.LINODE)
+        self.assertRaises(JobsBusy, jobs.submit, 'backend', 'create',
+                          self.block, name='m', provider=Provider.LINODE)
+
+    def test_failed(self):
+        """A failed job records its error"""
+        def fail(job):
+            raise Exception('no luck')
+        job = self.jobs.submit('backend', 'destroy', fail, machine_id='m')
+        self.assertTrue(self.wait(job))
+        self.assertEqual(job.status, 'failed')
+        self.assertEqual(job.error, 'no luck')
+
+
+class FakeEC2Connection(object):
+    def __init__(self, fail):
+        self.fail = fail
+        self.calls = []
+
+    def request(self, path, params):
+        self.calls.append(params)
+        if self.fail:
+            raise Exception('InvalidInstanceID')
+
+
+class FakeEC2Driver(object):
+    """Just enough of libcloud's EC2 driver for machine actions"""
+    path = '/'
+
+    def __init__(self, fail=False, broken=()):
+        from libcloud.compute.types import Provider
+        self.type = Provider.EC2
+        self.connection = FakeEC2Connection(fail)
+        self.broken = broken
+        self.rebooted = []
+
+    def reboot_node(self, node):
+        if node.id in self.broken:
+            raise Exception('InvalidInstanceID')
+        self.rebooted.append(node.id)
+
+
+class MachineActionsTests(unittest.TestCase):
+    """EC2 machines take one call, falling back to one call each"""
+    def test_batch(self):
+        from mist.io.helpers import ec2_machine_actions
+        conn = FakeEC2Driver()
+        results = ec2_machine_actions(conn, ['i-1', 'i-2'], 'reboot')
+        self.assertEqual(results, {'i-1': None, 'i-2': None})
+        self.assertEqual(conn.connection.calls,
+                         [{'Action': 'RebootInstances',
+                           'InstanceId.1': 'i-1',
+                           'InstanceId.2': 'i-2'}])
+        self.assertEqual(conn.rebooted, [])
+
+    def test_fallback(self):
+        from mist.io.helpers import ec2_machine_actions
+        conn = FakeEC2Driver(fail=True, broken=['i-2'])
+        results = ec2_machine_actions(conn, ['i-1', 'i-2'], 'reboot')
+        self.assertEqual(results['i-1'], None)
+        self.assertTrue(isinstance(results['i-2'], Exception))
+        self.assertEqual(conn.rebooted, ['i-1'])
+
+    def test_outcomes(self):
+        from contextlib import contextmanager
+        from mist.io import helpers
+        conn = FakeEC2Driver(fail=True, broken=['i-2'])
+
+        @contextmanager
+        def get_connection(backend_id, backend):
+            yield conn
+
+        original = helpers.get_connection
+        helpers.get_connection = get_connection
+        try:
+            outcomes = helpers.backend_machine_actions('backend', {},
+                                                       ['i-1', 'i-2'],
+                                                       'reboot')
+        finally:
+            helpers.get_connection = original
+        self.assertEqual(outcomes,
+                         [{'backend': 'backend', 'machine': 'i-1',
+                           'status': 'ok'},
+                          {'backend': 'backend', 'machine': 'i-2',
+                           'status': 'error', 'error': 'InvalidInstanceID'}])
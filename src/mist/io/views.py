@@ -1,16 +1,18 @@
 """mist.io views"""
 import os
+import json
 import tempfile
 import logging
+import threading
 
+from time import time
+from Queue import Queue, Empty
 from datetime import datetime
 
 import requests
 
 from hashlib import sha256
 
-from Crypto.PublicKey import RSA
-
 from pyramid.response import Response
 from pyramid.view import view_config
 
@@ -22,24 +24,37 @@ from libcloud.compute.base import NodeAuthSSHKey
 from libcloud.compute.deployment import MultiStepDeployment, ScriptDeployment, SSHKeyDeployment
 from libcloud.compute.types import Provider
 
-from mist.io.config import STATES
-from mist.io.config import EC2_IMAGES
 from mist.io.config import EC2_PROVIDERS
 from mist.io.config import EC2_KEY_NAME
 from mist.io.config import EC2_SECURITYGROUP
-from mist.io.config import LINODE_DATACENTERS
 from mist.io.config import SUPPORTED_PROVIDERS
-
-from mist.io.helpers import connect
-from mist.io.helpers import get_machine_actions
-from mist.io.helpers import import_key, get_keypair, get_keypair_by_name
-from mist.io.helpers import create_security_group
-from mist.io.helpers import run_command
+from mist.io.config import EVENTS_STREAM_TIMEOUT, EVENTS_KEEPALIVE
+from mist.io.config import BACKEND_TIMEOUT, IMAGES_PAGE_SIZE
+from mist.io.config import COMMAND_TIMEOUT
+from mist.io.config import SSH_BATCH_CONCURRENCY, SHELL_MAX_TIMEOUT
+from mist.io.config import MACHINE_CREATE_MAX, EC2_BATCH_ACTIONS
+from mist.io.config import MACHINE_ACTIONS_CONCURRENCY
+
+from mist.io.helpers import connect, evict_driver, get_connection
+from mist.io.helpers import get_backend
+from mist.io.helpers import get_machines, expire_inventory, find_node
+from mist.io.helpers import get_keypair, get_keypair_by_name
+from mist.io.helpers import get_keypair_index
+from mist.io.helpers import ensure_key, ensure_security_group
+from mist.io.helpers import forget_provisioned, add_keypair_machines
+from mist.io.helpers import store_keypair
+from mist.io.helpers import run_command, run_commands, stream_commands
+from mist.io.helpers import get_machine_host, get_machine_user
+from mist.io.helpers import backend_machine_actions, machine_action
 try:
     from mist.core.helpers import save_keypairs
 except ImportError:
     from mist.io.helpers import save_keypairs
 from mist.io.helpers import save_settings
+from mist.io.store import get_store
+from mist.io.poller import Subscription
+from mist.io.jobs import JobsBusy
+from mist.io import keygen
 
 
 log = logging.getLogger('mist.io')
@@ -128,8 +143,11 @@ def add_backend(request, renderer='json'):
                'enabled': 1,
               }
 
+    if backend_id in request.registry.settings['backends']:
+        # added again, e.g. with a new secret
+        evict_driver(backend_id)
     request.registry.settings['backends'][backend_id] = backend
-    save_settings(request)
+    get_store(request).save_backend(backend_id)
 
     ret = {'id'           : backend_id,
            'apikey'       : backend['apikey'],
@@ -145,8 +163,16 @@ def add_backend(request, renderer='json'):
 
 @view_config(route_name='backend_action', request_method='DELETE', renderer='json')
 def delete_backend(request, renderer='json'):
-    request.registry.settings['backends'].pop(request.matchdict['backend'])
-    save_settings(request)
+    backend_id = request.matchdict['backend']
+    backend = request.registry.settings['backends'].pop(backend_id)
+    evict_driver(backend_id)
+    request.registry.image_catalog.forget(backend)
+    request.registry.sizes.forget(backend)
+    request.registry.locations.forget(backend)
+    poller = getattr(request.registry, 'poller', None)
+    if poller:
+        poller.forget(backend_id)
+    get_store(request).delete_backend(backend_id)
 
     return Response('OK', 200)
 
@@ -155,18 +181,40 @@ def delete_backend(request, renderer='json'):
 def list_machines(request):
     """Gets machines and their metadata for a backend.
 
-    Because each provider stores metadata in different places several checks
-    are needed.
-
-    The folowing are considered:::
+    Backends configured in settings are served from the snapshot of the
+    inventory poller, so that the provider is polled once per poll_interval
+    no matter how many clients are watching. Backends that live in a
+    session are listed directly. Check helpers.get_machines for the format.
+    Machines still being created are listed too, see create_machine.
 
-        * For tags, Rackspace stores them in extra.metadata.tags while EC2 in
-          extra.tags.tags.
-        * For images, both EC2 and Rackpace have an image and an etra.imageId
-          attribute
-        * For flavors, EC2 has an extra.instancetype attribute while Rackspace
-          an extra.flavorId. however we also expect to get size attribute.
+    Pass a version as since to get only what changed after it, along with
+    the current version. If nothing changed the response is a 304. Check
+    InventoryPoller.get_changes for the format. Backends not handled by the
+    poller ignore since and always return the full list.
     """
+    backend_id = request.matchdict['backend']
+    poller = getattr(request.registry, 'poller', None)
+
+    since = request.params.get('since', None)
+    if since is not None:
+        try:
+            since = int(since)
+        except ValueError:
+            return Response('Invalid version', 400)
+
+    if poller and not 'beaker.session' in request.environ:
+        try:
+            if since is None:
+                return poller.get_machines(backend_id)
+            changes = poller.get_changes(backend_id, since)
+            if changes is None:
+                return Response(status=304)
+            return changes
+        except KeyError:
+            return Response('Backend not found', 404)
+        except:
+            return Response('Backend unavailable', 503)
+
     try:
         conn = connect(request)
     except RuntimeError as e:
@@ -176,44 +224,138 @@ def list_machines(request):
         return Response('Backend not found', 404)
 
     try:
-        machines = conn.list_nodes()
+        machines = get_machines(conn)
     except:
+        evict_driver(backend_id)
         return Response('Backend unavailable', 503)
+    return machines + request.registry.machine_jobs.get_pending(backend_id)
+
+
+@view_config(route_name='all_machines', request_method='GET', renderer='json')
+def list_all_machines(request):
+    """Gets the machines of all enabled backends at once.
+
+    Backends are queried concurrently on the backend worker pool, so this
+    takes as long as the slowest backend instead of all of them together.
+    Backends that don't answer within BACKEND_TIMEOUT seconds of their own,
+    counted from when a worker picks them up, are reported with a timeout
+    status and left to finish in the background, so the results may be
+    partial. Returns a dict with a status of ok, error,
+    timeout or disabled and the machines of each backend.
+    """
+    try:
+        backends = request.environ['beaker.session']['backends']
+    except:
+        backends = request.registry.settings['backends']
+
+    poller = getattr(request.registry, 'poller', None)
+    if 'beaker.session' in request.environ:
+        poller = None
+
+    def list_backend(backend_id, backend):
+        if poller:
+            return poller.get_machines(backend_id)
+        try:
+            with get_connection(backend_id, backend) as conn:
+                machines = get_machines(conn)
+        except:
+            evict_driver(backend_id)
+            raise
+        return machines + request.registry.machine_jobs.get_pending(backend_id)
+
+    ret = {}
+    jobs = {}
+    for backend_id, backend in backends.items():
+        if not backend.get('enabled', True):
+            ret[backend_id] = {'status': 'disabled', 'machines': []}
+        else:
+            jobs[backend_id] = request.registry.backend_pool.submit(
+                list_backend, backend_id, backend)
+
+    for backend_id, job in jobs.items():
+        if not job.wait_running(BACKEND_TIMEOUT, BACKEND_TIMEOUT):
+            ret[backend_id] = {'status': 'timeout', 'machines': []}
+        elif job.error:
+            ret[backend_id] = {'status': 'error',
+                               'error': str(job.error),
+                               'machines': []}
+        else:
+            ret[backend_id] = {'status': 'ok', 'machines': job.result}
 
-    ret = []
-    for m in machines:
-        tags = m.extra.get('tags', None) or m.extra.get('metadata', None)
-        tags = tags or {}
-        tags = [value for key, value in tags.iteritems() if key != 'Name']
-
-        if m.extra.get('availability', None):
-            # for EC2
-            tags.append(m.extra['availability'])
-        elif m.extra.get('DATACENTERID', None):
-            # for Linode
-            tags.append(LINODE_DATACENTERS[m.extra['DATACENTERID']])
-
-        image_id = m.image or m.extra.get('imageId', None)
-
-        size = m.size or m.extra.get('flavorId', None)
-        size = size or m.extra.get('instancetype', None)
-
-        machine = {'id'            : m.id,
-                   'uuid'          : m.get_uuid(),
-                   'name'          : m.name,
-                   'imageId'       : image_id,
-                   'size'          : size,
-                   'state'         : STATES[m.state],
-                   'private_ips'   : m.private_ips,
-                   'public_ips'    : m.public_ips,
-                   'tags'          : tags,
-                   'extra'         : m.extra,
-                  }
-        machine.update(get_machine_actions(m, conn))
-        ret.append(machine)
     return ret
 
 
+@view_config(route_name='events', request_method='GET')
+def stream_machine_events(request):
+    """Streams the machine changes of backends as server-sent events.
+
+    The backends to watch and the versions the client already has are given
+    as since, e.g. since=<backend_id>:<version>,<backend_id>:<version>. One
+    stream serves all backends, since browsers only open a few connections
+    per host.
+
+    Each time the inventory poller finds changes in a backend a 'changes'
+    event is sent, with the same payload as list_machines with since plus
+    the backend id. The event id holds the updated versions of all backends,
+    and browsers send it back as Last-Event-ID when they reconnect. A backend
+    that fails gets a 'failure' event and is dropped from the stream.
+
+    A stream only lasts EVENTS_STREAM_TIMEOUT seconds and the browser
+    reconnects afterwards, so an idle subscriber never holds a server thread
+    for good. Dead clients are noticed by the keepalive comments. At most
+    events_max_subscribers streams are served, a share of the server threads
+    only, and extra ones get a 503. Backends not handled by the poller get a
+    501. In both cases clients should fall back to polling.
+    """
+    poller = getattr(request.registry, 'poller', None)
+
+    if not poller or 'beaker.session' in request.environ:
+        return Response('Events not supported for these backends', 501)
+
+    cursor = request.headers.get('Last-Event-ID',
+                                 request.params.get('since', ''))
+    try:
+        cursors = dict((backend_id, int(version)) for backend_id, version
+                       in [pair.split(':') for pair in cursor.split(',')])
+    except ValueError:
+        return Response('Invalid versions', 400)
+
+    def format_cursors(cursors):
+        return ','.join(['%s:%s' % pair for pair in cursors.iteritems()])
+
+    def stream(cursors):
+        deadline = time() + EVENTS_STREAM_TIMEOUT
+        # ask the browser to reconnect right after the stream ends
+        yield 'retry: 1000\n\n'
+        while cursors and time() < deadline:
+            timeout = min(EVENTS_KEEPALIVE, deadline - time())
+            changes = poller.wait_for_changes(cursors, timeout)
+            if not changes:
+                yield ': keepalive\n\n'
+                continue
+            for backend_id, backend_changes in changes.iteritems():
+                if isinstance(backend_changes, Exception):
+                    cursors.pop(backend_id)
+                    yield 'id: %s\nevent: failure\ndata: %s\n\n' % (
+                          format_cursors(cursors),
+                          json.dumps({'backend': backend_id,
+                                      'error': str(backend_changes)}))
+                else:
+                    cursors[backend_id] = backend_changes['version']
+                    backend_changes['backend'] = backend_id
+                    yield 'id: %s\nevent: changes\ndata: %s\n\n' % (
+                          format_cursors(cursors),
+                          json.dumps(backend_changes))
+
+    if not poller.subscribe():
+        return Response('Too many subscribers', 503)
+
+    response = Response(content_type='text/event-stream',
+                        app_iter=Subscription(poller, stream(cursors)))
+    response.headers['Cache-Control'] = 'no-cache'
+    return response
+
+
 @view_config(route_name='machines', request_method='POST', renderer='json')
 def create_machine(request):
     """Creates a new virtual machine on the specified backend.
@@ -234,6 +376,20 @@ def create_machine(request):
     liblcoud doesn't support linode.config.list at the moment, so no way to
     get them. Also, it will create inconsistencies for machines created
     through mist.io and those from the Linode interface.
+
+    Creating takes minutes, so only the request is checked here and the rest
+    runs as a machine job, see deploy_machine. The response is a 202 with the
+    job, whose id is also the id of the pending machine listed until the
+    job is done. Follow it with GET /jobs/{id}.
+
+    Pass count, or a list of names instead of name, to create many machines
+    alike, e.g. a cluster. The backend, location and keypair are looked up
+    once, the EC2 key and security group are provisioned once, and every
+    machine gets its own job, run alongside the rest up to the provider's
+    limit, see jobs.MachineJobs. The keypair is associated with each new
+    machine as soon as its job ends, and stored once the last job ends. The
+    response then has the jobs, and the names that couldn't be queued under
+    errors.
     """
 
     try:
@@ -258,14 +414,10 @@ def create_machine(request):
     else:
         keypair = get_keypair(keypairs)      
 
-    if keypair:
-        private_key = keypair['private']
-        public_key = keypair['public']
-    else:
-        private_key = public_key = None
-
     try:
-        machine_name = request.json_body['name']
+        machine_name = request.json_body.get('name', None)
+        names = request.json_body.get('names', None)
+        count = int(request.json_body.get('count', 0))
         location_id = request.json_body['location']
         image_id = request.json_body['image']
         size_id = request.json_body['size']
@@ -277,42 +429,158 @@ def create_machine(request):
     except Exception as e:
         return Response('Invalid payload', 400)
 
+    # many machines at once, named explicitly or after name
+    bulk = bool(names or count)
+    if names:
+        if not isinstance(names, list) or not all(names):
+            return Response('Invalid names', 400)
+        names = [unicode(name) for name in names]
+    elif not machine_name:
+        return Response('Invalid payload', 400)
+    elif count > 1:
+        names = ['%s-%d' % (machine_name, i + 1) for i in range(count)]
+    else:
+        names = [machine_name]
+    if len(names) > MACHINE_CREATE_MAX:
+        return Response('Too many machines, at most %d at once'
+                        % MACHINE_CREATE_MAX, 400)
+
     size = NodeSize(size_id, name='', ram='', disk=disk, bandwidth='',
                     price='', driver=conn)
     image = NodeImage(image_id, name='', extra=image_extra, driver=conn)
 
     if conn.type in EC2_PROVIDERS:
-        locations = conn.list_locations()
-        for loc in locations:
-            if loc.id == location_id:
-                location = loc
-                break
+        # EC2 needs the availability zone, get it from the cached locations
+        location = None
+        try:
+            backend = get_backend(request)
+            locations = request.registry.locations.get(backend_id, backend)
+            for loc in locations:
+                if loc.id == location_id:
+                    location = loc
+                    break
+            if not location:
+                # maybe a new one, check again with the provider
+                locations = request.registry.locations.refresh(backend_id,
+                                                               backend)
+                for loc in locations:
+                    if loc.id == location_id:
+                        location = loc
+                        break
+        except:
+            return Response('Backend unavailable', 503)
+        if not location:
+            return Response('Location not found', 404)
     else:
         location = NodeLocation(location_id, name='', country='', driver=conn)
-    
+
+    # the jobs run after the response went out, they can't use request, nor
+    # its driver as they run at the same time
+    registry = request.registry
+    backend = get_backend(request)
+    keypair_name = key_name or get_keypair_index(keypairs).get_name(keypair)
+
+    # every machine is associated as soon as its job is done, the keypair is
+    # stored once, by the last job of the batch to finish
+    batch = {'pending': len(names), 'associated': False}
+    batch_lock = threading.Lock()
+
+    def finish(associated):
+        with batch_lock:
+            batch['pending'] -= 1
+            batch['associated'] = batch['associated'] or associated
+            if batch['pending'] or not batch['associated']:
+                return
+        store_keypair(registry, keypair_name)
+
+    def create(job):
+        associated = False
+        try:
+            with get_connection(backend_id, backend) as conn:
+                machine = deploy_machine(job, conn, backend_id, job.name,
+                                         image, size, location, script,
+                                         keypair, key_name)
+                deployed = keypair_name and deploys_key(conn, keypair)
+            if deployed:
+                job.progress('associating key')
+                add_keypair_machines(registry, keypair_name,
+                                     [[backend_id, machine['id']]],
+                                     save=False)
+                associated = True
+        finally:
+            finish(associated)
+        return machine
+
+    jobs = []
+    errors = []
+    for name in names:
+        try:
+            job = request.registry.machine_jobs.submit(backend_id, 'create',
+                                                       create, name=name,
+                                                       provider=conn.type)
+            jobs.append(job.to_dict())
+        except JobsBusy as e:
+            errors.append({'name': name, 'error': str(e)})
+            finish(False)
+
+    if not jobs:
+        return Response('Service unavailable: %s' % errors[0]['error'], 503)
+    request.response.status_int = 202
+    if not bulk:
+        return jobs[0]
+    return {'jobs': jobs, 'errors': errors}
+
+
+def submit_machine_job(request, backend_id, action, func, machine_id=None,
+                       name=None):
+    """Queues func as a machine job and sets the response status to 202.
+
+    Returns the MachineJob, or a 503 Response if too many jobs are queued.
+    """
+    try:
+        job = request.registry.machine_jobs.submit(backend_id, action, func,
+                                                   machine_id, name)
+    except JobsBusy as e:
+        return Response('Service unavailable: %s' % e, 503)
+    request.response.status_int = 202
+    return job
+
+
+def deploy_machine(job, conn, backend_id, machine_name, image, size,
+                   location, script, keypair, key_name):
+    """Creates a machine and deploys the keypair and script to it.
+
+    Runs as a machine job, since deploying waits for the machine to boot and
+    the script to finish. Reports its stages to job and raises on failure.
+    Returns the new machine ready for json. Associating the keypair with it
+    is left to the caller, see deploys_key.
+    """
+    if keypair:
+        private_key = keypair['private']
+        public_key = keypair['public']
+    else:
+        private_key = public_key = None
+
     if conn.type in [Provider.RACKSPACE_FIRST_GEN, Provider.RACKSPACE] and\
     public_key:
         key = SSHKeyDeployment(str(public_key))
         deploy_script = ScriptDeployment(script)
-        msd = MultiStepDeployment([key, deploy_script])        
+        msd = MultiStepDeployment([key, deploy_script])
+        job.progress('deploying')
         try:
             node = conn.deploy_node(name=machine_name,
                              image=image,
                              size=size,
                              location=location,
                              deploy=msd)
-            if keypair:
-                machines = keypair.get('machines', None)
-                if machines and len(machines):
-                    keypair['machines'].append([backend_id, node.id])
-                else:
-                    keypair['machines'] = [[backend_id, node.id],]
-                save_keypairs(request, keypair)
         except Exception as e:
-            return Response('Something went wrong with node creation in RackSpace: %s' % e, 500)
+            raise Exception('Something went wrong with node creation in RackSpace: %s' % e)
     elif conn.type in EC2_PROVIDERS and public_key:
-        imported_key = import_key(conn, public_key, key_name)
-        created_security_group = create_security_group(conn, EC2_SECURITYGROUP)
+        job.progress('provisioning')
+        if not ensure_key(backend_id, conn, public_key, key_name):
+            raise Exception('Failed to import key in EC2')
+        if not ensure_security_group(backend_id, conn, EC2_SECURITYGROUP):
+            raise Exception('Failed to create security group in EC2')
         deploy_script = ScriptDeployment(script)
 
         (tmp_key, tmp_key_path) = tempfile.mkstemp()
@@ -320,34 +588,30 @@ def create_machine(request):
         key_fd.write(private_key)
         key_fd.close()
         #deploy_node wants path for ssh private key
-        if imported_key and created_security_group:
-            try:
-                node = conn.deploy_node(name=machine_name,
-                                 image=image,
-                                 size=size,
-                                 deploy=deploy_script,
-                                 location=location,
-                                 ssh_key=tmp_key_path,
-                                 ex_keyname=key_name,
-                                 ex_securitygroup=EC2_SECURITYGROUP['name'])
-
-                if keypair:
-                    machines = keypair.get('machines', None)
-                    if machines and len(machines):
-                        keypair['machines'].append([backend_id, node.id])
-                    else:
-                        keypair['machines'] = [[backend_id, node.id],]
-                    save_keypairs(request, keypair)
-            except Exception as e:
-                return Response('Something went wrong with node creation in EC2: %s' % e, 500)
-        #remove temp file with private key
+        job.progress('deploying')
         try:
-            os.remove(tmp_key_path)
-        except:
-            pass
+            node = conn.deploy_node(name=machine_name,
+                             image=image,
+                             size=size,
+                             deploy=deploy_script,
+                             location=location,
+                             ssh_key=tmp_key_path,
+                             ex_keyname=key_name,
+                             ex_securitygroup=EC2_SECURITYGROUP['name'])
+        except Exception as e:
+            # maybe the key or the security group is gone, check again
+            forget_provisioned(backend_id, conn)
+            raise Exception('Something went wrong with node creation in EC2: %s' % e)
+        finally:
+            #remove temp file with private key
+            try:
+                os.remove(tmp_key_path)
+            except:
+                pass
     elif conn.type is Provider.LINODE and public_key:
         auth = NodeAuthSSHKey(public_key)
         deploy_script = ScriptDeployment(script)
+        job.progress('creating')
         try:
             node = conn.create_node(name=machine_name,
                              image=image,
@@ -355,24 +619,17 @@ def create_machine(request):
                              deploy=deploy_script,
                              location=location,
                              auth=auth)
-            if keypair:
-                machines = keypair.get('machines', None)
-                if machines and len(machines):
-                    keypair['machines'].append([backend_id, node.id])
-                else:
-                    keypair['machines'] = [[backend_id, node.id],]
-                save_keypairs(request, keypair)
         except:
-            return Response('Something went wrong with Linode creation', 500)
-
+            raise Exception('Something went wrong with Linode creation')
     else:
+        job.progress('creating')
         try:
             node = conn.create_node(name=machine_name,
                              image=image,
                              size=size,
                              location=location)
         except Exception as e:
-            return Response('Something went wrong with generic node creation: %s' % e, 500)
+            raise Exception('Something went wrong with generic node creation: %s' % e)
 
     return {'id': node.id,
             'name': node.name,
@@ -382,6 +639,14 @@ def create_machine(request):
             }
 
 
+def deploys_key(conn, keypair):
+    """Checks if deploy_machine deploys keypair to the machines it creates."""
+    if not keypair or not keypair.get('public', None):
+        return False
+    return conn.type in EC2_PROVIDERS or conn.type in [
+               Provider.RACKSPACE_FIRST_GEN, Provider.RACKSPACE,
+               Provider.LINODE]
+
 
 @view_config(route_name='machine', request_method='POST',
              request_param='action=start', renderer='json')
@@ -409,6 +674,7 @@ def start_machine(request):
     try:
         # In liblcoud it is not possible to call this with machine.start()
         conn.ex_start_node(machine)
+        expire_inventory(request)
         Response('Success', 200)
     except AttributeError:
         return Response('Action not supported for this machine', 404)
@@ -443,6 +709,7 @@ def stop_machine(request):
     try:
         # In libcloud it is not possible to call this with machine.stop()
         conn.ex_stop_node(machine)
+        expire_inventory(request)
         Response('Success', 200)
     except AttributeError:
         return Response('Action not supported for this machine', 404)
@@ -453,45 +720,192 @@ def stop_machine(request):
 @view_config(route_name='machine', request_method='POST',
              request_param='action=reboot', renderer='json')
 def reboot_machine(request):
-    """Reboots a machine on a certain backend."""
-    try:
-        conn = connect(request)
-    except:
-        return Response('Backend not found', 404)
+    """Reboots a machine on a certain backend, as a machine job.
 
+    Answers with a 202 and the job, see create_machine.
+    """
+    backend_id = request.matchdict['backend']
+    backend = get_backend(request)
+    if not backend:
+        return Response('Backend not found', 404)
     machine_id = request.matchdict['machine']
-    machine = Node(machine_id,
-                   name=machine_id,
-                   state=0,
-                   public_ips=[],
-                   private_ips=[],
-                   driver=conn)
 
-    machine.reboot()
+    def reboot(job):
+        job.progress('rebooting')
+        with get_connection(backend_id, backend) as conn:
+            machine_action(conn, machine_id, 'reboot')
 
-    return Response('Success', 200)
+    job = submit_machine_job(request, request.matchdict['backend'], 'reboot',
+                             reboot, machine_id=machine_id)
+    if isinstance(job, Response):
+        return job
+    return job.to_dict()
 
 
 @view_config(route_name='machine', request_method='POST',
              request_param='action=destroy', renderer='json')
 def destroy_machine(request):
-    """Destroys a machine on a certain backend."""
+    """Destroys a machine on a certain backend, as a machine job.
+
+    Answers with a 202 and the job, see create_machine.
+    """
+    backend_id = request.matchdict['backend']
+    backend = get_backend(request)
+    if not backend:
+        return Response('Backend not found', 404)
+    machine_id = request.matchdict['machine']
+
+    def destroy(job):
+        job.progress('destroying')
+        with get_connection(backend_id, backend) as conn:
+            machine_action(conn, machine_id, 'destroy')
+
+    job = submit_machine_job(request, request.matchdict['backend'], 'destroy',
+                             destroy, machine_id=machine_id)
+    if isinstance(job, Response):
+        return job
+    return job.to_dict()
+
+
+@view_config(route_name='machine_actions', request_method='POST',
+             renderer='json')
+def bulk_machine_action(request):
+    """Starts, stops, reboots or destroys many machines at once.
+
+    Expects an action and a list of machines, each a dict with backend and
+    machine. The machines of a backend are handled one after the other on
+    its driver, or with a single API call on EC2, see
+    helpers.backend_machine_actions.
+
+    Reboots and destroys run as a machine job per backend, like those of a
+    single machine, and the response is a 202. Starts and stops run on the
+    backend worker pool, a call per machine, or per backend on EC2, each on
+    a driver of its own. At most MACHINE_ACTIONS_CONCURRENCY calls run at a
+    time, and each one is waited for up to BACKEND_TIMEOUT seconds.
+
+    Returns the jobs, and the backend, machine and status of each machine
+    under machines. Status is as helpers.backend_machine_actions says, or
+    queued along with the job, or timeout if the call didn't end in time and
+    was left to finish in the background. Finished jobs have the statuses
+    of their machines for result.
+    """
     try:
-        conn = connect(request)
+        action = request.json_body['action']
+        machines = request.json_body['machines']
     except:
-        return Response('Backend not found', 404)
+        return Response('Invalid payload', 400)
 
-    machine_id = request.matchdict['machine']
-    machine = Node(machine_id,
-                   name=machine_id,
-                   state=0,
-                   public_ips=[],
-                   private_ips=[],
-                   driver=conn)
+    if not action in EC2_BATCH_ACTIONS:
+        return Response('Invalid action', 400)
+    if not isinstance(machines, list):
+        return Response('Invalid machines', 400)
+
+    selected = {}
+    for machine in machines:
+        if not isinstance(machine, dict) or not machine.get('backend', None) \
+                or not machine.get('machine', None):
+            return Response('Invalid machines', 400)
+        machine_ids = selected.setdefault(machine['backend'], [])
+        if not machine['machine'] in machine_ids:
+            machine_ids.append(machine['machine'])
+
+    def machine_job(backend_id, backend, machine_ids):
+        def run(job):
+            job.progress(action == 'reboot' and 'rebooting' or 'destroying')
+            return backend_machine_actions(backend_id, backend, machine_ids,
+                                           action)
+        return run
 
-    machine.destroy()
+    ret = []
+    jobs = []
+    pending = []
+    for backend_id, machine_ids in selected.items():
+        backend = get_backend(request, backend_id)
+        if not backend:
+            error = 'Backend not found'
+        else:
+            if not action in ('reboot', 'destroy'):
+                pending.append((backend_id, backend, machine_ids))
+                continue
+            try:
+                job = request.registry.machine_jobs.submit(
+                    backend_id, action, machine_job(backend_id, backend,
+                                                    machine_ids))
+            except JobsBusy as e:
+                error = str(e)
+            else:
+                jobs.append(job.to_dict())
+                ret.extend([{'backend': backend_id,
+                             'machine': machine_id,
+                             'status': 'queued',
+                             'job': job.id} for machine_id in machine_ids])
+                continue
+        ret.extend([{'backend': backend_id,
+                     'machine': machine_id,
+                     'status': 'error',
+                     'error': error} for machine_id in machine_ids])
+
+    # starts and stops, EC2 takes a call per backend, the rest a call per
+    # machine, a few calls at once
+    calls = []
+    for backend_id, backend, machine_ids in pending:
+        if backend['provider'] in EC2_PROVIDERS:
+            calls.append((backend_id, backend, machine_ids))
+        else:
+            calls.extend([(backend_id, backend, [machine_id])
+                          for machine_id in machine_ids])
+
+    finished = Queue()
+    running = {}
+    calls.reverse()
+    while calls or running:
+        while calls and len(running) < MACHINE_ACTIONS_CONCURRENCY:
+            backend_id, backend, machine_ids = calls.pop()
+            job = request.registry.backend_pool.submit(
+                backend_machine_actions, backend_id, backend, machine_ids,
+                action)
+            running[job] = (backend_id, machine_ids,
+                            time() + BACKEND_TIMEOUT)
+            job.notify(finished)
+        deadline = min([call[2] for call in running.values()])
+        try:
+            job = finished.get(True, max(0, deadline - time()))
+        except Empty:
+            # calls that ran out of time are left to end in the background
+            now = time()
+            for job, (backend_id, machine_ids, deadline) in running.items():
+                if deadline <= now:
+                    del running[job]
+                    ret.extend([{'backend': backend_id,
+                                 'machine': machine_id,
+                                 'status': 'timeout'}
+                                for machine_id in machine_ids])
+            continue
+        if not job in running:
+            continue
+        backend_id, machine_ids, deadline = running.pop(job)
+        expire_inventory(request, backend_id)
+        if job.error:
+            ret.extend([{'backend': backend_id,
+                         'machine': machine_id,
+                         'status': 'error',
+                         'error': str(job.error)}
+                        for machine_id in machine_ids])
+        else:
+            ret.extend(job.result)
+
+    if jobs:
+        request.response.status_int = 202
+    return {'machines': ret, 'jobs': jobs}
 
-    return Response('Success', 200)
+
+@view_config(route_name='job', request_method='GET', renderer='json')
+def get_job(request):
+    """Gets the status of a machine job, check jobs.MachineJob.to_dict."""
+    job = request.registry.machine_jobs.get(request.matchdict['job'])
+    if not job:
+        return Response('Job not found', 404)
+    return job.to_dict()
 
 
 @view_config(route_name='machine_metadata', request_method='POST',
@@ -504,6 +918,10 @@ def set_machine_metadata(request):
 
     machine_id comes as u'...' but the rest are plain strings so use == when
     comparing in ifs. u'f' is 'f' returns false and 'in' is too broad.
+
+    EC2 tags the machine by id. Elsewhere the machine is asked from the
+    provider alone, see helpers.find_node, instead of listing all machines.
+    Not the inventory snapshot, so that a machine destroyed since is a 404.
     """
     try:
         conn = connect(request)
@@ -536,12 +954,10 @@ def set_machine_metadata(request):
             return Response('Error while creating tag in EC2', 503)
     else:
         try:
-            nodes = conn.list_nodes()
-            for node in nodes:
-                if node.id == machine_id:
-                    machine = node
-                    break
+            machine = find_node(request, conn, machine_id, cached=False)
         except:
+            return Response('Backend unavailable', 503)
+        if not machine:
             return Response('Machine not found', 404)
 
         try:
@@ -550,6 +966,7 @@ def set_machine_metadata(request):
         except:
             return Response('Error while creating tag', 503)
 
+    expire_inventory(request)
     return Response('Success', 200)
 
 
@@ -565,7 +982,10 @@ def delete_machine_metadata(request):
     new list and not delete from the existing.
 
     Mist.io client knows only the value of the tag and not it's key so it
-    has to loop through the machine list in order to find it.
+    has to look the machine up in order to find it, see helpers.find_node.
+    In EC2 the inventory snapshot will do, unless the tag is newer than that.
+    Openstack gets the machine from the provider, as the metadata set
+    replaces all of it and must not drop tags the snapshot is missing.
 
     Don't forget to check string encoding before using them in ifs.
     u'f' is 'f' returns false.
@@ -587,16 +1007,24 @@ def delete_machine_metadata(request):
     machine_id = request.matchdict['machine']
 
     try:
-        nodes = conn.list_nodes()
-        for node in nodes:
-            if node.id == machine_id:
-                machine = node
-                break
+        machine = find_node(request, conn, machine_id,
+                            cached=conn.type in EC2_PROVIDERS)
     except:
+        machine = None
+    if not machine:
         return Response('Machine not found', 404)
 
     if conn.type in EC2_PROVIDERS:
-        tags = machine.extra.get('tags', None)
+        tags = machine.extra.get('tags', None) or {}
+        if not tag in tags.values():
+            # maybe added after the snapshot was taken
+            try:
+                machine = find_node(request, conn, machine_id, cached=False)
+            except:
+                machine = None
+            if not machine:
+                return Response('Machine not found', 404)
+            tags = machine.extra.get('tags', None)
         try:
             for mkey, mdata in tags.iteritems():
                 if tag == mdata:
@@ -624,6 +1052,7 @@ def delete_machine_metadata(request):
         except:
             return Response('Error while updating metadata', 503)
 
+    expire_inventory(request)
     return Response('Success', 200)
 
 
@@ -661,43 +1090,370 @@ def shell_command(request):
     return run_command(conn, machine_id, host, ssh_user, private_key, command)
 
 
-@view_config(route_name='images', request_method='GET', renderer='json')
-def list_images(request):
-    """List images from each backend."""
+@view_config(route_name='machine_sessions', request_method='POST',
+             renderer='json')
+def open_shell_session(request):
+    """Opens an interactive shell on a machine, over ssh.
+
+    Unlike shell_command, the shell stays open, so working directory,
+    environment and the like carry over from command to command. Returns
+    the id of the session, to send input to and read output from. Sessions
+    without input for SHELL_SESSION_IDLE_TIMEOUT seconds are closed, or
+    SHELL_SESSION_WATCHED_TIMEOUT if their output is still read.
+    """
+    backend_id = request.matchdict['backend']
+    machine_id = request.matchdict['machine']
+    if not get_backend(request):
+        return Response('Backend not found', 404)
+
+    params = request.json_body
+    host = params.get('host', None)
+    ssh_user = params.get('ssh_user', None)
+    if not ssh_user or ssh_user == 'undefined':
+        ssh_user = 'root'
+
     try:
-        conn = connect(request)
+        keypairs = request.environ['beaker.session']['keypairs']
+    except:
+        keypairs = request.registry.settings.get('keypairs', {})
+
+    keypair = get_keypair(keypairs, backend_id, machine_id)
+    if not host or not keypair:
+        return Response('Host or key not set', 400)
+
+    sessions = request.registry.shell_sessions
+    try:
+        session = sessions.open(host, ssh_user, keypair['private'],
+                                backend_id, machine_id)
+    except Exception as e:
+        log.error('Exception while opening shell: %s' % e)
+        return Response('Exception while opening shell: %s' % e, 503)
+
+    if not session:
+        return Response('Too many shell sessions, try again later', 503)
+    return {'session': session.id}
+
+
+@view_config(route_name='session', request_method='POST')
+def write_shell_session(request):
+    """Sends input, e.g. a command and a newline, to a shell session."""
+    session = request.registry.shell_sessions.get(
+        request.matchdict['session'])
+    if not session:
+        return Response('Session not found', 404)
+
+    try:
+        data = request.json_body['input']
+    except:
+        return Response('Input not set', 400)
+
+    try:
+        session.write(data.encode('utf-8'))
+    except Exception as e:
+        request.registry.shell_sessions.close(session.id)
+        return Response('Exception while writing to shell: %s' % e, 503)
+    return Response('OK', 200)
+
+
+@view_config(route_name='session', request_method='DELETE')
+def close_shell_session(request):
+    request.registry.shell_sessions.close(request.matchdict['session'])
+    return Response('OK', 200)
+
+
+@view_config(route_name='session_output', request_method='GET')
+def stream_shell_session(request):
+    """Streams the output of a shell session as server-sent events.
+
+    Output is sent in 'output' events holding a json string, with the
+    offset it ends at as event id. Browsers send that back as Last-Event-ID
+    when they reconnect, so the stream resumes where it left off, or offset
+    may be passed. A 'closed' event is sent once the shell exits. Streams
+    last EVENTS_STREAM_TIMEOUT seconds like the machine events, and count
+    against the same events_max_subscribers, extra ones get a 503.
+    """
+    session = request.registry.shell_sessions.get(
+        request.matchdict['session'])
+    if not session:
+        return Response('Session not found', 404)
+
+    try:
+        offset = int(request.headers.get('Last-Event-ID',
+                                         request.params.get('offset', 0)))
+    except ValueError:
+        return Response('Invalid offset', 400)
+
+    def stream(offset):
+        deadline = time() + EVENTS_STREAM_TIMEOUT
+        yield 'retry: 1000\n\n'
+        while time() < deadline:
+            timeout = min(EVENTS_KEEPALIVE, deadline - time())
+            offset, output = session.get_output(offset, timeout)
+            if output:
+                yield 'id: %d\nevent: output\ndata: %s\n\n' % (
+                      offset, json.dumps(output.decode('utf-8', 'replace')))
+            elif session.closed:
+                yield 'event: closed\ndata: {}\n\n'
+                return
+            else:
+                yield ': keepalive\n\n'
+
+    poller = request.registry.poller
+    if not poller.subscribe():
+        return Response('Too many subscribers', 503)
+
+    response = Response(content_type='text/event-stream',
+                        app_iter=Subscription(poller, stream(offset)))
+    response.headers['Cache-Control'] = 'no-cache'
+    return response
+
+
+@view_config(route_name='uptimes', request_method='POST')
+def check_uptimes(request):
+    """Gets the uptime of many machines at once, over ssh.
+
+    Expects a list of machines, each a dict with backend, machine, host and
+    ssh_user. At most SSH_BATCH_CONCURRENCY machines are checked at the same
+    time. Results are streamed as they come, one json object per line, with
+    the backend, machine, status and output of cat /proc/uptime, or the
+    error if status is not 200.
+    """
+    try:
+        machines = request.json_body['machines']
+    except:
+        return Response('Machines not set', 400)
+    if not isinstance(machines, list) or \
+            not all(isinstance(machine, dict) for machine in machines):
+        return Response('Malformed machines', 400)
+
+    try:
+        keypairs = request.environ['beaker.session']['keypairs']
+    except:
+        keypairs = request.registry.settings.get('keypairs', {})
+
+    backends = {}
+    missing = []
+    targets = []
+    for machine in machines:
+        backend_id = machine.get('backend', None)
+        machine_id = machine.get('machine', None)
+        if not isinstance(backend_id, basestring):
+            missing.append(machine)
+            continue
+        if not backend_id in backends:
+            backends[backend_id] = get_backend(request, backend_id)
+        if not backends[backend_id]:
+            missing.append(machine)
+            continue
+
+        ssh_user = machine.get('ssh_user', None)
+        if ssh_user == 'undefined':
+            ssh_user = None
+        keypair = get_keypair(keypairs, backend_id, machine_id)
+        targets.append({'backend': backend_id,
+                        'backend_settings': backends[backend_id],
+                        'machine_id': machine_id,
+                        'host': machine.get('host', None),
+                        'ssh_user': ssh_user,
+                        'private_key': keypair and keypair['private']})
+
+    def stream():
+        for machine in missing:
+            yield json.dumps({'backend': machine.get('backend', None),
+                              'machine': machine.get('machine', None),
+                              'status': 404,
+                              'output': 'Backend not found'}) + '\n'
+
+        results = run_commands(targets, 'cat /proc/uptime',
+                               SSH_BATCH_CONCURRENCY)
+        for target, output in results:
+            if isinstance(output, Response):
+                status = output.status_int
+                output = output.body
+            else:
+                status = 200
+            yield json.dumps({'backend': target['backend'],
+                              'machine': target['machine_id'],
+                              'status': status,
+                              'output': output}) + '\n'
+
+    response = Response(content_type='application/x-json-stream',
+                        app_iter=stream())
+    response.headers['Cache-Control'] = 'no-cache'
+    return response
+
+
+@view_config(route_name='fleet_shell', request_method='POST')
+def fleet_shell_command(request):
+    """Runs a shell command on many machines at once, over ssh.
+
+    The machines are either given as a list, each a dict with backend,
+    machine, host, ssh_user and optionally name, or selected by backend
+    and/or tag, in which case the running machines of that backend, or all
+    enabled backends, carrying that tag are used.
+
+    At most SSH_BATCH_CONCURRENCY machines run the command at the same time,
+    each for at most timeout seconds. Output is streamed as it comes, every
+    line prefixed with the machine's name. Once all are done, a summary with
+    the exit status of each machine, or the error it failed with, follows.
+    """
+    try:
+        params = request.json_body
+        command = params.get('command', None)
+    except:
+        return Response('Malformed request', 400)
+    if not command:
+        return Response('Command not set', 400)
+
+    try:
+        timeout = min(int(params.get('timeout', COMMAND_TIMEOUT)),
+                      SHELL_MAX_TIMEOUT)
+    except:
+        return Response('Malformed timeout', 400)
+
+    try:
+        backends = request.environ['beaker.session']['backends']
     except:
+        backends = request.registry.settings['backends']
+
+    try:
+        keypairs = request.environ['beaker.session']['keypairs']
+    except:
+        keypairs = request.registry.settings.get('keypairs', {})
+
+    poller = getattr(request.registry, 'poller', None)
+    if 'beaker.session' in request.environ:
+        poller = None
+
+    machines = params.get('machines', None)
+    if machines is None:
+        backend_id = params.get('backend', None)
+        tag = params.get('tag', None)
+        if not backend_id and not tag:
+            return Response('Machines not set', 400)
+        if backend_id and not backend_id in backends:
+            return Response('Backend not found', 404)
+
+        machines = []
+        for selected_id, backend in backends.items():
+            if backend_id and selected_id != backend_id:
+                continue
+            if not backend.get('enabled', True):
+                continue
+            try:
+                if poller:
+                    listed = poller.get_machines(selected_id)
+                else:
+                    with get_connection(selected_id, backend) as conn:
+                        listed = get_machines(conn)
+            except:
+                evict_driver(selected_id)
+                return Response('Backend unavailable', 503)
+            for machine in listed:
+                if machine['state'] != 'running':
+                    continue
+                if tag and not tag in machine['tags']:
+                    continue
+                machines.append({'backend': selected_id,
+                                 'machine': machine['id'],
+                                 'name': machine['name'],
+                                 'host': get_machine_host(machine),
+                                 'ssh_user': get_machine_user(machine)})
+    elif not isinstance(machines, list) or \
+            not all(isinstance(machine, dict) for machine in machines):
+        return Response('Malformed machines', 400)
+
+    targets = []
+    for machine in machines:
+        keypair = get_keypair(keypairs, machine.get('backend', None),
+                              machine.get('machine', None))
+        ssh_user = machine.get('ssh_user', None)
+        if ssh_user == 'undefined':
+            ssh_user = None
+        name = machine.get('name', None) or machine.get('machine', None)
+        if isinstance(name, unicode):
+            # output is raw bytes, keep names from turning lines unicode
+            name = name.encode('utf-8')
+        targets.append({'name': name,
+                        'host': machine.get('host', None),
+                        'ssh_user': ssh_user,
+                        'private_key': keypair and keypair['private']})
+
+    def stream():
+        exits = []
+        results = stream_commands(targets, command, SSH_BATCH_CONCURRENCY,
+                                  timeout)
+        for kind, target, value in results:
+            if kind == 'output':
+                yield '%s: %s\n' % (target['name'], value)
+            else:
+                exits.append((target['name'], value))
+
+        yield '\n'
+        for name, status in exits:
+            if isinstance(status, int):
+                yield '%s: exit status %d\n' % (name, status)
+            else:
+                yield '%s: failed, %s\n' % (name, status)
+
+    response = Response(content_type='text/plain', app_iter=stream())
+    response.headers['Cache-Control'] = 'no-cache'
+    return response
+
+
+@view_config(route_name='images', request_method='GET', renderer='json')
+def list_images(request):
+    """List images from each backend.
+
+    Images come from the backend's image catalog, which is stored on disk
+    and revalidated in the background, check catalog.ImageCatalog.
+
+    Without parameters all images are returned. Pass q to search by name or
+    distro, and offset and limit to page through the matches. Then a dict
+    with the total number of matches and the images in the page is returned.
+    """
+    backend_id = request.matchdict['backend']
+    backend = get_backend(request)
+    if not backend:
         return Response('Backend not found', 404)
 
+    catalog = request.registry.image_catalog
     try:
-        if conn.type in EC2_PROVIDERS:
-            images = conn.list_images(None, EC2_IMAGES[conn.type].keys())
-            for image in images:
-                image.name = EC2_IMAGES[conn.type][image.id]
-        else:
-            images = conn.list_images()
+        images = catalog.get(backend_id, backend)
     except:
         return Response('Backend unavailable', 503)
 
-    ret = []
-    for image in images:
-        ret.append({'id'    : image.id,
-                    'extra' : image.extra,
-                    'name'  : image.name,
-                    })
-    return ret
+    if not 'q' in request.params and not 'offset' in request.params:
+        return images['images']
+
+    try:
+        offset = int(request.params.get('offset', 0))
+        limit = int(request.params.get('limit', IMAGES_PAGE_SIZE))
+    except ValueError:
+        return Response('Invalid offset or limit', 400)
+    if offset < 0 or limit < 1:
+        return Response('Invalid offset or limit', 400)
+
+    total, page = catalog.search(images, request.params.get('q', ''),
+                                 offset, limit)
+    return {'total': total,
+            'offset': offset,
+            'images': page}
 
 
 @view_config(route_name='sizes', request_method='GET', renderer='json')
 def list_sizes(request):
-    """List sizes (aka flavors) from each backend."""
-    try:
-        conn = connect(request)
-    except:
+    """List sizes (aka flavors) from each backend.
+
+    Sizes are cached for SIZES_TTL, check catalog.ListingCache.
+    """
+    backend = get_backend(request)
+    if not backend:
         return Response('Backend not found', 404)
 
     try:
-        sizes = conn.list_sizes()
+        sizes = request.registry.sizes.get(request.matchdict['backend'],
+                                           backend)
     except:
         return Response('Backend unavailable', 503)
 
@@ -726,20 +1482,22 @@ def list_locations(request):
 
     In EC2 all locations by a provider have the same name, so the availability
     zones are listed instead of name.
+
+    Locations are cached for LOCATIONS_TTL, check catalog.ListingCache.
     """
-    try:
-        conn = connect(request)
-    except:
+    backend = get_backend(request)
+    if not backend:
         return Response('Backend not found', 404)
 
     try:
-        locations = conn.list_locations()
+        locations = request.registry.locations.get(
+            request.matchdict['backend'], backend)
     except:
         return Response('Backend unavailable', 503)
 
     ret = []
     for location in locations:
-        if conn.type in EC2_PROVIDERS:
+        if backend['provider'] in EC2_PROVIDERS:
             name = location.availability_zone.name
         else:
             name = location.name
@@ -775,10 +1533,15 @@ def list_keys(request):
 
 @view_config(route_name='keys', request_method='POST', renderer='json')
 def generate_keypair(request):
-    """Generate a random keypair"""
-    key = RSA.generate(2048, os.urandom)
-    return {'public': key.exportKey('OpenSSH'),
-            'private': key.exportKey()}
+    """Generate a random keypair
+
+    Keypairs come from the keypair pool, generated ahead of time, check
+    keygen.KeypairPool.
+    """
+    pool = getattr(request.registry, 'keypair_pool', None)
+    if pool:
+        return pool.get()
+    return keygen.generate_keypair()
 
 
 @view_config(route_name='key', request_method='PUT', renderer='json')
@@ -793,7 +1556,8 @@ def add_key(request):
         key['default'] = True
   
     request.registry.settings['keypairs'][id] = key
-    save_settings(request)
+    get_keypair_index(request.registry.settings['keypairs']).update(id)
+    get_store(request).save_keypair(id)
 
     ret = {'name': id, 
            'pub': key['public'], 
@@ -816,8 +1580,9 @@ def set_default_key(request):
             keypairs[key]['default'] = False
  
     keypairs[id]['default'] = True
+    get_keypair_index(keypairs).update(id)
   
-    save_settings(request)
+    get_store(request).set_default_keypair(id)
 
     return {}
 
@@ -856,7 +1621,7 @@ def associate_key_to_machines(request):
 
 	    keypair['machines'].append(pair)
 
-
+    get_keypair_index(keypairs).update(key_name)
     save_keypairs(request, keypair)
 
     return {}
@@ -885,8 +1650,10 @@ def associate_key_to_machine(request):
 
     machine_backend = [backend_id, machine_id]
 
-    if not machine_backend in keypair['machines']:
-        keypair['machines'].append(machine_backend)
+    index = get_keypair_index(keypairs)
+    if not index.has(key_name, backend_id, machine_id):
+        keypair.setdefault('machines', []).append(machine_backend)
+        index.update(key_name)
 
     save_keypairs(request, keypair)
 
@@ -915,11 +1682,11 @@ def disassociate_key_to_machine(request):
 
     machine_backend = [backend_id, machine_id]
 
-    for pair in keypair['machines']:
-        if pair == machine_backend:
-            keypair['machines'].remove(pair)
-            save_keypairs(request, keypair)
-            break
+    index = get_keypair_index(keypairs)
+    if index.has(key_name, backend_id, machine_id):
+        keypair['machines'].remove(machine_backend)
+        index.update(key_name)
+        save_keypairs(request, keypair)
 
     return {}
 
@@ -953,16 +1720,20 @@ def delete_key(request):
     params = request.json_body
     id = params.get('name', '')
 
-    key = request.registry.settings['keypairs'].pop(id)
+    keypairs = request.registry.settings['keypairs']
+    key = keypairs.pop(id)
+    index = get_keypair_index(keypairs)
+    index.update(id)
     if key.get('default', None):
         #if we delete the default key, make the next one as default, provided 
         #that it exists
         try:
-           first_key_id = request.registry.settings['keypairs'].keys()[0]
-           request.registry.settings['keypairs'][first_key_id]['default'] = True
+           first_key_id = keypairs.keys()[0]
+           keypairs[first_key_id]['default'] = True
+           index.update(first_key_id)
         except KeyError: 
             pass
-    save_settings(request)
+    get_store(request).delete_keypair(id)
 
     return {}
 
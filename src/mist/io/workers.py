@@ -0,0 +1,109 @@
+"""Bounded thread pools for running blocking calls in parallel"""
+import logging
+import threading
+
+from time import time
+from Queue import Queue
+
+
+log = logging.getLogger('mist.io')
+
+
+class Job(object):
+    """A call submitted to a WorkerPool, holds its result or exception."""
+
+    def __init__(self, func, args, kwargs):
+        self.func = func
+        self.args = args
+        self.kwargs = kwargs
+        self.result = None
+        self.error = None
+        # when a worker picked it up
+        self.started = None
+        self.done = threading.Event()
+        self.queues = []
+        self.lock = threading.Lock()
+
+    def run(self):
+        self.started = time()
+        try:
+            self.result = self.func(*self.args, **self.kwargs)
+        except Exception as exc:
+            self.error = exc
+        finally:
+            with self.lock:
+                self.done.set()
+                queues = self.queues
+            for queue in queues:
+                queue.put(self)
+
+    def notify(self, queue):
+        """Puts the job in queue once it is done, right away if it already is.
+
+        Lets a caller wait for whichever of many jobs finishes first.
+        """
+        with self.lock:
+            if not self.done.is_set():
+                self.queues.append(queue)
+                return
+        queue.put(self)
+
+    def wait(self, timeout=None):
+        """Waits for the job to finish, returns False if it didn't in time."""
+        self.done.wait(timeout)
+        return self.done.is_set()
+
+    def wait_running(self, timeout, queue_timeout):
+        """Waits for the job to finish within timeout seconds of starting.
+
+        Time spent waiting for a worker doesn't count, so jobs queued behind
+        slow ones get their full timeout. Gives up if no worker picks the
+        job up within queue_timeout seconds. Returns like wait().
+        """
+        deadline = time() + queue_timeout
+        while not self.done.is_set():
+            started = self.started
+            if started:
+                remaining = started + timeout - time()
+            else:
+                # check now and then whether it started
+                remaining = min(deadline - time(), 0.5)
+                if time() >= deadline:
+                    break
+            if remaining <= 0:
+                break
+            self.done.wait(remaining)
+        return self.done.is_set()
+
+
+class WorkerPool(object):
+    """A fixed number of daemon threads running jobs from a queue.
+
+    The pool never runs more than size calls at once, whatever the number of
+    requests submitting them. If queue_size is set, submit() raises
+    Queue.Full when that many jobs are already waiting, so that callers can
+    turn work away instead of piling it up.
+    """
+
+    def __init__(self, size, queue_size=0, name='worker'):
+        self.size = size
+        self.queue = Queue(queue_size)
+        self.threads = []
+        for i in range(size):
+            thread = threading.Thread(target=self.work,
+                                      name='%s-%d' % (name, i))
+            thread.daemon = True
+            thread.start()
+            self.threads.append(thread)
+
+    def submit(self, func, *args, **kwargs):
+        """Queues func to be called with args and kwargs, returns its Job."""
+        job = Job(func, args, kwargs)
+        self.queue.put(job, False)
+        return job
+
+    def work(self):
+        while True:
+            job = self.queue.get()
+            job.run()
+            self.queue.task_done()
@@ -0,0 +1,40 @@
+"""Cooperative server mode, serving the app from gevent green threads
+
+Use it as the server of an ini file, as gevent.ini does::
+
+    [server:main]
+    use = egg:mist.io#gevent
+
+Importing this module monkey-patches the standard library, so that the
+sockets of libcloud, requests and paramiko, and the threads and locks of
+the poller, the worker pools and the shell sessions all become green and
+yield to each other while waiting on I/O, instead of each pinning an OS
+thread. That only works if nothing of mist.io was imported yet, since its
+modules create locks and import libcloud and paramiko on import. Importing
+anything under mist.io runs mist/io/__init__.py first, so this module lives
+outside the package. paster loads the server before the app, so patching
+takes place before mist.io is imported.
+
+CPU bound work, e.g. generating keys, still blocks the whole process while
+it runs, so gevent.ini keeps keypair_pool_size small.
+"""
+from gevent import monkey
+monkey.patch_all()
+
+import logging
+
+from gevent.pool import Pool
+from gevent.pywsgi import WSGIServer
+
+
+log = logging.getLogger('mist.io')
+
+
+def serve(app, global_conf, host='0.0.0.0', port=6543, connections=10000):
+    """Paste server runner, serves app with gevent's WSGI server.
+
+    Each connection is handled in a greenlet, at most connections at once.
+    """
+    server = WSGIServer((host, int(port)), app, spawn=Pool(int(connections)))
+    log.info('Serving on http://%s:%s with gevent' % (host, port))
+    server.serve_forever()